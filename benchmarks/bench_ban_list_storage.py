@@ -0,0 +1,126 @@
+"""バンリストの保存方式のベンチマーク（JSON + ジャーナル vs SQLite）
+
+100万件のユーザーIDで、起動時の読み込み・1件追加の書き込み・
+スナップショットの圧縮・登録内容の検索にかかる時間とファイルサイズを測る。
+
+使い方（リポジトリのルートで実行）:
+    py benchmarks/bench_ban_list_storage.py [--ids 1000000]
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import harness  # noqa: E402
+
+main = harness.import_main()
+
+LOOKUPS = 20000
+
+
+def make_ids(count):
+    rng = random.Random(0)
+    return [str(rng.randrange(10**17, 2**62)) for _ in range(count)]
+
+
+def file_size_mib(*paths):
+    return sum(os.path.getsize(path) for path in paths if os.path.exists(path)) / 1024 / 1024
+
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return time.perf_counter() - start, result
+
+
+async def timed_async(coro):
+    start = time.perf_counter()
+    await coro
+    return time.perf_counter() - start
+
+
+def bench_memory_lookup(ban_list, ids):
+    rng = random.Random(1)
+    probes = [rng.choice(ids) if i % 2 else str(rng.randrange(10**17, 2**62)) for i in range(LOOKUPS)]
+    elapsed, _ = timed(lambda: [ban_list.has_user(user_id) for user_id in probes])
+    return elapsed / LOOKUPS * 1e6
+
+
+async def bench_json(work_dir, ids):
+    path = os.path.join(work_dir, "ban_list.json")
+    journal = os.path.join(work_dir, "ban_list.journal")
+    write_s, _ = timed(lambda: main.save_ban_list({"user_ids": ids, "texts": []}, path))
+    load_s, ban_list = timed(lambda: main.BanList(path, journal))
+    assert len(ban_list.user_ids) == len(ids)
+    ban_list.add_user("1", added_by=1, reason="bench")
+    add_s = await timed_async(ban_list.flush())
+    compact_s = await timed_async(ban_list.flush(compact=True))
+    return {
+        "write_s": write_s,
+        "load_s": load_s,
+        "add_flush_ms": add_s * 1000,
+        "compact_s": compact_s,
+        "lookup_us": None,
+        "has_user_us": bench_memory_lookup(ban_list, ids),
+        "size_mib": file_size_mib(path, journal),
+    }
+
+
+async def bench_sqlite(work_dir, ids):
+    db_path = os.path.join(work_dir, "ban_list.db")
+    missing = os.path.join(work_dir, "missing.json")
+    ban_list = main.SqliteBanList(db_path, missing, missing + ".journal")
+
+    def bulk_import():
+        ban_list.import_data({"user_ids": ids, "texts": []}, reason="bench")
+        ban_list.flush_sync()
+
+    write_s, _ = timed(bulk_import)
+    del ban_list
+    load_s, ban_list = timed(lambda: main.SqliteBanList(db_path, missing, missing + ".journal"))
+    assert len(ban_list.user_ids) == len(ids)
+    ban_list.add_user("1", added_by=1, reason="bench")
+    add_s = await timed_async(ban_list.flush())
+    compact_s = await timed_async(ban_list.flush(compact=True))
+
+    # 登録内容の検索（user_id のインデックスを使う）
+    rng = random.Random(2)
+    probes = [rng.choice(ids) for _ in range(LOOKUPS // 10)]
+    lookup_s, _ = timed(lambda: [ban_list._query_user(user_id) for user_id in probes])
+    return {
+        "write_s": write_s,
+        "load_s": load_s,
+        "add_flush_ms": add_s * 1000,
+        "compact_s": compact_s,
+        "lookup_us": lookup_s / len(probes) * 1e6,
+        "has_user_us": bench_memory_lookup(ban_list, ids),
+        "size_mib": file_size_mib(db_path, db_path + "-wal"),
+    }
+
+
+async def amain(args):
+    ids = make_ids(args.ids)
+    print(f"{args.ids:,} user IDs")
+    print(f"{'backend':>8} {'write(s)':>9} {'load(s)':>8} {'add+flush(ms)':>14} {'compact(s)':>11} "
+          f"{'sql lookup(us)':>15} {'has_user(us)':>13} {'size(MiB)':>10}")
+    for name, bench in (("json", bench_json), ("sqlite", bench_sqlite)):
+        with tempfile.TemporaryDirectory(prefix="antiraid-storage-") as work_dir:
+            r = await bench(work_dir, ids)
+        lookup = f"{r['lookup_us']:.1f}" if r["lookup_us"] is not None else "-"
+        print(f"{name:>8} {r['write_s']:>9.2f} {r['load_s']:>8.2f} {r['add_flush_ms']:>14.2f} {r['compact_s']:>11.2f} "
+              f"{lookup:>15} {r['has_user_us']:>13.2f} {r['size_mib']:>10.1f}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--ids", type=int, default=1_000_000, help="ユーザーIDの件数")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(amain(parse_args()))
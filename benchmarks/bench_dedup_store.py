@@ -0,0 +1,87 @@
+"""処理済み記録（DedupStore）の削除順・メモリ使用量・速度の確認
+
+使い方（リポジトリのルートで実行）:
+    py benchmarks/bench_dedup_store.py
+"""
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import harness  # noqa: E402
+
+DedupStore = harness.import_main().DedupStore
+
+GUILD_ID = 1100000000000000000
+KEY_COUNT = 1_000_000
+
+
+def check_eviction_order():
+    """上限を超えたら最も長く使われていないキーから削除されることを確認"""
+    store = DedupStore(max_entries=3, ttl=60)
+    keys = [DedupStore.make_key(GUILD_ID, user_id, "検知") for user_id in range(5)]
+    store.add(keys[0])
+    store.add(keys[1])
+    store.add(keys[2])
+    assert keys[0] in store  # keys[0] を使ったので keys[1] が最も古くなる
+    store.add(keys[3])
+    assert store.keys() == [keys[2], keys[0], keys[3]]
+    store.add(keys[4])
+    assert store.keys() == [keys[0], keys[3], keys[4]]
+    assert store.evicted == 2
+    print("削除順: OK（最も長く使われていないキーから削除）")
+
+
+def check_expiry():
+    """有効期限が切れたキーは存在しない扱いになり、追加時に先頭から削除されることを確認"""
+    store = DedupStore(max_entries=100, ttl=0.05)
+    first = DedupStore.make_key(GUILD_ID, 1, "検知")
+    store.add(first)
+    assert first in store
+    time.sleep(0.06)
+    assert first not in store
+    store.add(first)
+    time.sleep(0.06)
+    store.add(DedupStore.make_key(GUILD_ID, 2, "検知"))
+    assert len(store) == 1 and store.expired == 2
+    print("有効期限: OK")
+
+
+def measure_memory():
+    """100万キーでのメモリ使用量と操作速度"""
+    store = DedupStore(max_entries=KEY_COUNT, ttl=3600)
+    keys = [DedupStore.make_key(GUILD_ID, 900000000000000000 + i, "禁止文字列検知") for i in range(KEY_COUNT)]
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    for key in keys:
+        store.add(key)
+    add_seconds = time.perf_counter() - start
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    hits = sum(1 for key in keys if key in store)
+    lookup_seconds = time.perf_counter() - start
+    assert hits == KEY_COUNT
+
+    # 上限を超えて追加しても件数は増えない
+    store.add(DedupStore.make_key(GUILD_ID, 1, "禁止文字列検知"))
+    assert len(store) == KEY_COUNT and store.evicted == 1
+
+    print(f"キー数: {len(store):,}")
+    print(f"メモリ: {current / 1024 / 1024:.1f} MiB（1キーあたり {current / KEY_COUNT:.0f} バイト、キー整数は除く）")
+    print(f"追加: {KEY_COUNT / add_seconds / 1e6:.2f} M ops/秒")
+    print(f"検索: {KEY_COUNT / lookup_seconds / 1e6:.2f} M ops/秒")
+
+
+def main():
+    check_eviction_order()
+    check_expiry()
+    measure_memory()
+
+
+if __name__ == "__main__":
+    main()
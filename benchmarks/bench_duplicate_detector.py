@@ -0,0 +1,71 @@
+"""重複投稿検知（DuplicateDetector）の1件あたりの処理時間と検知結果の確認
+
+使い方（リポジトリのルートで実行）:
+    py benchmarks/bench_duplicate_detector.py
+"""
+import os
+import random
+import string
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import harness  # noqa: E402
+
+main = harness.import_main()
+
+MESSAGE_COUNT = 20000
+SPAM = "🎁 Free Discord Nitro for everyone! Claim it here before it expires: https://disc0rd-gift.com/{code}"
+
+
+def make_message(message_id, author_id, content, channel_id=1):
+    return SimpleNamespace(
+        id=message_id,
+        content=content,
+        author=SimpleNamespace(id=author_id),
+        channel=SimpleNamespace(id=channel_id),
+    )
+
+
+def make_vocabulary(rng, size=3000):
+    return ["".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(2, 9))) for _ in range(size)]
+
+
+def random_chat(rng, vocabulary):
+    return " ".join(rng.choice(vocabulary) for _ in range(rng.randint(6, 30)))
+
+
+def main_bench():
+    rng = random.Random(0)
+    detector = main.DuplicateDetector()
+    vocabulary = make_vocabulary(rng)
+    messages = []
+    for i in range(MESSAGE_COUNT):
+        if i % 50 == 0:
+            code = "".join(rng.choice(string.ascii_letters) for _ in range(6))
+            content = SPAM.format(code=code)
+        else:
+            content = random_chat(rng, vocabulary)
+        messages.append(make_message(i, 1000 + i, content, channel_id=i % 40))
+
+    flagged = 0
+    latencies = []
+    start = time.perf_counter()
+    for message in messages:
+        t0 = time.perf_counter()
+        cluster, newly_flagged = detector.check(message)
+        latencies.append(time.perf_counter() - t0)
+        flagged += newly_flagged
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    print(f"メッセージ数: {MESSAGE_COUNT:,}（{MESSAGE_COUNT / elapsed:,.0f} 件/秒）")
+    print(f"1件あたり: 中央値 {latencies[len(latencies) // 2] * 1e6:.1f}us / p99 {latencies[int(len(latencies) * 0.99)] * 1e6:.1f}us")
+    print(f"検知したまとまり: {flagged}件（索引中のまとまり {len(detector.clusters):,}件）")
+    assert flagged == 1, "スパム文章だけが1つのまとまりとして検知されるはず"
+
+
+if __name__ == "__main__":
+    main_bench()
@@ -0,0 +1,92 @@
+"""管理者（対象外）判定のベンチマーク（従来の判定 vs ExemptCache）
+
+本物の discord.Guild / discord.Member を組み立てて、ロール数が 1 と 100 の
+メンバーで1回あたりの判定時間を測る。
+
+使い方（リポジトリのルートで実行）:
+    py benchmarks/bench_exempt_check.py
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import harness  # noqa: E402
+
+main = harness.import_main()
+discord = main.discord
+
+GUILD_ID = 1
+ROLE_COUNTS = [1, 100]
+# 設定する管理者ロール数（メンバーはどれも持たない＝従来の判定で最も遅い場合）
+ADMIN_ROLE_COUNT = 3
+ITERATIONS = 20000
+
+
+def make_guild(role_count):
+    roles = [
+        {"id": str(GUILD_ID if i == 0 else 1000 + i), "name": f"role{i}", "permissions": "0", "position": i,
+         "color": 0, "hoist": False, "managed": False, "mentionable": False}
+        for i in range(role_count + ADMIN_ROLE_COUNT + 1)
+    ]
+    data = {"id": str(GUILD_ID), "name": "bench", "roles": roles, "owner_id": "2", "members": [], "channels": []}
+    return discord.Guild(data=data, state=main.bot._connection)
+
+
+def make_member(guild, user_id, role_ids):
+    data = {
+        "user": {"id": str(user_id), "username": f"user{user_id}", "discriminator": "0", "avatar": None},
+        "roles": [str(role_id) for role_id in role_ids],
+        "joined_at": None,
+        "flags": 0,
+    }
+    return discord.Member(data=data, guild=guild, state=main.bot._connection)
+
+
+def legacy_is_admin(member, admin_role_ids):
+    """従来の is_admin と同じ処理"""
+    if member.guild_permissions.administrator:
+        return True
+    if admin_role_ids:
+        member_role_ids = [role.id for role in member.roles]
+        for admin_role_id in admin_role_ids:
+            if admin_role_id in member_role_ids:
+                return True
+    return False
+
+
+def bench(func):
+    start = time.perf_counter()
+    for _ in range(ITERATIONS):
+        func()
+    return (time.perf_counter() - start) / ITERATIONS
+
+
+def main_bench():
+    print(f"{'roles':>6} {'legacy(us)':>11} {'miss(us)':>9} {'hit(us)':>8} {'speedup(hit)':>13}")
+    for role_count in ROLE_COUNTS:
+        guild = make_guild(role_count)
+        member_roles = [1000 + i for i in range(1, role_count + 1)]
+        admin_roles = [1000 + role_count + i for i in range(1, ADMIN_ROLE_COUNT + 1)]
+        main.guild_configs.set(GUILD_ID, "admin_role_ids", admin_roles)
+        cache = main.ExemptCache()
+
+        member = make_member(guild, 5, member_roles)
+        admin = make_member(guild, 6, member_roles[:-1] + admin_roles[-1:])
+        # 結果が一致することを確認
+        for target in (member, admin):
+            assert cache.is_exempt(target) == legacy_is_admin(target, admin_roles)
+
+        def miss():
+            cache.invalidate_member(GUILD_ID, member.id)
+            cache.is_exempt(member)
+
+        legacy_us = bench(lambda: legacy_is_admin(member, admin_roles)) * 1e6
+        miss_us = bench(miss) * 1e6
+        hit_us = bench(lambda: cache.is_exempt(member)) * 1e6
+        print(f"{role_count:>6} {legacy_us:>11.2f} {miss_us:>9.2f} {hit_us:>8.2f} {legacy_us / hit_us:>12.1f}x")
+
+
+if __name__ == "__main__":
+    main_bench()
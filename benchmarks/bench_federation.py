@@ -0,0 +1,106 @@
+"""連携モード（複数サーバーへの処罰の展開）のベンチマーク
+
+全サーバーに参加している荒らしを1つのサーバーで検知したときに、他のすべての
+サーバーで処罰が終わるまでの時間を、全体の同時実行数ごとに測る。あわせて、
+ユーザー → サーバーの逆引きの作成時間と、全サーバーを調べる方法との検索時間を比べる。
+
+使い方（リポジトリのルートで実行）:
+    py benchmarks/bench_federation.py [--guilds 300] [--members 1000] [--latency-ms 50]
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import harness  # noqa: E402
+
+main = harness.import_main()
+
+RAIDER_ID = 999
+CONCURRENCY = [1, 10, 50]
+LOOKUPS = 2000
+
+
+def build_guilds(args, rest):
+    rng = random.Random(0)
+    created_at = main.discord.utils.utcnow()
+    # 一部のユーザーが複数のサーバーに参加するよう、共通の候補から選ぶ
+    pool = range(10_000, 10_000 + args.guilds * args.members // 2)
+    guilds = []
+    for index in range(args.guilds):
+        guild = harness.FakeGuild(1_000_000 * (index + 1), f"guild{index}", rest)
+        for user_id in rng.sample(pool, args.members):
+            guild.add_member(harness.FakeMember(guild, user_id, f"user{user_id}", created_at))
+        guild.add_member(harness.FakeMember(guild, RAIDER_ID, "raider", created_at))
+        main.guild_configs.set(guild.id, "federation", True)
+        main.guild_configs.set(guild.id, "log_channel_id", guild.id + 1)
+        guilds.append(guild)
+    harness.install_guilds(main, guilds)
+    return guilds
+
+
+def reset_queues():
+    for queue in main.punishment_queues.values():
+        for worker in queue.workers:
+            worker.cancel()
+    main.punishment_queues.clear()
+
+
+async def bench_fanout(guilds, rest, concurrency):
+    reset_queues()
+    main.punishment_semaphore = asyncio.Semaphore(concurrency)
+    main.federation = main.Federation()
+    for guild in guilds:
+        if guild.get_member(RAIDER_ID) is None:
+            guild.add_member(harness.FakeMember(guild, RAIDER_ID, "raider", main.discord.utils.utcnow()))
+    rest.calls.clear()
+    started = time.perf_counter()
+    assert main.federation.propagate(guilds[0], RAIDER_ID, "bench")
+    await asyncio.gather(*main.federation.tasks)
+    return time.perf_counter() - started, sum(rest.calls.values())
+
+
+async def amain(args):
+    rest = harness.FakeRest(latency=args.latency_ms / 1000)
+    guilds = build_guilds(args, rest)
+
+    started = time.perf_counter()
+    await main.member_index.rebuild(guilds)
+    build_s = time.perf_counter() - started
+    print(f"{args.guilds} guilds x {args.members} members, REST latency {args.latency_ms}ms")
+    print(f"member index: {len(main.member_index):,} users, built in {build_s * 1000:.0f}ms")
+
+    rng = random.Random(1)
+    probes = [rng.choice(guilds).members[0].id for _ in range(LOOKUPS)]
+    started = time.perf_counter()
+    for user_id in probes:
+        main.member_index.guilds_of(user_id)
+    index_us = (time.perf_counter() - started) / LOOKUPS * 1e6
+    started = time.perf_counter()
+    for user_id in probes:
+        [guild.id for guild in main.bot.guilds if guild.get_member(user_id) is not None]
+    scan_us = (time.perf_counter() - started) / LOOKUPS * 1e6
+    print(f"guilds of a user: index {index_us:.2f}us / scan all guilds {scan_us:.1f}us")
+
+    print(f"{'concurrency':>12} {'fan-out(s)':>11} {'REST calls':>11}")
+    for concurrency in CONCURRENCY:
+        elapsed, calls = await bench_fanout(guilds, rest, concurrency)
+        print(f"{concurrency:>12} {elapsed:>11.2f} {calls:>11}")
+    await asyncio.gather(*main.log_sink.tasks.values())
+    reset_queues()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--guilds", type=int, default=300, help="サーバー数")
+    parser.add_argument("--members", type=int, default=1000, help="サーバーあたりのメンバー数")
+    parser.add_argument("--latency-ms", type=float, default=50, help="1回の API 呼び出しにかかる時間（ミリ秒）")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(amain(parse_args()))
@@ -0,0 +1,132 @@
+"""禁止ドメイン・招待リンクの判定のベンチマーク（LinkMatcher vs 部分一致の TextMatcher）
+
+禁止ドメインの件数ごとに、マッチャーの作成時間・メモリ使用量（tracemalloc で計測）と、
+リンクを含む/含まないメッセージ1件あたりの判定時間を測る。LinkMatcher の判定時間が
+リストの件数によらないことと、部分一致では誤検知になる例（notevil.com.example など）を確認する。
+
+使い方（リポジトリのルートで実行）:
+    py benchmarks/bench_link_matcher.py [--domains 100000]
+"""
+import argparse
+import gc
+import os
+import random
+import string
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import harness  # noqa: E402
+
+main = harness.import_main()
+
+MESSAGES = 20000
+TLDS = ["com", "net", "org", "xyz", "ru", "jp", "co.jp", "io"]
+# (メッセージ, 判定されるべき禁止文字列) の確認用（{0} は禁止ドメインの1件目）
+CASES = [
+    ("join {0} now", "{0}"),
+    ("https://cdn.assets.{0}/free-nitro", "{0}"),
+    ("notevil{0}.example", None),
+    ("{0}munity is not the same site", None),
+    ("discord.gg/raid", "discord.gg/raid"),
+    ("https://discord.com/invite/RAID", "discord.gg/raid"),
+    ("discord.gg/raidxyz", None),
+    ("d i s c o r d . g g/raid", "discord.gg/raid"),
+    ("**disc**ord[.]gg/raid", "discord.gg/raid"),
+]
+
+
+def make_domains(count, seed=0):
+    rng = random.Random(seed)
+    domains = set()
+    while len(domains) < count:
+        label = "".join(rng.choices(string.ascii_lowercase + string.digits, k=rng.randint(5, 14)))
+        domains.add(f"{label}.{rng.choice(TLDS)}")
+    return sorted(domains)
+
+
+def make_messages(rng, domains, with_links):
+    words = ["こんにちは", "今日は", "ゲーム", "hello", "gg", "nice", "見て"]
+    messages = []
+    for i in range(MESSAGES):
+        text = " ".join(rng.choices(words, k=12))
+        if with_links:
+            # 半分は禁止ドメインのサブドメイン、残りは登録されていないドメイン
+            host = f"www.{rng.choice(domains)}" if i % 2 else f"safe{i}.example.com"
+            text += f" https://{host}/path?q={i}"
+        messages.append(text)
+    return messages
+
+
+def measure(build):
+    """作成時間（計測の影響を避けるため tracemalloc なしで作成）と、作り直したときのメモリ（バイト）"""
+    gc.collect()
+    start = time.perf_counter()
+    result = build()
+    elapsed = time.perf_counter() - start
+    del result
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, elapsed, size
+
+
+def per_message_us(matcher, messages):
+    start = time.perf_counter()
+    for message in messages:
+        matcher.search(message)
+    return (time.perf_counter() - start) / len(messages) * 1e6
+
+
+def check_cases(domains):
+    patterns = domains + ["discord.gg/raid"]
+    links = main.LinkMatcher(patterns)
+    substring = main.TextMatcher(patterns, main.normalize_text)
+    print(f"{'message':<40} {'link':>6} {'substring':>10}")
+    for message, expected in CASES:
+        message = message.format(domains[0])
+        expected = expected.format(domains[0]) if expected else None
+        link_hit = links.search(message)
+        assert link_hit == expected, (message, link_hit)
+        substring_hit = substring.search(message)
+        print(f"{message:<40} {'o' if link_hit else '-':>6} {'o' if substring_hit else '-':>10}")
+
+
+def main_bench(args):
+    all_domains = make_domains(args.domains)
+    rng = random.Random(1)
+    check_cases(all_domains)
+    print()
+    print(f"{'domains':>8} {'matcher':>10} {'build(ms)':>10} {'MiB':>6} {'no link(us)':>12} {'link(us)':>9}")
+    sizes = sorted({min(args.domains, size) for size in (1000, 10000, args.domains)})
+    for count in sizes:
+        domains = all_domains[:count]
+        plain = make_messages(rng, domains, False)
+        linked = make_messages(rng, domains, True)
+        candidates = [("link", lambda: main.LinkMatcher(domains))]
+        if count <= args.substring_max:
+            candidates.append(("substring", lambda: main.TextMatcher(domains, main.normalize_text)))
+        for name, build in candidates:
+            matcher, build_s, size = measure(build)
+            print(
+                f"{count:>8} {name:>10} {build_s * 1000:>10.0f} {size / 1024 / 1024:>6.1f} "
+                f"{per_message_us(matcher, plain):>12.2f} {per_message_us(matcher, linked):>9.2f}"
+            )
+            del matcher
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--domains", type=int, default=100_000, help="禁止ドメインの件数")
+    parser.add_argument(
+        "--substring-max", type=int, default=100_000, help="部分一致の TextMatcher も測る最大件数（作成に時間がかかるため）"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main_bench(parse_args())
@@ -0,0 +1,155 @@
+"""正規表現・ワイルドカード・単語のルールのベンチマーク
+
+1. 追加時の検査: よくあるパターンと、バックトラックで極端に遅くなるパターンが
+   受け付けられるか/断られるかと、検査にかかった時間を表示する。
+2. 判定時間: ルールの件数ごとに、RuleMatcher（必ず含まれる文字列で絞り込む）と、
+   すべてのルールを1つにまとめた正規表現、ルールごとの正規表現を順に試す方法とで、
+   メッセージ1件あたりの時間を比べる。
+   あわせて、検査用の文字列（4000文字）での最悪の時間も測る。
+
+使い方（リポジトリのルートで実行）:
+    py benchmarks/bench_rule_matcher.py [--rules 1000]
+"""
+import argparse
+import asyncio
+import os
+import random
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import harness  # noqa: E402
+
+main = harness.import_main()
+
+MESSAGES = 2000
+# (ルール, 断られるべきか)
+CHECK_CASES = [
+    (r"regex:fr[e3]{2}\s*n[i1]tro", False),
+    (r"regex:free.*nitro", False),
+    (r"regex:(?i)discord\.gg/\w+", False),
+    ("glob:*nitro*", False),
+    ("glob:discord.gg/*", False),
+    ("word:raid", False),
+    ("word:荒らし", False),
+    (r"regex:ｆｒｅｅ\s*ｎｉｔｒｏ", False),
+    ("regex:[ﬁ]le", True),
+    (r"regex:(a+)+$", True),
+    (r"regex:(\w+)\s\1", True),
+    (r"regex:(a|aa)*b", True),
+    (r"regex:.*a.*b", True),
+    (r"regex:x.*y", True),
+    ("regex:a*", True),
+    ("glob:*", True),
+]
+
+
+def random_word(rng):
+    return "".join(rng.choices(string.ascii_lowercase, k=rng.randint(4, 9)))
+
+
+def make_rules(rng, count):
+    rules = []
+    for i in range(count):
+        kind = i % 3
+        if kind == 0:
+            rules.append(f"word:{random_word(rng)}")
+        elif kind == 1:
+            rules.append(f"glob:*{random_word(rng)}*")
+        else:
+            rules.append(rf"regex:{random_word(rng)}\s*{random_word(rng)}")
+    return rules
+
+
+def make_messages(rng):
+    words = ["こんにちは", "今日は", "ゲーム", "hello", "gg", "nice", "見て", "everyone", "https://example.com/a"]
+    return [" ".join(rng.choices(words, k=rng.randint(3, 20))) for _ in range(MESSAGES)]
+
+
+class CombinedMatcher:
+    """すべてのルールを1つの正規表現にまとめる（比較用）"""
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        sources = [f"(?P<r{i}>{main.rule_source(p)})" for i, p in enumerate(self.patterns)]
+        self.regex = main.regex_engine.compile("(?i)" + "|".join(sources))
+
+    def search(self, text):
+        match = self.regex.search(main.fold_spaced_text(text))
+        if match is None:
+            return None
+        return self.patterns[int(match.lastgroup[1:])]
+
+
+class LoopMatcher:
+    """ルールごとの正規表現を順に試す（比較用）"""
+
+    def __init__(self, patterns):
+        self.patterns = [(p, main.regex_engine.compile(f"(?i)(?:{main.rule_source(p)})")) for p in patterns]
+
+    def search(self, text):
+        text = main.fold_spaced_text(text)
+        for pattern, regex in self.patterns:
+            if regex.search(text):
+                return pattern
+        return None
+
+
+def per_message_us(matcher, messages):
+    start = time.perf_counter()
+    for message in messages:
+        matcher.search(message)
+    return (time.perf_counter() - start) / len(messages) * 1e6
+
+
+def worst_case_ms(matcher, inputs):
+    worst = 0.0
+    for text in inputs:
+        start = time.perf_counter()
+        matcher.search(text)
+        worst = max(worst, time.perf_counter() - start)
+    return worst * 1000
+
+
+async def bench_checks():
+    print(f"engine: {main.regex_engine.__name__}, budget {main.rule_time_budget_ms}ms/message")
+    print(f"{'rule':<28} {'result':>8} {'check(s)':>9}  reason")
+    for rule, should_reject in CHECK_CASES:
+        start = time.perf_counter()
+        error = await main.check_rule(rule)
+        elapsed = time.perf_counter() - start
+        assert (error is not None) == should_reject, (rule, error)
+        print(f"{rule:<28} {'reject' if error else 'accept':>8} {elapsed:>9.2f}  {error or ''}")
+
+
+def bench_matching(args):
+    rng = random.Random(0)
+    messages = make_messages(rng)
+    print(f"{'rules':>6} {'matcher':>10} {'build(ms)':>10} {'per msg(us)':>12} {'worst(ms)':>10}")
+    for count in sorted({min(args.rules, n) for n in (10, 100, args.rules)}):
+        rules = make_rules(rng, count)
+        # 検査用の文字列は、正規表現のルール（3件ごと）の文字を含むもの
+        inputs = main.rule_stress_inputs(main.rule_source(rules[2 % count]))
+        for name, cls in (("prefilter", main.RuleMatcher), ("combined", CombinedMatcher), ("loop", LoopMatcher)):
+            start = time.perf_counter()
+            matcher = cls(rules)
+            build_ms = (time.perf_counter() - start) * 1000
+            print(
+                f"{count:>6} {name:>10} {build_ms:>10.1f} {per_message_us(matcher, messages):>12.1f} "
+                f"{worst_case_ms(matcher, inputs):>10.1f}"
+            )
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rules", type=int, default=1000, help="判定時間を測るルールの最大件数")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    asyncio.run(bench_checks())
+    print()
+    bench_matching(args)
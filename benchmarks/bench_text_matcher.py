@@ -0,0 +1,100 @@
+"""禁止文字列マッチングのベンチマーク（従来のループ vs Aho-Corasick）
+
+使い方（リポジトリのルートで実行）:
+    py benchmarks/bench_text_matcher.py
+"""
+import os
+import random
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import harness  # noqa: E402
+
+main = harness.import_main()
+TextMatcher = main.TextMatcher
+
+PATTERN_COUNTS = [10, 1000, 50000]
+MESSAGE_COUNT = 2000
+# 区切りや [.] で崩したリンク（禁止文字列, メッセージ）。リンクの禁止文字列は LinkMatcher で判定する
+OBFUSCATED_LINKS = [
+    ("discord.gg/abc", "d i s c o r d . g g/abc"),
+    ("evil.com", "e v i l . c o m"),
+    ("evil.com", "evil[.]com"),
+]
+
+
+def make_patterns(count, rng):
+    """フィッシングドメインや招待リンク断片に似た禁止文字列を生成"""
+    patterns = []
+    for i in range(count):
+        token = "".join(rng.choice(string.ascii_lowercase + string.digits) for _ in range(8))
+        if i % 2:
+            patterns.append(f"discord.gg/{token}")
+        else:
+            patterns.append(f"{token}-nitro.com")
+    return patterns
+
+
+def make_messages(patterns, rng):
+    """通常の会話文に一部だけ禁止文字列を混ぜたメッセージを生成"""
+    words = ["こんにちは", "hello", "今日は", "raid", "gg", "test", "ok", "nice", "見て", "link"]
+    messages = []
+    for i in range(MESSAGE_COUNT):
+        text = " ".join(rng.choice(words) for _ in range(20))
+        if i % 20 == 0:
+            text += " https://" + rng.choice(patterns)
+        messages.append(text)
+    return messages
+
+
+def naive_search(patterns, message_content):
+    """従来の check_text_in_message と同じ処理"""
+    message_lower = message_content.lower()
+    for text in patterns:
+        if text.lower() in message_lower:
+            return text
+    return None
+
+
+def bench(func, messages):
+    start = time.perf_counter()
+    for message in messages:
+        func(message)
+    return (time.perf_counter() - start) / len(messages)
+
+
+def check_obfuscated_links():
+    """BOT と同じ振り分けで作ったマッチャーが、崩したリンクを検知することを確認"""
+    text_matcher, link_matcher, _ = main.BanList._build_matchers([pattern for pattern, _ in OBFUSCATED_LINKS])
+    for pattern, message in OBFUSCATED_LINKS:
+        detected = text_matcher.search(message) or link_matcher.search(message)
+        assert detected == pattern, (message, detected)
+    assert link_matcher.search("notevil.com.example") is None
+
+
+def main_bench():
+    check_obfuscated_links()
+    rng = random.Random(0)
+    print(f"{'patterns':>9} {'build(ms)':>10} {'loop(us/msg)':>13} {'aho(us/msg)':>12} {'speedup':>8}")
+    for count in PATTERN_COUNTS:
+        patterns = make_patterns(count, rng)
+        messages = make_messages(patterns, rng)
+
+        start = time.perf_counter()
+        matcher = TextMatcher(patterns)
+        build_ms = (time.perf_counter() - start) * 1000
+
+        # 結果が一致することを確認
+        for message in messages[:200]:
+            assert matcher.search(message) == naive_search(patterns, message)
+
+        loop_us = bench(lambda m: naive_search(patterns, m), messages) * 1e6
+        aho_us = bench(matcher.search, messages) * 1e6
+        print(f"{count:>9} {build_ms:>10.1f} {loop_us:>13.1f} {aho_us:>12.1f} {loop_us / aho_us:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main_bench()
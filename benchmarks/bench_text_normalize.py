@@ -0,0 +1,103 @@
+"""禁止文字列の判定前の正規化のベンチマーク
+
+正規化の段階（none / nfkc / full）ごとに、よくある回避手口をどれだけ検知できるかと、
+メッセージの長さに対する1文字あたりの処理時間（長さに比例するか）を測る。
+
+使い方（リポジトリのルートで実行）:
+    py benchmarks/bench_text_normalize.py
+"""
+import os
+import random
+import sys
+import time
+from functools import lru_cache
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import harness  # noqa: E402
+
+main = harness.import_main()
+
+LEVELS = ["none", "nfkc", "full"]
+LENGTHS = [100, 1000, 4000]
+ITERATIONS = 2000
+PATTERNS = ["discord.gg/raid", "free nitro", "荒らし共栄圏"]
+# (手口, メッセージ)
+EVASIONS = [
+    ("そのまま", "join discord.gg/raid now"),
+    ("大文字", "JOIN DISCORD.GG/RAID"),
+    ("全角", "ｄｉｓｃｏｒｄ．ｇｇ／ｒａｉｄ"),
+    ("半角カナ・全角混在", "ﾌﾘｰ free　ｎｉｔｒｏ"),
+    ("ゼロ幅文字", "disc​ord.g‍g/ra⁠id"),
+    ("キリル文字", "dіscоrd.gg/rаid"),
+    ("装飾文字", "𝐟𝐫𝐞𝐞 𝐧𝐢𝐭𝐫𝐨"),
+    ("丸囲み文字", "ⓓⓘⓢⓒⓞⓡⓓ.ⓖⓖ/ⓡⓐⓘⓓ"),
+    ("打ち消し線", "f̶r̶e̶e̶ n̶i̶t̶r̶o̶"),
+    ("空白区切り", "d i s c o r d . g g / r a i d"),
+    ("Markdown", "**disc**||ord||.gg/`raid`"),
+    ("日本語の区切り", "荒・ら・し・共・栄・圏"),
+]
+
+
+# 文章の種類 → 単語（fullwidth は NFKC で変わる全角英数字・半角カナを含む）
+WORDS = {
+    "ascii": ["hello", "raid", "gg", "nice", "link"],
+    "japanese": ["こんにちは", "今日は", "ゲーム", "見て", "草"],
+    "fullwidth": ["ｗｗｗ", "ＯＫ", "１２３", "ｱﾆﾒ", "こんにちは"],
+}
+
+
+def make_message(rng, length, kind):
+    words = WORDS[kind]
+    text = ""
+    while len(text) < length:
+        text += rng.choice(words) + " "
+    return text[:length]
+
+
+def per_char_ns(fold, messages):
+    start = time.perf_counter()
+    for message in messages:
+        fold(message)
+    return (time.perf_counter() - start) / sum(len(m) for m in messages) * 1e9
+
+
+def main_bench():
+    folders = {level: main.make_text_folder(level) for level in LEVELS}
+
+    print("回避手口の検知（o: 検知 / -: 見逃し）")
+    print(f"{'':<18}" + "".join(f"{level:>6}" for level in LEVELS))
+    detected = dict.fromkeys(LEVELS, 0)
+    for name, message in EVASIONS:
+        row = f"{name:<18}"
+        for level in LEVELS:
+            matcher = main.TextMatcher(PATTERNS, lru_cache(maxsize=16)(folders[level]))
+            hit = matcher.search(message) is not None
+            detected[level] += hit
+            row += f"{'o' if hit else '-':>6}"
+        print(row)
+    print(f"{'合計':<18}" + "".join(f"{detected[level]:>4}/{len(EVASIONS)}" for level in LEVELS))
+
+    print()
+    print("1文字あたりの処理時間（ns、キャッシュなし）")
+    rng = random.Random(0)
+    print(f"{'length':>7} {'text':>10}" + "".join(f"{level:>7}" for level in LEVELS))
+    for length in LENGTHS:
+        for kind in WORDS:
+            messages = [make_message(rng, length, kind) + str(i) for i in range(ITERATIONS * 100 // length)]
+            row = f"{length:>7} {kind:>10}"
+            for level in LEVELS:
+                row += f"{per_char_ns(folders[level], messages):>7.1f}"
+            print(row)
+
+    # 同じメッセージを複数の検知処理で使う場合（2回目以降はキャッシュから返る）
+    message = make_message(rng, 1000, "japanese")
+    main.normalize_text(message)
+    start = time.perf_counter()
+    for _ in range(ITERATIONS):
+        main.normalize_text(message)
+    print(f"\nキャッシュ済みの取得: {(time.perf_counter() - start) / ITERATIONS * 1e9:.0f}ns/回（1000文字）")
+
+
+if __name__ == "__main__":
+    main_bench()
@@ -0,0 +1,86 @@
+"""ユーザーIDの集合の表現のベンチマーク（str の dict vs int の set vs UserIdSet）
+
+100万件あたりのメモリ使用量（tracemalloc で計測）と、リストにある/ないIDの
+1回あたりの判定時間を測る。UserIdSet は Bloom フィルターなし/ありの両方を測る。
+
+使い方（リポジトリのルートで実行）:
+    py benchmarks/bench_user_id_set.py [--ids 1000000]
+"""
+import argparse
+import gc
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import harness  # noqa: E402
+
+main = harness.import_main()
+
+LOOKUPS = 200000
+
+
+def make_ids(count, seed):
+    rng = random.Random(seed)
+    return [str(rng.randrange(10**17, 2**62)) for _ in range(count)]
+
+
+def measure_memory(build):
+    """build() が作るオブジェクトが確保したメモリ（バイト）"""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, after - before
+
+
+def per_lookup_ns(container, probes):
+    start = time.perf_counter()
+    for probe in probes:
+        probe in container  # noqa: B015
+    return (time.perf_counter() - start) / len(probes) * 1e9
+
+
+def main_bench(args):
+    ids = make_ids(args.ids, 0)
+    int_ids = [int(user_id) for user_id in ids]
+    rng = random.Random(1)
+    hit_probes = [rng.choice(int_ids) for _ in range(LOOKUPS)]
+    miss_probes = [int(user_id) for user_id in make_ids(LOOKUPS, 2)]
+
+    candidates = [
+        # これまでの BanList.user_ids と同じ（文字列キーの dict、判定時に str() する）
+        # キーのオブジェクト自体も計測に含めるため、その場で作り直す
+        ("dict[str]", lambda: dict.fromkeys(str(user_id) for user_id in int_ids), str),
+        ("set[int]", lambda: {int(user_id) for user_id in ids}, None),
+        ("UserIdSet", lambda: main.UserIdSet(ids), None),
+        (f"UserIdSet+bloom{args.bloom_bits}", lambda: main.UserIdSet(ids, bloom_bits_per_id=args.bloom_bits), None),
+    ]
+    scale = 1_000_000 / args.ids
+    print(f"{args.ids:,} user IDs")
+    print(f"{'structure':>20} {'MiB/1M ids':>11} {'hit(ns)':>8} {'miss(ns)':>9} {'miss lookups/s':>15}")
+    for name, build, convert in candidates:
+        container, size = measure_memory(build)
+        hits = [convert(probe) for probe in hit_probes] if convert else hit_probes
+        misses = [convert(probe) for probe in miss_probes] if convert else miss_probes
+        assert all(probe in container for probe in hits[:1000])
+        hit_ns = per_lookup_ns(container, hits)
+        miss_ns = per_lookup_ns(container, misses)
+        print(f"{name:>20} {size * scale / 1024 / 1024:>11.1f} {hit_ns:>8.0f} {miss_ns:>9.0f} {1e9 / miss_ns:>15,.0f}")
+        del container, hits, misses
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--ids", type=int, default=1_000_000, help="ユーザーIDの件数")
+    parser.add_argument("--bloom-bits", type=int, default=10, help="Bloom フィルターの1件あたりのビット数")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    main_bench(parse_args())
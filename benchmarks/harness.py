@@ -0,0 +1,211 @@
+"""ベンチマーク用の共通処理（main.py の読み込みと Discord オブジェクトの代用品）
+
+main.py は読み込み時にカレントディレクトリの config.json と ban_list.json を
+使うため、一時ディレクトリに移動してから読み込む。ネットワークやトークンは不要。
+"""
+import asyncio
+import importlib
+import json
+import os
+import sys
+import tempfile
+import time
+from collections import Counter
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+
+
+def import_main(config=None):
+    """一時ディレクトリで main.py を読み込む（リポジトリ内にファイルを作らない）"""
+    if "main" in sys.modules:
+        return sys.modules["main"]
+    work_dir = tempfile.mkdtemp(prefix="antiraid-bench-")
+    with open(os.path.join(work_dir, "config.json"), "w", encoding="utf-8") as f:
+        # ログは一時ディレクトリのファイルにだけ書き出す（コンソールには出さない）
+        json.dump({"token": "", "log_console": False, **(config or {})}, f)
+    os.chdir(work_dir)
+    sys.path.insert(0, ROOT)
+    return importlib.import_module("main")
+
+
+class VirtualClock:
+    """time.monotonic の代わりに使う仮想時計（記録されたイベント時刻で進める）"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def __getattr__(self, name):
+        # monotonic 以外は本物の time モジュールに任せる
+        return getattr(time, name)
+
+
+class FakeRest:
+    """Discord の REST API の代用品（呼び出し回数を記録し、指定した遅延だけ待つ）"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = Counter()
+
+    async def request(self, route):
+        self.calls[route] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        else:
+            await asyncio.sleep(0)
+
+
+class FakePermissions:
+    def __init__(self, administrator=False):
+        self.administrator = administrator
+
+
+class FakeUser:
+    def __init__(self, user_id, name, bot=False):
+        self.id = user_id
+        self.name = name
+        self.bot = bot
+        self.mention = f"<@{user_id}>"
+
+
+class FakeMember(FakeUser):
+    def __init__(self, guild, user_id, name, created_at, avatar=True, roles=(), administrator=False):
+        super().__init__(user_id, name)
+        self.guild = guild
+        self.created_at = created_at
+        self.avatar = "avatar" if avatar else None
+        self.roles = list(roles)
+        self.guild_permissions = FakePermissions(administrator)
+
+    def get_role(self, role_id):
+        for role in self.roles:
+            if role.id == role_id:
+                return role
+        return None
+
+    async def kick(self, reason=None):
+        await self.guild.rest.request("kick")
+        self.guild.remove_member(self.id)
+
+    async def timeout(self, until, reason=None):
+        await self.guild.rest.request("timeout")
+
+    async def add_roles(self, *roles, reason=None):
+        await self.guild.rest.request("add_roles")
+
+
+class FakeMessage:
+    state = None
+
+    def __init__(self, message_id, guild, channel, author, content, mentions=()):
+        self.id = message_id
+        self.guild = guild
+        self.channel = channel
+        self.author = author
+        self.content = content
+        self.mentions = list(mentions)
+        self.role_mentions = []
+        self.mention_everyone = False
+        self.attachments = []
+        self.embeds = []
+        # commands.Context が参照する接続状態（install_guilds で設定）
+        self._state = FakeMessage.state
+
+    async def delete(self):
+        await self.guild.rest.request("delete_message")
+
+
+class FakePartialMessage:
+    def __init__(self, channel, message_id):
+        self.channel = channel
+        self.id = message_id
+
+    async def delete(self):
+        await self.channel.guild.rest.request("delete_message")
+
+
+class FakeChannel:
+    def __init__(self, guild, channel_id, name):
+        self.guild = guild
+        self.id = channel_id
+        self.name = name
+        self.mention = f"<#{channel_id}>"
+        self.sent = 0
+
+    async def send(self, content=None, **kwargs):
+        await self.guild.rest.request("send_message")
+        self.sent += 1
+
+    def get_partial_message(self, message_id):
+        return FakePartialMessage(self, message_id)
+
+
+class FakeGuild:
+    def __init__(self, guild_id, name, rest, channel_count=20):
+        self.id = guild_id
+        self.name = name
+        self.rest = rest
+        self._members = {}
+        self.channels = {guild_id + i: FakeChannel(self, guild_id + i, f"ch{i}") for i in range(1, channel_count + 1)}
+        self.roles = {}
+        # BOT 自身のメンバー（None のときは権限を確認せずに一括バンを試す）
+        self.me = None
+
+    @property
+    def members(self):
+        return list(self._members.values())
+
+    @property
+    def member_count(self):
+        return len(self._members)
+
+    def add_member(self, member):
+        self._members[member.id] = member
+
+    def remove_member(self, user_id):
+        self._members.pop(user_id, None)
+
+    def get_member(self, user_id):
+        return self._members.get(user_id)
+
+    def get_channel(self, channel_id):
+        return self.channels.get(channel_id)
+
+    def get_channel_or_thread(self, channel_id):
+        return self.channels.get(channel_id)
+
+    def get_role(self, role_id):
+        return self.roles.get(role_id)
+
+    async def ban(self, user, reason=None, delete_message_seconds=0):
+        await self.rest.request("ban")
+        self.remove_member(user.id)
+
+    async def unban(self, user, reason=None):
+        await self.rest.request("unban")
+
+    async def bulk_ban(self, users, reason=None, delete_message_seconds=0):
+        await self.rest.request("bulk_ban")
+        users = list(users)
+        for user in users:
+            self.remove_member(user.id)
+        return SimpleNamespace(banned=users, failed=[])
+
+    async def fetch_members(self, limit=None):
+        for member in list(self._members.values()):
+            yield member
+
+
+def install_guilds(main, guilds):
+    """BOT のキャッシュに代用品のサーバーを登録する"""
+    state = main.bot._connection
+    state._guilds.clear()
+    for guild in guilds:
+        state._guilds[guild.id] = guild
+    if state.user is None:
+        state.user = FakeUser(1, "AntiRaidBot", bot=True)
+    FakeMessage.state = state
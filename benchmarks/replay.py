@@ -0,0 +1,426 @@
+"""on_message / on_raw_message_edit / on_member_join / periodic_check のリプレイベンチマーク
+
+合成（または記録済み）のイベント列を代用品の Discord オブジェクトに流し、
+イベント数/秒、ハンドラーの処理時間（p50/p99）、メモリ割り当て量を測定する。
+ネットワークやトークンは不要。結果は JSON で保存し、前回の結果と比較できる。
+
+使い方（リポジトリのルートで実行）:
+    py benchmarks/replay.py
+    py benchmarks/replay.py --scenarios chatter,link_raid --scale 0.5
+    py benchmarks/replay.py --events recorded.jsonl
+    py benchmarks/replay.py --compare benchmarks/results/replay-20250101-000000.json
+
+記録済みイベントは1行1件の JSON で、次の形式に対応する:
+    {"type": "message", "at": 1.5, "channel": 100001, "author": 500, "content": "...", "mentions": 0, "id": 42}
+    {"type": "edit", "at": 1.8, "id": 42, "content": "..."}
+    {"type": "join", "at": 2.0, "user": 501, "name": "raider1", "account_age_days": 0, "avatar": false}
+    {"type": "tick", "at": 5.0}
+edit の id は編集するメッセージの id（content を省くと内容の変わらない編集）。
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import random
+import string
+import subprocess
+import sys
+import time
+import tracemalloc
+from collections import defaultdict
+from datetime import timedelta
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import harness  # noqa: E402
+
+main = harness.import_main()
+
+GUILD_ID = 100000
+DRAIN_TIMEOUT = 30.0
+
+
+class Scenario:
+    """リプレイするシナリオ（サーバーの初期状態とイベント列）"""
+
+    def __init__(self, name, members=2000, texts=(), user_ids=(), events=()):
+        self.name = name
+        self.members = members
+        self.texts = list(texts)
+        self.user_ids = list(user_ids)
+        self.events = list(events)
+
+
+def make_vocabulary(rng, size=3000):
+    return ["".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(2, 9))) for _ in range(size)]
+
+
+def make_banned_texts(rng, count):
+    return [f"{''.join(rng.choice(string.ascii_lowercase) for _ in range(8))}-nitro.com" for _ in range(count)]
+
+
+def chatter_events(rng, vocabulary, count, duration, members, start=0.0):
+    """通常の会話（1人あたりの発言は少なめ）"""
+    events = []
+    for i in range(count):
+        events.append({
+            "type": "message",
+            "at": start + duration * i / count,
+            "channel": GUILD_ID + 1 + rng.randrange(20),
+            "author": 10_000 + rng.randrange(members),
+            "content": " ".join(rng.choice(vocabulary) for _ in range(rng.randint(3, 25))),
+        })
+    return events
+
+
+def build_chatter(rng, scale):
+    vocabulary = make_vocabulary(rng)
+    count = int(20000 * scale)
+    return Scenario(
+        "chatter",
+        members=2000,
+        texts=make_banned_texts(rng, 1000),
+        events=chatter_events(rng, vocabulary, count, duration=count / 10, members=2000),
+    )
+
+
+def build_link_raid(rng, scale):
+    vocabulary = make_vocabulary(rng)
+    texts = make_banned_texts(rng, 1000)
+    raiders = int(300 * scale)
+    events = chatter_events(rng, vocabulary, int(5000 * scale), duration=60, members=2000)
+    for i in range(raiders):
+        user_id = 900_000 + i
+        joined_at = 10 + 30 * i / raiders
+        events.append({
+            "type": "join", "at": joined_at, "user": user_id,
+            "name": f"nitro_gift{i}", "account_age_days": 0, "avatar": False,
+        })
+        for j in range(3):
+            events.append({
+                "type": "message", "at": joined_at + 1 + j,
+                "channel": GUILD_ID + 1 + rng.randrange(20), "author": user_id,
+                "content": f"free nitro here https://{rng.choice(texts)}/claim @everyone",
+            })
+    events.sort(key=lambda event: event["at"])
+    return Scenario("link_raid", members=2000, texts=texts, events=events)
+
+
+def build_join_flood(rng, scale):
+    joins = int(5000 * scale)
+    events = [{
+        "type": "join", "at": 50 * i / joins, "user": 2_000_000 + i,
+        "name": f"user{rng.randrange(10**6)}", "account_age_days": rng.choice([0, 1, 400]),
+        "avatar": rng.random() < 0.3,
+    } for i in range(joins)]
+    return Scenario("join_flood", members=2000, events=events)
+
+
+def build_periodic(rng, scale):
+    members = int(100_000 * scale)
+    listed = [10_000 + rng.randrange(members) for _ in range(500)]
+    listed += [50_000_000 + i for i in range(500)]
+    ticks = members // main.ReconcileState.MEMBERS_PER_TICK + 3
+    events = [{"type": "tick", "at": 5.0 * i} for i in range(ticks)]
+    return Scenario("periodic", members=members, user_ids=listed, events=events)
+
+
+def build_edit_spam(rng, scale):
+    """編集の多い会話（埋め込みの展開・ピン留め、同じ内容の連投、あとから禁止リンクを書き足す編集）"""
+    vocabulary = make_vocabulary(rng)
+    texts = make_banned_texts(rng, 1000)
+    count = int(10000 * scale)
+    events = chatter_events(rng, vocabulary, count, duration=count / 10, members=2000)
+    copypasta = [" ".join(rng.choice(vocabulary) for _ in range(15)) for _ in range(5)]
+    for i, event in enumerate(events):
+        event["id"] = 1_000_000 + i
+        if rng.random() < 0.3:
+            # 荒らしではない同じ内容の連投（コピペ・定型文）
+            event["content"] = rng.choice(copypasta)
+    edits = []
+    for event in events:
+        roll = rng.random()
+        if roll < 0.5:
+            # リンクの埋め込みの展開やピン留め（内容は変わらない）
+            edits.append({"type": "edit", "at": event["at"] + 0.5, "id": event["id"]})
+        elif roll < 0.6:
+            edits.append({
+                "type": "edit", "at": event["at"] + 2, "id": event["id"],
+                "content": event["content"] + " " + rng.choice(vocabulary),
+            })
+        elif roll < 0.62:
+            edits.append({
+                "type": "edit", "at": event["at"] + 5, "id": event["id"],
+                "content": event["content"] + f" https://{rng.choice(texts)}/claim",
+            })
+    events += edits
+    events.sort(key=lambda event: event["at"])
+    return Scenario("edit_spam", members=2000, texts=texts, events=events)
+
+
+SCENARIOS = {
+    "chatter": build_chatter,
+    "link_raid": build_link_raid,
+    "join_flood": build_join_flood,
+    "periodic": build_periodic,
+    "edit_spam": build_edit_spam,
+}
+
+
+def load_recorded(path):
+    with open(path, "r", encoding="utf-8") as f:
+        events = [json.loads(line) for line in f if line.strip()]
+    members = {event["author"] for event in events if event.get("type") == "message"}
+    return Scenario(os.path.splitext(os.path.basename(path))[0], members=0, events=events), members
+
+
+async def reset_state():
+    """シナリオ間で main.py の状態を初期化する"""
+    # 前のシナリオの書き込みが残っていると一時ファイルが競合する
+    await main.ban_list.flush()
+    for queue in main.punishment_queues.values():
+        for worker in queue.workers:
+            worker.cancel()
+    main.punishment_queues.clear()
+    for task in main.log_sink.tasks.values():
+        task.cancel()
+    main.log_sink = main.LogSink()
+    main.join_states.clear()
+    main.flood_detector = main.FloodDetector()
+    main.duplicate_detector = main.DuplicateDetector()
+    main.processed_users.clear()
+    main.exempt_cache.reset()
+    main.guild_rules.clear()
+    main.reconcile_state = main.ReconcileState()
+    main.member_index = main.MemberIndex()
+    main.federation = main.Federation()
+    main.content_cache = main.ContentVerdictCache(main.content_cache_max_entries)
+    for path in (main.BAN_LIST_FILE, main.BAN_LIST_JOURNAL_FILE):
+        if os.path.exists(path):
+            os.remove(path)
+    main.ban_list = main.BanList(main.BAN_LIST_FILE, main.BAN_LIST_JOURNAL_FILE)
+
+
+def setup_guild(scenario, rest, extra_members=()):
+    guild = harness.FakeGuild(GUILD_ID, "bench", rest)
+    created_at = main.discord.utils.utcnow() - timedelta(days=365)
+    for user_id in list(range(10_000, 10_000 + scenario.members)) + list(extra_members):
+        guild.add_member(harness.FakeMember(guild, user_id, f"member{user_id}", created_at))
+    harness.install_guilds(main, [guild])
+    for member in guild.members:
+        main.member_index.add(guild.id, member.id)
+    main.guild_configs.set(GUILD_ID, "log_channel_id", GUILD_ID + 1)
+    return guild
+
+
+def make_member(guild, event):
+    created_at = main.discord.utils.utcnow() - timedelta(days=event.get("account_age_days", 365))
+    member = harness.FakeMember(guild, event["user"], event.get("name", f"user{event['user']}"), created_at, avatar=event.get("avatar", True))
+    guild.add_member(member)
+    main.member_index.add(guild.id, member.id)
+    return member
+
+
+def make_message(guild, event, message_id):
+    author = guild.get_member(event["author"])
+    if author is None:
+        author = make_member(guild, {"user": event["author"]})
+    channel = guild.get_channel(event.get("channel", GUILD_ID + 1)) or guild.get_channel(GUILD_ID + 1)
+    mentions = [harness.FakeUser(10_000 + i, f"member{10_000 + i}") for i in range(event.get("mentions", 0))]
+    return harness.FakeMessage(event.get("id", message_id), guild, channel, author, event["content"], mentions)
+
+
+def make_edited_message(original, event):
+    """編集後のメッセージ（RawMessageUpdateEvent.message と同じく、新しいオブジェクト）"""
+    return harness.FakeMessage(
+        original.id, original.guild, original.channel, original.author,
+        event.get("content", original.content), original.mentions,
+    )
+
+
+async def drain():
+    """キューとログ送信が終わるまで待つ"""
+    queues = [queue.queue.join() for queue in main.punishment_queues.values()]
+    with contextlib.suppress(asyncio.TimeoutError):
+        await asyncio.wait_for(asyncio.gather(*queues), DRAIN_TIMEOUT)
+    tasks = list(main.log_sink.tasks.values())
+    if tasks:
+        await asyncio.wait(tasks, timeout=DRAIN_TIMEOUT)
+
+
+async def replay(scenario, extra_members=()):
+    """1回分のリプレイを実行し、イベント種別ごとの処理時間を返す"""
+    await reset_state()
+    rest = harness.FakeRest()
+    guild = setup_guild(scenario, rest, extra_members)
+    for text in scenario.texts:
+        main.ban_list.add_text(text)
+    for user_id in scenario.user_ids:
+        main.ban_list.add_user(user_id)
+    main.ban_list.pop_added_users()
+
+    clock = harness.VirtualClock()
+    real_time = main.time
+    main.time = clock
+    latencies = defaultdict(list)
+    # 編集イベントのための id → 最新のメッセージ
+    messages = {}
+    started = time.perf_counter()
+    try:
+        for index, event in enumerate(scenario.events):
+            clock.now = 1000.0 + event.get("at", 0.0)
+            kind = event["type"]
+            if kind == "message":
+                message = make_message(guild, event, 1_000_000 + index)
+                messages[message.id] = message
+                t0 = time.perf_counter()
+                await main.on_message(message)
+            elif kind == "edit":
+                original = messages.get(event["id"])
+                if original is None:
+                    continue
+                message = messages[original.id] = make_edited_message(original, event)
+                t0 = time.perf_counter()
+                await main.on_raw_message_edit(SimpleNamespace(message=message))
+            elif kind == "join":
+                member = make_member(guild, event)
+                t0 = time.perf_counter()
+                await main.on_member_join(member)
+            elif kind == "tick":
+                t0 = time.perf_counter()
+                await main.periodic_check.coro()
+            else:
+                continue
+            latencies[kind].append(time.perf_counter() - t0)
+        replay_seconds = time.perf_counter() - started
+        await drain()
+    finally:
+        main.time = real_time
+    total_seconds = time.perf_counter() - started
+    return latencies, replay_seconds, total_seconds, rest
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+async def run_scenario(scenario, extra_members=(), trace_alloc=True):
+    latencies, replay_seconds, total_seconds, rest = await replay(scenario, extra_members)
+    event_count = sum(len(values) for values in latencies.values())
+    handler_seconds = sum(sum(values) for values in latencies.values())
+    result = {
+        "events": event_count,
+        "replay_seconds": round(replay_seconds, 4),
+        "total_seconds_with_drain": round(total_seconds, 4),
+        "events_per_second": round(event_count / handler_seconds, 1) if handler_seconds else 0.0,
+        "handlers": {
+            kind: {
+                "count": len(values),
+                "p50_us": round(percentile(values, 0.50) * 1e6, 1),
+                "p99_us": round(percentile(values, 0.99) * 1e6, 1),
+                "max_us": round(max(values) * 1e6, 1),
+            }
+            for kind, values in latencies.items()
+        },
+        "rest_calls": dict(rest.calls),
+        "content_cache_hit_rate": round(main.content_cache.hit_rate, 4),
+    }
+    if trace_alloc:
+        # 時間の測定に影響しないよう、割り当て量は別の実行で測る
+        tracemalloc.start()
+        blocks_before = sys.getallocatedblocks()
+        await replay(scenario, extra_members)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result["alloc_peak_kib"] = round(peak / 1024, 1)
+        result["alloc_blocks_retained"] = sys.getallocatedblocks() - blocks_before
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=harness.ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_result(name, result):
+    print(f"\n== {name} ==  {result['events']:,} events, {result['events_per_second']:,.0f} events/sec (handler time)")
+    for kind, stats in result["handlers"].items():
+        print(f"  {kind:<8} n={stats['count']:<7,} p50={stats['p50_us']:>8.1f}us  p99={stats['p99_us']:>9.1f}us  max={stats['max_us']:>9.1f}us")
+    print(f"  REST: {result['rest_calls']}")
+    print(f"  content cache hit rate: {result['content_cache_hit_rate'] * 100:.1f}%")
+    if "alloc_peak_kib" in result:
+        print(f"  alloc peak: {result['alloc_peak_kib']:,.1f} KiB, retained blocks: {result['alloc_blocks_retained']:,}")
+
+
+def print_comparison(current, previous):
+    print(f"\n== 比較: {previous.get('commit')} → {current.get('commit')} ==")
+    for name, result in current["scenarios"].items():
+        old = previous.get("scenarios", {}).get(name)
+        if not old:
+            continue
+        print(f"  {name}: events/sec {old['events_per_second']:,.0f} → {result['events_per_second']:,.0f}"
+              f" ({(result['events_per_second'] / old['events_per_second'] - 1) * 100 if old['events_per_second'] else 0:+.1f}%)")
+        for kind, stats in result["handlers"].items():
+            old_stats = old["handlers"].get(kind)
+            if old_stats:
+                print(f"    {kind:<8} p50 {old_stats['p50_us']:.1f} → {stats['p50_us']:.1f}us, p99 {old_stats['p99_us']:.1f} → {stats['p99_us']:.1f}us")
+
+
+async def amain(args):
+    rng = random.Random(args.seed)
+    if args.no_content_cache:
+        main.content_cache_max_entries = 0
+    scenarios = []
+    if args.events:
+        scenario, members = load_recorded(args.events)
+        scenarios.append((scenario, members))
+    else:
+        for name in args.scenarios.split(","):
+            scenarios.append((SCENARIOS[name](rng, args.scale), ()))
+
+    output = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "scale": args.scale,
+        "scenarios": {},
+    }
+    for scenario, members in scenarios:
+        result = await run_scenario(scenario, members, trace_alloc=not args.no_alloc)
+        output["scenarios"][scenario.name] = result
+        print_result(scenario.name, result)
+
+    os.makedirs(harness.RESULTS_DIR, exist_ok=True)
+    path = args.output or os.path.join(harness.RESULTS_DIR, f"replay-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(output, f, ensure_ascii=False, indent=2)
+    print(f"\n結果を保存しました: {path}")
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            print_comparison(output, json.load(f))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="イベントリプレイによるハンドラーのベンチマーク")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="実行するシナリオ（カンマ区切り）")
+    parser.add_argument("--events", help="記録済みイベント（JSON Lines）をリプレイする")
+    parser.add_argument("--scale", type=float, default=1.0, help="イベント数の倍率")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-alloc", action="store_true", help="メモリ割り当ての測定を省略する")
+    parser.add_argument("--no-content-cache", action="store_true", help="内容のハッシュと判定結果を記録しない（比較用）")
+    parser.add_argument("--output", help="結果の保存先（既定: benchmarks/results/replay-<時刻>.json）")
+    parser.add_argument("--compare", help="比較する過去の結果ファイル")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(amain(parse_args()))
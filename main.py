@@ -1,14 +1,49 @@
 import discord
 from discord.ext import commands, tasks
 from discord import app_commands
+import argparse
+import atexit
+import csv
 import json
+import logging
 import os
+import queue
+import sqlite3
+import threading
 import asyncio
+import io
+import re
+import sys
+import tempfile
+import time
+import unicodedata
+from bisect import bisect_left
+from array import array
+from collections import OrderedDict, deque
 from datetime import datetime, timedelta
+from functools import lru_cache, wraps
+from itertools import chain, groupby, islice
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+import aiohttp
+from aiohttp import web
+
+if sys.version_info >= (3, 11):
+    # 3.11 以降は sre_parse が非推奨になり、同じものが re._parser にある
+    from re import _parser as sre_parse
+else:
+    import sre_parse
+
+try:
+    # 入っていれば線形時間で判定できる RE2 を使う（pip install google-re2）
+    import re2
+except ImportError:
+    re2 = None
 
 # 設定ファイル
 CONFIG_FILE = "config.json"
 BAN_LIST_FILE = "ban_list.json"
+BAN_LIST_JOURNAL_FILE = "ban_list.journal"
 
 # デフォルトのリスト構造
 DEFAULT_BAN_LIST = {
@@ -36,350 +71,4167 @@ danger_role_id = config.get("danger_role_id")
 admin_role_ids = config.get("admin_role_ids", [])
 default_punishment = config.get("default_punishment", "ban")
 timeout_duration_minutes = config.get("timeout_duration_minutes", 60)
+# メンバーチェック方式: "incremental"（変更時のみ＋キャッシュで定期照合）または "full"（従来のREST全件取得）
+sweep_mode = config.get("sweep_mode", "incremental")
+# キャッシュを使った全件照合の間隔（分）
+reconcile_interval_minutes = config.get("reconcile_interval_minutes", 60)
+# サーバーごとの処罰ワーカー数
+punishment_workers = config.get("punishment_workers", 4)
+# 全サーバー合計で同時に実行する処罰（API呼び出し）の上限（Discord 全体のレート制限は 50回/秒）
+punishment_max_concurrency = config.get("punishment_max_concurrency", 50)
+# これより長いレート制限待ちは discord.py 内で待たずにエラーとして返す（秒、最小30）
+max_ratelimit_timeout = max(30.0, float(config.get("max_ratelimit_timeout", 30.0)))
+# 一括バンにまとめるまでの待ち時間（ミリ秒）と1回あたりの最大人数（APIの上限は200）
+bulk_ban_window_ms = config.get("bulk_ban_window_ms", 500)
+bulk_ban_max_size = min(200, max(1, config.get("bulk_ban_max_size", 200)))
+# ログチャンネルへまとめて送信する間隔（ミリ秒）
+log_flush_interval_ms = config.get("log_flush_interval_ms", 1000)
+# 送信済みログの記録の上限件数と有効期限（分）
+dedup_max_entries = config.get("dedup_max_entries", 100000)
+dedup_ttl_minutes = config.get("dedup_ttl_minutes", 60)
+# 参加レートによるレイド検知
+raid_join_threshold = config.get("raid_join_threshold", 10)
+raid_join_window_seconds = config.get("raid_join_window_seconds", 10)
+raid_suspicious_threshold = config.get("raid_suspicious_threshold", 5)
+raid_account_age_days = config.get("raid_account_age_days", 7)
+raid_lockdown_minutes = config.get("raid_lockdown_minutes", 10)
+# ロックダウン中の不審な参加者への対応: "punish"（処罰）または "quarantine"（危険ロールのみ）
+# 不審な点のない参加者は raid_action によらず危険ロールの付与とログのみ
+raid_action = config.get("raid_action", "punish")
+# 連投（フラッド）検知
+flood_message_count = config.get("flood_message_count", 6)
+flood_window_seconds = config.get("flood_window_seconds", 5)
+flood_duplicate_count = config.get("flood_duplicate_count", 3)
+flood_duplicate_window_seconds = config.get("flood_duplicate_window_seconds", 30)
+# 同じ内容の繰り返しとして数える最小の文字数（正規化後。「ok」「草」などの短い相づちは数えない）
+flood_duplicate_min_length = config.get("flood_duplicate_min_length", 10)
+flood_mention_threshold = config.get("flood_mention_threshold", 5)
+flood_emoji_threshold = config.get("flood_emoji_threshold", 20)
+# 一定時間発言のないユーザーの記録は削除（秒）と、記録するユーザー数の上限
+flood_idle_seconds = config.get("flood_idle_seconds", 300)
+flood_max_tracked_users = config.get("flood_max_tracked_users", 50000)
+# 複数チャンネル・複数アカウントによる同じ文章（多少の違いを含む）の投稿検知
+duplicate_author_threshold = config.get("duplicate_author_threshold", 5)
+duplicate_window_seconds = config.get("duplicate_window_seconds", 60)
+duplicate_min_length = config.get("duplicate_min_length", 30)
+duplicate_similarity = config.get("duplicate_similarity", 0.5)
+duplicate_flag_ttl_minutes = config.get("duplicate_flag_ttl_minutes", 60)
+duplicate_max_clusters = config.get("duplicate_max_clusters", 50000)
+# 検知した文章を、検知したサーバーの禁止文字列リストに自動追加するか（他のサーバーには影響しない）
+duplicate_auto_add = config.get("duplicate_auto_add", True)
+# メッセージの編集時に再チェックを省くため、内容のハッシュと判定結果を覚えておく件数
+content_cache_max_entries = config.get("content_cache_max_entries", 50000)
+# 禁止文字列・重複投稿・連投の判定前に行う文字列の正規化
+#   "none": 小文字化のみ（従来どおり）
+#   "nfkc": 全角・互換文字（NFKC）と見た目が似た文字を統一し、ゼロ幅文字などの見えない文字を除去。
+#           1文字ずつ空白・「.」で区切った部分（"f r e e" / "f.r.e.e"）はつなげる
+#   "full": さらに空白・記号（Markdown の装飾を含む）をすべて除去（単語をまたいだ一致が増え、
+#           "sex" が "this is expensive" に一致するなど短い禁止文字列で誤検知するため、既定では使わない）
+text_normalization = config.get("text_normalization", "nfkc")
+# 正規表現・ワイルドカードのルールの最大文字数と、追加時の検査で許すメッセージ1件あたりの最悪の処理時間（ミリ秒）
+rule_max_length = config.get("rule_max_length", 200)
+rule_time_budget_ms = config.get("rule_time_budget_ms", 25)
+# バンリストの保存方式: "json"（ban_list.json とジャーナル）または "sqlite"（WAL モードの SQLite）
+ban_list_backend = config.get("ban_list_backend", "json")
+ban_list_db = config.get("ban_list_db", "ban_list.db")
+# /import で受け付ける添付ファイルの最大サイズ（バイト）
+import_max_bytes = config.get("import_max_bytes", 50 * 1024 * 1024)
+# 連携モード：検知したユーザーを、連携を有効にした他のサーバー（BOTとユーザーが共通で参加）でも処罰する
+# federation_enabled はサーバーごとの既定値（/federation で変更）
+federation_enabled = config.get("federation_enabled", False)
+# 連携処罰の結果を待つ最大時間（秒）
+federation_timeout_seconds = config.get("federation_timeout_seconds", 120)
+# 同じユーザーを再び連携処罰するまでの間隔（秒）
+federation_cooldown_seconds = config.get("federation_cooldown_seconds", 600)
+# ユーザーIDの Bloom フィルターの1件あたりのビット数（0 で無効。10 で誤判定は約1%）
+# リストにないIDの判定が速くなる代わりに、1件あたりのメモリと読み込み時間が増える
+user_id_bloom_bits = config.get("user_id_bloom_bits", 0)
+# Prometheus 形式のメトリクスを公開するポート（未設定なら無効）
+metrics_host = config.get("metrics_host", "127.0.0.1")
+metrics_port = config.get("metrics_port")
+
+# ログ出力（JSON Lines 形式のファイルはサイズでローテーション）
+log_level = config.get("log_level", "INFO")
+log_file = config.get("log_file", "bot.log")
+log_max_bytes = config.get("log_max_bytes", 10 * 1024 * 1024)
+log_backup_count = config.get("log_backup_count", 5)
+log_console = config.get("log_console", True)
+# 同じ警告・エラーを1件にまとめる間隔（秒）
+log_repeat_window_seconds = config.get("log_repeat_window_seconds", 60)
+
+# ユーザー取得（fetch_user）を省略した回数
+rest_calls_avoided = 0
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """ログを1行1件の JSON にする（extra で渡した項目もそのまま出力）"""
+
+    STANDARD_ATTRS = frozenset(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+    def format(self, record):
+        data = {
+            "time": datetime.fromtimestamp(record.created).astimezone().isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in self.STANDARD_ATTRS:
+                data[key] = value
+        if record.exc_info:
+            data["exception"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class ConsoleFormatter(logging.Formatter):
+    """コンソール向けの1行表示（省略した件数があれば末尾に付ける）"""
+
+    def format(self, record):
+        line = super().format(record)
+        suppressed = getattr(record, "suppressed", 0)
+        if suppressed:
+            line += f"（同じログを{suppressed}件省略）"
+        return line
+
+
+class RepeatFilter(logging.Filter):
+    """同じ警告・エラーが続く場合、一定時間に1件だけ通して残りは件数にまとめる"""
+
+    # 記録するログの種類の上限（古いものから削除）
+    MAX_KEYS = 1000
+
+    def __init__(self, window_seconds):
+        super().__init__()
+        self.window_seconds = window_seconds
+        self.seen = OrderedDict()  # (ロガー名, レベル, メッセージ) -> [最後に通した時刻, 省略した件数]
 
-# 処理済みユーザーIDを記録（ログの重複送信を防ぐ）
-processed_users = set()
+    def filter(self, record):
+        if record.levelno < logging.WARNING or self.window_seconds <= 0:
+            return True
+        # 引数（ユーザーIDなど）まで同じものだけをまとめる（別の対象のエラーは隠さない）
+        key = (record.name, record.levelno, record.getMessage())
+        now = time.monotonic()
+        entry = self.seen.get(key)
+        if entry is not None and now - entry[0] < self.window_seconds:
+            entry[1] += 1
+            return False
+        if entry is not None and entry[1]:
+            record.suppressed = entry[1]
+        self.seen[key] = [now, 0]
+        self.seen.move_to_end(key)
+        while len(self.seen) > self.MAX_KEYS:
+            self.seen.popitem(last=False)
+        return True
+
+
+def setup_logging():
+    """ログをキュー経由で別スレッドから書き出す（イベントループでファイル書き込みをしない）"""
+    handlers = []
+    if log_file:
+        file_handler = RotatingFileHandler(
+            log_file, maxBytes=log_max_bytes, backupCount=log_backup_count, encoding="utf-8"
+        )
+        file_handler.setFormatter(JsonLinesFormatter())
+        handlers.append(file_handler)
+    if log_console:
+        console_handler = logging.StreamHandler()
+        console_handler.setFormatter(ConsoleFormatter("[%(asctime)s] %(message)s"))
+        handlers.append(console_handler)
+
+    queue_handler = QueueHandler(queue.SimpleQueue())
+    queue_handler.addFilter(RepeatFilter(log_repeat_window_seconds))
+    listener = QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    level = logging.getLevelName(str(log_level).upper())
+    if not isinstance(level, int):
+        level = logging.INFO
+    # discord.py のログも同じ出力先にまとめる（bot.run では log_handler=None を指定）
+    for name in ("antiraid", "discord"):
+        target = logging.getLogger(name)
+        target.addHandler(queue_handler)
+        target.setLevel(level)
+        target.propagate = False
+    return listener
+
+
+log_listener = setup_logging()
+logger = logging.getLogger("antiraid")
 
 intents = discord.Intents.default()
 intents.message_content = True
 intents.members = True
 intents.guilds = True
 
-bot = commands.Bot(command_prefix="!", intents=intents)
 
+class Histogram:
+    """固定バケットのヒストグラム（記録は O(log バケット数)）"""
+
+    __slots__ = ("buckets", "counts", "total", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def quantile(self, q):
+        """バケット内を線形補間した分位数の推定値"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        lower = 0.0
+        for upper, count in zip(self.buckets, self.counts):
+            if count and seen + count >= rank:
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+            lower = upper
+        return self.buckets[-1]
+
+
+class Metrics:
+    """カウンターとヒストグラムの集計（Prometheus のテキスト形式で出力できる）"""
 
-def load_ban_list():
+    LATENCY_BUCKETS = (
+        0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+        0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0
+    )
+
+    def __init__(self):
+        # (名前, ラベル) → 値
+        self.counters = {}
+        self.histograms = {}
+        # 出力時に値を計算するゲージ（(名前, ラベル, 値) を返す関数）
+        self.gauges = []
+        # 出力時に値を読み取るカウンター（増えるだけの値。形式はゲージと同じ）
+        self.counter_functions = []
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(labels.items()))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(labels.items()))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(self.LATENCY_BUCKETS)
+        histogram.observe(value)
+
+    def counter_value(self, name, **match):
+        """ラベルが一致するカウンターの合計"""
+        total = 0
+        for (counter_name, labels), value in self.counters.items():
+            if counter_name == name and all(dict(labels).get(k) == v for k, v in match.items()):
+                total += value
+        return total
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        items = list(labels) + list(extra)
+        if not items:
+            return ""
+        return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+    def render(self):
+        """Prometheus のテキスト形式で出力"""
+        lines = []
+        typed = set()
+        for (name, labels), value in sorted(self.counters.items(), key=lambda item: item[0]):
+            if name not in typed:
+                lines.append(f"# TYPE antiraid_{name} counter")
+                typed.add(name)
+            lines.append(f"antiraid_{name}{self._labels(labels)} {value}")
+        for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+            if name not in typed:
+                lines.append(f"# TYPE antiraid_{name} histogram")
+                typed.add(name)
+            cumulative = 0
+            for upper, count in zip(self.buckets_with_inf(histogram), histogram.counts):
+                cumulative += count
+                lines.append(f"antiraid_{name}_bucket{self._labels(labels, [('le', upper)])} {cumulative}")
+            lines.append(f"antiraid_{name}_sum{self._labels(labels)} {histogram.total}")
+            lines.append(f"antiraid_{name}_count{self._labels(labels)} {histogram.count}")
+        for kind, functions in (("counter", self.counter_functions), ("gauge", self.gauges)):
+            for function in functions:
+                for name, labels, value in function():
+                    if name not in typed:
+                        lines.append(f"# TYPE antiraid_{name} {kind}")
+                        typed.add(name)
+                    lines.append(f"antiraid_{name}{self._labels(labels.items())} {value}")
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def buckets_with_inf(histogram):
+        return [str(upper) for upper in histogram.buckets] + ["+Inf"]
+
+
+metrics = Metrics()
+
+
+def timed(name):
+    """コルーチンの処理時間を記録するデコレーター"""
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                metrics.observe("handler_latency_seconds", time.perf_counter() - started, handler=name)
+        return wrapper
+    return decorator
+
+
+def count_rest(route):
+    """Discord の REST API を呼び出した回数を記録"""
+    metrics.inc("rest_calls_total", route=route)
+
+
+class RateLimitLogCounter(logging.Handler):
+    """discord.py 内部で待機したレート制限（429）の回数を数える"""
+
+    def emit(self, record):
+        if "429" in record.getMessage():
+            metrics.inc("rate_limits_total", source="discord.http")
+
+
+logging.getLogger("discord.http").addHandler(RateLimitLogCounter(logging.WARNING))
+
+
+class AntiRaidBot(commands.Bot):
+    async def setup_hook(self):
+        if metrics_port:
+            await start_metrics_server()
+
+    async def close(self):
+        """終了時に未書き込みのバンリスト変更を書き出す"""
+        try:
+            await ban_list.flush(compact=True)
+        except Exception as e:
+            logger.error("バンリストの書き込みエラー: %s", e)
+        await super().close()
+
+
+bot = AntiRaidBot(command_prefix="!", intents=intents, max_ratelimit_timeout=max_ratelimit_timeout)
+
+
+def load_ban_list(path=BAN_LIST_FILE):
     """バンリストを読み込む"""
     try:
-        with open(BAN_LIST_FILE, "r", encoding="utf-8") as f:
+        with open(path, "r", encoding="utf-8") as f:
             return json.load(f)
     except FileNotFoundError:
         return DEFAULT_BAN_LIST.copy()
 
 
-def save_ban_list(ban_list):
-    """バンリストを保存する"""
-    with open(BAN_LIST_FILE, "w", encoding="utf-8") as f:
+def save_ban_list(ban_list, path=BAN_LIST_FILE):
+    """バンリストを保存する（一時ファイルに書き込んでから置き換える）"""
+    temp_path = path + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
         json.dump(ban_list, f, ensure_ascii=False, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
 
 
-def save_config():
-    """設定を保存する"""
-    config["log_channel_id"] = log_channel_id
-    config["danger_role_id"] = danger_role_id
-    config["admin_role_ids"] = admin_role_ids
-    config["default_punishment"] = default_punishment
-    config["timeout_duration_minutes"] = timeout_duration_minutes
-    with open(CONFIG_FILE, "w", encoding="utf-8") as f:
-        json.dump(config, f, ensure_ascii=False, indent=2)
+# ===== バンリストの取り込み・書き出し =====
+# 対応形式: ndjson（1行に1件）・csv（ID だけを並べたテキストも可）・json（ban_list.json 形式または配列）
+IMPORT_FORMATS = ("ndjson", "csv", "json")
+FORMAT_EXTENSIONS = {
+    ".ndjson": "ndjson", ".jsonl": "ndjson",
+    ".csv": "csv", ".txt": "csv",
+    ".json": "json",
+}
+# 1行目にこの列名が含まれていれば見出し行として扱う（それ以外の列は無視する）
+CSV_HEADER_NAMES = {"type", "value", "guild_id", "user_id", "text"}
 
 
-async def get_log_channel(guild):
-    """ログチャンネルを取得"""
-    global log_channel_id
-    if log_channel_id:
+class ImportSummary:
+    """取り込み結果の件数"""
+
+    def __init__(self):
+        self.users = 0
+        self.texts = 0
+        self.duplicates = 0
+        self.invalid = 0
+        # 反映済みでまだ保存していないエントリ
+        self.applied = []
+
+    @property
+    def added(self):
+        return self.users + self.texts
+
+    def describe(self):
+        return (
+            f"ユーザーID {self.users}件、禁止文字列 {self.texts}件を追加しました。"
+            f"（登録済み・重複 {self.duplicates}件、読み取れない行 {self.invalid}件）"
+        )
+
+
+def detect_format(filename, head=""):
+    """拡張子（なければ先頭の内容）から形式を判定する"""
+    extension = os.path.splitext(filename.lower())[1]
+    if extension in FORMAT_EXTENSIONS:
+        return FORMAT_EXTENSIONS[extension]
+    head = head.lstrip("\ufeff \t\r\n")
+    if head.startswith("["):
+        return "json"
+    if head.startswith("{"):
+        # 1行目だけで完結した JSON なら ndjson
         try:
-            channel = guild.get_channel(log_channel_id)
-            if channel:
-                return channel
-        except:
-            pass
-    return None
+            json.loads(head.split("\n", 1)[0])
+            return "ndjson"
+        except ValueError:
+            return "json"
+    return "csv"
 
 
-async def assign_danger_role(member):
-    """危険な人にロールを付与（ロール付与できない問題を解決）"""
-    global danger_role_id
-    if not danger_role_id:
-        return False
-    
+def classify_value(value, guild_id=None):
+    """種類の指定がない値を (種類, 値, サーバーID) にする（数字だけならユーザーID）"""
+    if isinstance(value, bool) or not isinstance(value, (str, int)):
+        return (None, value, None)
+    if isinstance(value, int):
+        return ("user", str(value), guild_id)
+    value = value.strip()
+    if not value:
+        return (None, value, None)
+    if value.isascii() and value.isdigit():
+        return ("user", value, guild_id)
+    return ("text", value, guild_id)
+
+
+def entry_from_object(obj, guild_id=None):
+    """{"type": "user", "value": "..."} / {"user_id": ...} / {"text": ...} 形式の1件を変換する"""
+    if not isinstance(obj, dict):
+        return classify_value(obj, guild_id)
+    guild_id = obj.get("guild_id") or guild_id
     try:
-        # メンバーがサーバーに存在するか確認
-        if not isinstance(member, discord.Member):
-            print(f"[{datetime.now()}] メンバーオブジェクトが無効です")
-            return False
-        
-        # ロールを取得
-        role = member.guild.get_role(danger_role_id)
-        if not role:
-            print(f"[{datetime.now()}] ロールID {danger_role_id} が見つかりません")
+        guild_id = int(guild_id) if guild_id is not None else None
+    except (TypeError, ValueError):
+        return (None, obj, None)
+    if "user_id" in obj:
+        list_type, value = "user", obj["user_id"]
+    elif "text" in obj:
+        list_type, value = "text", obj["text"]
+    else:
+        list_type, value = obj.get("type"), obj.get("value")
+    if list_type is None:
+        return classify_value(value, guild_id)
+    if list_type not in ("user", "text") or not isinstance(value, (str, int)) or isinstance(value, bool):
+        return (None, obj, None)
+    value = str(value).strip()
+    if not value or (list_type == "user" and not (value.isascii() and value.isdigit())):
+        return (None, obj, None)
+    return (list_type, value, guild_id)
+
+
+def iter_ndjson(lines):
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield entry_from_object(json.loads(line))
+        except ValueError:
+            yield (None, line, None)
+
+
+def iter_csv(lines):
+    """見出し行があれば列名で、なければ1列目の値だけを使う（2列目以降は名前などのため無視）"""
+    columns = None
+    for row in csv.reader(lines):
+        cells = [cell.strip() for cell in row]
+        if not any(cells):
+            continue
+        if columns is None:
+            names = [cell.lower().lstrip("\ufeff") for cell in cells]
+            if set(names) & CSV_HEADER_NAMES:
+                columns = names
+                continue
+            columns = False
+        if columns:
+            yield entry_from_object({
+                name: cell for name, cell in zip(columns, cells) if name in CSV_HEADER_NAMES and cell
+            })
+        elif cells[0].lower() in ("user", "text") and len(cells) >= 2:
+            # 見出しなしの「種類,値[,サーバーID]」
+            yield entry_from_object({"type": cells[0].lower(), "value": cells[1], "guild_id": (cells[2:3] or [None])[0] or None})
+        else:
+            yield classify_value(cells[0])
+
+
+class JsonStreamReader:
+    """ban_list.json 形式（または値の配列）を少しずつ読み込み、1件ずつ返す
+
+    全体を読み込まずに、配列の要素を一つずつ json の raw_decode で取り出す。
+    """
+
+    CHUNK_SIZE = 1 << 16
+
+    def __init__(self, f):
+        self.f = f
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        """読み込み済みの部分を捨てて続きを読む（終端なら False）"""
+        if self.eof:
             return False
-        
-        # 既にロールを持っているか確認
-        if role in member.roles:
-            return True  # 既に付与されている
-        
-        # BOTのロール位置を確認
-        bot_member = member.guild.get_member(bot.user.id)
-        if bot_member:
-            bot_top_role = bot_member.top_role
-            if bot_top_role.position <= role.position:
-                print(f"[{datetime.now()}] 警告: BOTのロール位置が対象ロールより下です。")
-                print(f"  BOTのロール位置: {bot_top_role.position}, 対象ロール位置: {role.position}")
-                print(f"  ロールを付与するには、BOTのロールを対象ロールより上に配置してください。")
-                # それでも試行（権限があれば成功する可能性がある）
-        
-        # ロールを付与
-        await member.add_roles(role, reason="荒らし対策：危険ユーザーとして検知")
-        print(f"[{datetime.now()}] ユーザー {member.name} (ID: {member.id}) にロール {role.name} を付与しました")
-        return True
-        
-    except discord.errors.Forbidden as e:
-        print(f"[{datetime.now()}] ロール付与の権限がありません")
-        print(f"  エラー詳細: {e}")
-        print(f"  解決方法:")
-        print(f"  1. BOTに「ロールの管理」権限があるか確認")
-        print(f"  2. BOTのロールを対象ロールより上に配置")
-        print(f"  3. サーバー設定でBOTの権限を確認")
-        return False
-    except discord.errors.HTTPException as e:
-        print(f"[{datetime.now()}] ロール付与でHTTPエラーが発生: {e}")
-        return False
-    except Exception as e:
-        print(f"[{datetime.now()}] ロール付与エラー: {type(e).__name__}: {e}")
-        return False
+        chunk = self.f.read(self.CHUNK_SIZE)
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        if not chunk:
+            self.eof = True
+        return bool(chunk)
 
+    def _peek(self):
+        """空白を飛ばして次の1文字を返す（終端なら空文字列）"""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in " \t\r\n\ufeff":
+                self.pos += 1
+            if self.pos < len(self.buffer) or not self._fill():
+                return self.buffer[self.pos:self.pos + 1]
 
-async def send_log_once(guild, user, reason, action_type="検知", message_content=None):
-    """ログチャンネルにログを送信（一回のみ）"""
-    # 重複チェック用のキー
-    log_key = f"{guild.id}_{user.id}_{action_type}"
-    
-    # 既に処理済みの場合はスキップ
-    if log_key in processed_users:
+    def _expect(self, char):
+        if self._peek() != char:
+            raise ValueError(f"{char!r} が必要です（{self.pos}文字目付近）")
+        self.pos += 1
+
+    def _value(self):
+        while True:
+            if not self._peek():
+                raise ValueError("ファイルが途中で終わっています")
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                if self._fill():
+                    continue
+                raise
+            # 数値がバッファの末尾で途切れている可能性があるため、続きを読んでからやり直す
+            if end == len(self.buffer) and not self.eof and self._fill():
+                continue
+            self.pos = end
+            return value
+
+    def _items(self, close):
+        """配列・オブジェクトの区切りを読みながら、要素ごとに制御を返す"""
+        if self._peek() == close:
+            self.pos += 1
+            return
+        while True:
+            yield
+            char = self._peek()
+            self.pos += 1
+            if char == close:
+                return
+            if char != ",":
+                raise ValueError(f"',' または {close!r} が必要です（{self.pos}文字目付近）")
+
+    def _array(self, list_type, guild_id):
+        self._expect("[")
+        for _ in self._items("]"):
+            value = self._value()
+            if list_type == "text" and isinstance(value, str) and value.strip():
+                yield ("text", value.strip(), guild_id)
+            elif list_type == "user":
+                yield entry_from_object({"type": "user", "value": value, "guild_id": guild_id})
+            else:
+                yield entry_from_object(value, guild_id)
+
+    def _object(self, guild_id):
+        self._expect("{")
+        for _ in self._items("}"):
+            key = self._value()
+            self._expect(":")
+            if key in ("user_ids", "texts") and self._peek() == "[":
+                yield from self._array("user" if key == "user_ids" else "text", guild_id)
+            elif key == "guilds" and guild_id is None and self._peek() == "{":
+                self._expect("{")
+                for _ in self._items("}"):
+                    scoped_guild_id = self._value()
+                    self._expect(":")
+                    try:
+                        scoped_guild_id = int(scoped_guild_id)
+                    except (TypeError, ValueError):
+                        self._value()
+                        yield (None, scoped_guild_id, None)
+                        continue
+                    yield from self._object(scoped_guild_id)
+            else:
+                # 関係のないキーは読み飛ばす
+                self._value()
+
+    def __iter__(self):
+        char = self._peek()
+        if char == "[":
+            return self._array(None, None)
+        if char == "{":
+            return self._object(None)
+        raise ValueError("JSON の配列またはオブジェクトではありません")
+
+
+def iter_import_entries(f, fmt):
+    """テキストファイルから (種類, 値, サーバーID) を1件ずつ返す（読み取れない行は種類が None）"""
+    if fmt == "ndjson":
+        return iter_ndjson(f)
+    if fmt == "csv":
+        return iter_csv(f)
+    if fmt == "json":
+        return iter(JsonStreamReader(f))
+    raise ValueError(f"対応していない形式です: {fmt}")
+
+
+def write_export(f, fmt, scopes):
+    """(サーバーID, ユーザーIDの列, 禁止文字列の列) の列を指定の形式で少しずつ書き出す"""
+    if fmt == "ndjson":
+        for guild_id, user_ids, texts in scopes:
+            extra = f', "guild_id": "{guild_id}"' if guild_id is not None else ""
+            for user_id in user_ids:
+                f.write(f'{{"type": "user", "value": "{user_id}"{extra}}}\n')
+            for text in texts:
+                f.write(f'{{"type": "text", "value": {json.dumps(text, ensure_ascii=False)}{extra}}}\n')
+    elif fmt == "csv":
+        writer = csv.writer(f, lineterminator="\n")
+        writer.writerow(["type", "value", "guild_id"])
+        for guild_id, user_ids, texts in scopes:
+            scope = "" if guild_id is None else str(guild_id)
+            writer.writerows(("user", user_id, scope) for user_id in user_ids)
+            writer.writerows(("text", text, scope) for text in texts)
+    elif fmt == "json":
+        # ban_list.json と同じ形式（全体を文字列にせず、要素ごとに書き出す）
+        def write_list(key, values, indent):
+            f.write(f'{indent}"{key}": [')
+            separator = "\n"
+            for value in values:
+                f.write(f"{separator}{indent}  {json.dumps(str(value), ensure_ascii=False)}")
+                separator = ",\n"
+            f.write(f"\n{indent}]" if separator == ",\n" else "]")
+
+        f.write("{\n")
+        guild_count = 0
+        for guild_id, user_ids, texts in scopes:
+            if guild_id is None:
+                indent = "  "
+            else:
+                f.write(',\n  "guilds": {\n' if guild_count == 0 else ",\n")
+                f.write(f'    "{guild_id}": {{\n')
+                indent = "      "
+                guild_count += 1
+            write_list("user_ids", user_ids, indent)
+            f.write(",\n")
+            write_list("texts", texts, indent)
+            if guild_id is not None:
+                f.write("\n    }")
+        f.write("\n  }\n}\n" if guild_count else "\n}\n")
+    else:
+        raise ValueError(f"対応していない形式です: {fmt}")
+
+
+# 見た目が似た文字 → ラテン文字（NFKC と casefold で統一されないもの）
+CONFUSABLES = {
+    # キリル文字
+    "а": "a", "в": "b", "г": "r", "д": "d", "е": "e", "ё": "e", "з": "3", "к": "k", "м": "m", "н": "h",
+    "о": "o", "п": "n", "р": "p", "с": "c", "т": "t", "у": "y", "х": "x", "ѕ": "s", "і": "i", "ї": "i",
+    "ј": "j", "ԁ": "d", "ԛ": "q", "ԝ": "w", "һ": "h", "ӏ": "l", "ь": "b",
+    # ギリシャ文字
+    "α": "a", "β": "b", "γ": "y", "ε": "e", "η": "n", "ι": "i", "κ": "k", "ν": "v", "ο": "o", "ρ": "p",
+    "τ": "t", "υ": "u", "χ": "x", "ω": "w",
+    # アルメニア文字
+    "ո": "n", "ս": "u", "օ": "o", "զ": "q", "հ": "h",
+    # ラテン文字の異体・小型大文字
+    "ı": "i", "ɩ": "i", "ɑ": "a", "ɡ": "g", "ɢ": "g", "ᴀ": "a", "ʙ": "b", "ᴄ": "c", "ᴅ": "d", "ᴇ": "e",
+    "ꜰ": "f", "ʜ": "h", "ɪ": "i", "ᴊ": "j", "ᴋ": "k", "ʟ": "l", "ᴍ": "m", "ɴ": "n", "ᴏ": "o", "ᴘ": "p",
+    "ʀ": "r", "ꜱ": "s", "ᴛ": "t", "ᴜ": "u", "ᴠ": "v", "ᴡ": "w", "ʏ": "y", "ᴢ": "z",
+}
+# 地域指示記号（🇦〜🇿）は国旗以外に1文字ずつアルファベットとして使われる
+CONFUSABLES.update({chr(0x1F1E6 + i): chr(ord("a") + i) for i in range(26)})
+
+
+class TextFoldTable(dict):
+    """str.translate 用の表（似た文字の置き換えと不要な文字の削除）
+
+    Unicode 全体の表を起動時に作らず、初めて出てきた文字だけカテゴリを調べて記録する。
+    """
+
+    # 見えない文字（書式文字・制御文字など）と、NFKC で合成されずに残った結合文字
+    INVISIBLE_CATEGORIES = {"Cc", "Cf", "Cn", "Co", "Cs", "Mn", "Me"}
+    # 区切りとして扱う文字（空白・句読点・数学記号・修飾記号）
+    SEPARATOR_CATEGORIES = {"Zs", "Zl", "Zp", "Pc", "Pd", "Ps", "Pe", "Pi", "Pf", "Po", "Sm", "Sk"}
+
+    def __init__(self, strip_separators):
+        super().__init__()
+        self.removed = self.INVISIBLE_CATEGORIES | (self.SEPARATOR_CATEGORIES if strip_separators else set())
+        if not strip_separators:
+            # 空白は単語の区切りとして残す
+            self.removed = self.removed - {"Cc"}
+
+    def __missing__(self, code):
+        char = chr(code)
+        if char in CONFUSABLES:
+            value = CONFUSABLES[char]
+        elif unicodedata.category(char) in self.removed:
+            value = None
+        else:
+            value = code
+        self[code] = value
+        return value
+
+
+# 1文字ずつ区切って書いた部分（"f r e e n i t r o"）。区切りは空白1つか「.」1つ、
+# 前後を空白にした「.」「/」（"d i s c o r d . g g"）、単語の間を表す2つ以上の空白
+SPACED_SEPARATOR_PATTERN = re.compile(r" [./] |  +| |\.")
+SPACED_RUN_PATTERN = re.compile(r"(?<!\w)\w(?:(?: [./] |  +| |\.)\w){2,}(?!\w)")
+# 上のパターンは全位置で試すため遅い。区切りの直後の1文字から始まる先頭一致で先に絞り込む
+SPACED_HINT_PATTERNS = (re.compile(r" \w[ .]+\w(?!\w)"), re.compile(r"\.\w[ .]+\w(?!\w)"))
+
+
+def _join_spaced_run(match):
+    return SPACED_SEPARATOR_PATTERN.sub(
+        lambda sep: "" if len(sep.group()) == 1 else sep.group().strip() or " ", match.group()
+    )
+
+
+def make_text_folder(level, collapse_spaced=True):
+    """正規化の段階に応じた変換関数を返す（どれも文字列の長さに対して線形）
+
+    "nfkc" では、collapse_spaced なら1文字ずつ区切って書いた部分をつなげる。
+    """
+    if level not in ("nfkc", "full"):
+        return str.lower
+    table = TextFoldTable(strip_separators=level == "full")
+    collapse = collapse_spaced and level == "nfkc"
+
+    def fold_text(text):
+        # ASCII だけの文字列や、全角英数字などを含まない多くの日本語の文章は NFKC で変わらない
+        if not text.isascii() and not unicodedata.is_normalized("NFKC", text):
+            text = unicodedata.normalize("NFKC", text)
+        text = text.casefold().translate(table)
+        if collapse and any(hint.search(text) for hint in SPACED_HINT_PATTERNS):
+            text = SPACED_RUN_PATTERN.sub(_join_spaced_run, text)
+        return text
+
+    return fold_text
+
+
+fold_text = make_text_folder(text_normalization)
+# 1件のメッセージを複数の検知処理（禁止文字列・連投・重複投稿）で正規化し直さないよう、
+# 直近の結果を覚えておく（荒らしは同じ文章を繰り返し投稿するため、メッセージ間でも当たる）
+normalize_text = lru_cache(maxsize=1024)(fold_text)
+
+
+class TextMatcher:
+    """Aho-Corasick 法で複数の禁止文字列を一度の走査で検出する
+
+    normalize を指定すると、禁止文字列とメッセージの両方を同じ関数で正規化してから照合する
+    （禁止文字列の正規化は作成時の1回だけ）。
+    """
+
+    # これより少ない件数では C 実装の `in` を順に試すほうが速い
+    LINEAR_SCAN_THRESHOLD = 32
+
+    def __init__(self, patterns, normalize=None):
+        # 元の文字列（リスト順）。検出結果はこの順序の添字で返す
+        self.patterns = list(patterns)
+        self.normalize = normalize or str.lower
+        # 禁止文字列はキャッシュを通さずに変換する（メッセージのキャッシュを追い出さない）
+        fold = getattr(self.normalize, "__wrapped__", self.normalize)
+        self._keys = [fold(p) for p in self.patterns]
+        # 記号だけの文字列などは正規化すると空になるため、小文字化しただけの元のメッセージと照合する
+        self._fallback = [(i, p.lower()) for i, p in enumerate(self.patterns) if p and not self._keys[i]]
+        # 空文字列はどのメッセージにも含まれる扱い（従来の `in` と同じ挙動）
+        self._always = tuple(i for i, p in enumerate(self.patterns) if not p)
+        self._lowered = None
+        if len(self.patterns) < self.LINEAR_SCAN_THRESHOLD:
+            self._lowered = self._keys
+            return
+        self._build()
+
+    def _build(self):
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [()]
+
+        for index, pattern in enumerate(self._keys):
+            if not pattern:
+                continue
+            state = 0
+            for ch in pattern:
+                next_state = self._goto[state].get(ch)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto[state][ch] = next_state
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append(())
+                state = next_state
+            self._out[state] += (index,)
+
+        # 幅優先で失敗遷移を構築し、出力を失敗先とマージする
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                fail_target = self._goto[fail].get(ch, 0)
+                self._fail[next_state] = fail_target if fail_target != next_state else 0
+                if self._out[self._fail[next_state]]:
+                    self._out[next_state] += self._out[self._fail[next_state]]
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def find_all_indices(self, text):
+        """一致したすべての禁止文字列の添字を返す（リスト順）"""
+        normalized = self.normalize(text)
+        if self._lowered is not None:
+            matched = [i for i, p in enumerate(self._lowered) if p and p in normalized]
+            if not self._always and not self._fallback:
+                return matched
+            matched = set(matched)
+        else:
+            goto = self._goto
+            fail = self._fail
+            out = self._out
+            matched = set()
+            state = 0
+            for ch in normalized:
+                while state and ch not in goto[state]:
+                    state = fail[state]
+                state = goto[state].get(ch, 0)
+                if out[state]:
+                    matched.update(out[state])
+        matched.update(self._always)
+        if self._fallback:
+            text_lower = text.lower()
+            matched.update(i for i, p in self._fallback if p in text_lower)
+        return sorted(matched)
+
+    def find_all(self, text):
+        """一致したすべての禁止文字列を返す（リスト順）"""
+        return [self.patterns[i] for i in self.find_all_indices(text)]
+
+    def search(self, text):
+        """最初に一致した禁止文字列（リスト順で最も前のもの）を返す"""
+        indices = self.find_all_indices(text)
+        return self.patterns[indices[0]] if indices else None
+
+
+# メッセージ中のホスト名（ASCII のラベルを2つ以上）と、その後ろのパスの先頭2段
+# 直前が英数字・ドット・ハイフンの位置からは始めない（notevil.com の途中の evil.com を拾わない）
+LINK_PATTERN = re.compile(r"(?<![a-z0-9.-])((?:[a-z0-9-]+\.)+[a-z0-9-]+)(?::\d+)?(?:/([a-z0-9-]*)(?:/([a-z0-9-]*))?)?")
+# NFKC で「.」か「。」を含む文字になるもの（どれも含まず「dot」もない文章にはホスト名がないため、正規化を省く）
+LINK_DOT_PATTERN = re.compile("[.\u2024-\u2026\u2488-\u249b\u33c2\u33c7\u33d8\ufe19\ufe30\ufe52\uff0e\U0001f100\u3002\ufe12\uff61]")
+# 1つの正規表現にまとめると文字の集合だけの高速な検索にならないため分ける
+LINK_DOT_WORD_PATTERN = re.compile("dot", re.IGNORECASE)
+# リンクを崩して書く手口を戻す（見つからなかったときの2回目の判定用）
+# Markdown の装飾（**disc**||ord||.gg）
+LINK_MARKUP_PATTERN = re.compile(r"[*_|~`]+")
+# 1文字ずつ空白で区切った部分（d i s c o r d . g g/abc）。最後の1文字にはパスが続いてもよい
+LINK_SPACED_PATTERN = re.compile(r"(?<!\S)(?:\S[ \t]+){2,}\S(?:/\S*)?(?!\S)")
+# 「.」の言い換えと前後の空白（evil[.]com / evil(dot)com / evil . com）
+LINK_DOT_ALIAS_PATTERN = re.compile(r"\s*(?:[\[({]\s*(?:\.|dot)\s*[\])}]|\.)\s*")
+# 招待リンクのホスト名（discord.gg/コード・discord.com/invite/コード）
+INVITE_HOSTS = {"discord.gg", "discord.com", "discordapp.com"}
+
+# 区切りの記号・空白を残す正規化（リンク・正規表現などのルールの判定用）
+# 全角・似た文字・見えない文字は禁止文字列と同じく統一する
+fold_spaced_text = lru_cache(maxsize=1024)(
+    make_text_folder("none" if text_normalization == "none" else "nfkc", collapse_spaced=False)
+)
+
+
+def fold_link_text(text, fold=fold_spaced_text):
+    """ホスト名を取り出せるように正規化する（句点「。」もドメインの区切りとして扱う）"""
+    return fold(text).replace("。", ".")
+
+
+def unmask_link_text(text):
+    """区切りや言い換えで崩したリンクを戻す（fold_link_text で正規化した文字列を受け取る）"""
+    text = LINK_MARKUP_PATTERN.sub("", text)
+    text = LINK_SPACED_PATTERN.sub(lambda match: "".join(match.group().split()), text)
+    return LINK_DOT_ALIAS_PATTERN.sub(".", text)
+
+
+def invite_code(host, first, second):
+    """ホスト名とパスの先頭2段から招待コードを返す（招待リンクでなければ None）"""
+    if host.startswith("www."):
+        host = host[4:]
+    if host not in INVITE_HOSTS:
         return None
-    
-    log_channel = await get_log_channel(guild)
-    if not log_channel:
+    if first == "invite":
+        return second or None
+    return first if host == "discord.gg" and first else None
+
+
+def parse_link_rule(text):
+    """禁止文字列がリンクだけの場合 ("domain", ホスト名) か ("invite", 招待コード) を返す
+
+    パスを含む URL（招待リンクを除く）や、ドメインとして扱えない文字列は None
+    （従来どおり部分一致で判定する）。
+    """
+    folded = fold_link_text(text, fold_spaced_text.__wrapped__).strip()
+    if "://" in folded:
+        folded = folded.split("://", 1)[1]
+    folded = folded.rstrip("/").rstrip(".")
+    match = LINK_PATTERN.fullmatch(folded)
+    if match is None:
+        return None
+    host, first, second = match.groups()
+    code = invite_code(host, first, second)
+    if code is not None:
+        return ("invite", code)
+    # 最後のラベル（トップレベルドメイン）が英字で始まるもののみ（1.5 や IP アドレスは除く）
+    if first is not None or not host.rsplit(".", 1)[1][:1].isalpha():
         return None
+    if host.startswith("www."):
+        host = host[4:]
+    return ("domain", host)
 
-    try:
-        embed = discord.Embed(
-            title=f"⚠️ {action_type}",
-            color=discord.Color.red(),
-            timestamp=datetime.utcnow()
-        )
-        embed.add_field(name="ユーザー", value=f"{user.mention} ({user.name})", inline=False)
-        embed.add_field(name="ユーザーID", value=str(user.id), inline=False)
-        embed.add_field(name="理由", value=reason, inline=False)
-        if message_content:
-            embed.add_field(name="メッセージ内容", value=message_content[:1000], inline=False)
-        
-        embed.set_footer(text=f"アクション: {action_type}")
-        
-        await log_channel.send(embed=embed)
-        
-        # 処理済みとして記録
-        processed_users.add(log_key)
-        
-        # メモリリークを防ぐため、一定数以上になったら古いものを削除
-        if len(processed_users) > 1000:
-            # 最新の500件のみ保持
-            processed_users.clear()
-        
+
+class LinkMatcher:
+    """メッセージ中のリンクを禁止ドメイン（サブドメインを含む）と招待コードで判定する
+
+    禁止ドメインはラベルを逆順にした木（com → evil）で持ち、ホスト名の末尾から
+    たどる。招待コードは dict で引く。どちらもリストの件数によらず、1件のリンクあたり
+    ラベル数程度の辞書の参照で判定できる。
+    """
+
+    def __init__(self, patterns=()):
+        # ラベル → 子の dict、または禁止ドメイン全体が一致した位置では元の禁止文字列
+        self._domains = {}
+        # 招待コード → 元の禁止文字列
+        self._invites = {}
+        self._count = 0
+        for pattern in patterns:
+            self.add(pattern)
+
+    def add(self, pattern):
+        """禁止文字列がリンクなら登録して True を返す（リンクでなければ False）"""
+        rule = parse_link_rule(pattern)
+        if rule is None:
+            return False
+        kind, value = rule
+        self._count += 1
+        if kind == "invite":
+            self._invites.setdefault(value, pattern)
+            return True
+        labels = value.split(".")
+        node = self._domains
+        for label in reversed(labels[1:]):
+            child = node.get(label)
+            if type(child) is str:
+                # 親ドメインが登録済み（サブドメインはすでに対象）
+                return True
+            if child is None:
+                child = node[label] = {}
+            node = child
+        if type(node.get(labels[0])) is not str:
+            # サブドメインだけが登録されていた場合も、親ドメインの登録で置き換える
+            node[labels[0]] = pattern
         return True
-    except Exception as e:
-        print(f"[{datetime.now()}] ログ送信エラー: {e}")
+
+    def __len__(self):
+        return self._count
+
+    def match_host(self, host):
+        """ホスト名が禁止ドメインかそのサブドメインなら元の禁止文字列を返す"""
+        node = self._domains
+        for label in reversed(host.split(".")):
+            node = node.get(label)
+            if node is None:
+                return None
+            if type(node) is str:
+                return node
         return None
 
+    def search(self, text):
+        """文章中の最初の禁止リンクの元の禁止文字列を返す
 
-async def is_admin(member):
-    """ユーザーが管理者かどうかをチェック"""
-    if not member:
-        return False
-    
-    # 管理者権限を持っているかチェック
-    if member.guild_permissions.administrator:
-        return True
-    
-    # 管理者ロールを持っているかチェック
-    global admin_role_ids
-    if admin_role_ids:
-        member_role_ids = [role.id for role in member.roles]
-        for admin_role_id in admin_role_ids:
-            if admin_role_id in member_role_ids:
-                return True
-    
-    return False
+        見つからなければ、区切りや [.] で崩したリンクを戻してもう一度探す。
+        部分一致には戻さないため、notevil.com の中の evil.com などは拾わない。
+        """
+        if not self._count or (LINK_DOT_PATTERN.search(text) is None and LINK_DOT_WORD_PATTERN.search(text) is None):
+            return None
+        text = fold_link_text(text)
+        rule = self._search_folded(text)
+        if rule is None:
+            unmasked = unmask_link_text(text)
+            if unmasked != text:
+                rule = self._search_folded(unmasked)
+        return rule
 
+    def _search_folded(self, text):
+        for match in LINK_PATTERN.finditer(text):
+            host, first, second = match.groups()
+            rule = self.match_host(host)
+            if rule is None and self._invites:
+                code = invite_code(host, first, second)
+                rule = self._invites.get(code) if code is not None else None
+            if rule is not None:
+                return rule
+        return None
+
+
+def embed_text(embeds):
+    """埋め込みのリンク・本文をまとめた文字列（リンクの判定用）"""
+    parts = []
+    for embed in embeds:
+        parts += (embed.url, embed.title, embed.description, embed.author.url)
+        parts += (field.value for field in embed.fields)
+    return "\n".join(part for part in parts if part)
+
+
+# ===== 正規表現・ワイルドカード・単語のルール =====
+# 禁止文字列に「種類:内容」の形で保存する（例: "regex:fr[e3]{2}\s*nitro" / "glob:*nitro*" / "word:raid"）
+RULE_TYPES = ("regex", "glob", "word")
+# RE2 がなければ標準の re を使う（re は途中で止められないため、追加時に遅くなるパターンを弾く）
+regex_engine = re2 if re2 is not None else re
+# 長さの変わる繰り返し（*, +, ?, {m,n}）
+REPEAT_OPS = {sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT, getattr(sre_parse, "POSSESSIVE_REPEAT", None)} - {None}
+# 追加時の検査に使う文字列の長さ（Discord のメッセージの最大文字数）
+RULE_STRESS_LENGTH = 4000
+# 追加時の検査全体の制限時間（秒）。超えたら検査用のプロセスを止めて追加を断る
+RULE_CHECK_TIMEOUT = 5.0
+# 検査用のプロセスで実行するスクリプト（最悪の処理時間を出力する）
+RULE_CHECK_SCRIPT = """
+import json, re, sys, time
+data = json.load(sys.stdin)
+pattern = re.compile(data["pattern"])
+worst = 0.0
+for text in data["inputs"]:
+    start = time.perf_counter()
+    pattern.search(text)
+    worst = max(worst, time.perf_counter() - start)
+    if worst > data["budget"]:
+        break
+print(worst)
+"""
+
+
+# 正規表現の字句（エスケープ・ASCII 以外の文字の並び・それ以外の1文字）
+RULE_TOKEN_PATTERN = re.compile(r"\\.|[^\x00-\x7f]+|.", re.DOTALL)
+
+
+def fold_rule_source(source):
+    """正規表現の ASCII 以外の文字をメッセージと同じく正規化する（全角・似た文字など）
+
+    ASCII の文字は正規化で変わらない（大文字は (?i) で一致する）ため、記号の意味は変えない。
+    正規化後の文字はエスケープし、繰り返しの直前で複数の文字になるものは (?:) で囲む。
+    """
+    fold = fold_spaced_text.__wrapped__
+    tokens = RULE_TOKEN_PATTERN.findall(source)
+    parts = []
+    in_class = False
+    class_chars = 0
+    for index, token in enumerate(tokens):
+        if token[0] == "\\" and not token[1:].isascii():
+            # エスケープした全角文字なども通常の文字として扱う
+            token = token[1:]
+        if token.isascii():
+            if in_class:
+                # 先頭の ] は文字として扱われる
+                if token == "]" and class_chars:
+                    in_class = False
+                elif token != "^" or class_chars:
+                    class_chars += 1
+            elif token == "[":
+                in_class, class_chars = True, 0
+            parts.append(token)
+            continue
+        if in_class:
+            for char in token:
+                folded = fold(char)
+                if len(folded) != 1:
+                    raise ValueError(f"[] の中の「{char}」は正規化すると1文字になりません")
+                parts.append(re.escape(folded))
+            class_chars += 1
+            continue
+        # 繰り返しは直前の1文字にかかるため、最後の1文字を分けて正規化する
+        following = tokens[index + 1] if index + 1 < len(tokens) else ""
+        if following in ("*", "+", "?", "{"):
+            parts.append(re.escape(fold(token[:-1])))
+            folded = fold(token[-1])
+            parts.append(re.escape(folded) if len(folded) == 1 else f"(?:{re.escape(folded)})")
+        else:
+            parts.append(re.escape(fold(token)))
+    return "".join(parts)
+
+
+def rule_kind(text):
+    """禁止文字列がルールならその種類（"regex" / "glob" / "word"）、そうでなければ None"""
+    kind, separator, body = text.partition(":")
+    return kind if separator and body and kind in RULE_TYPES else None
+
+
+def escape_rule_prefix(text):
+    """ルールの種類で始まる文字列を、ルールではない禁止文字列として保存できる形にする
+
+    種類の後の「:」を全角にする（判定前の正規化で「:」に戻るため、同じ文字列に一致する）。
+    """
+    kind = rule_kind(text)
+    return f"{kind}：{text[len(kind) + 1:]}" if kind else text
+
+
+def _check_repeats(subpattern, in_repeat=False):
+    """解析した正規表現をたどり、入力によって極端に遅くなる構造があれば ValueError"""
+    for op, av in subpattern:
+        if op in (sre_parse.GROUPREF, sre_parse.GROUPREF_EXISTS):
+            raise ValueError("後方参照は使えません")
+        if op in REPEAT_OPS:
+            low, high, body = av
+            if in_repeat and low != high:
+                raise ValueError("繰り返しの中で長さの変わる繰り返しは使えません（例: (a+)+）")
+            _check_repeats(body, in_repeat or high > 1)
+        elif op == sre_parse.BRANCH:
+            for branch in av[1]:
+                _check_repeats(branch, in_repeat)
+        elif op == sre_parse.SUBPATTERN:
+            _check_repeats(av[-1], in_repeat)
+        elif op in (sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+            _check_repeats(av[1], in_repeat)
+        elif op == getattr(sre_parse, "ATOMIC_GROUP", None):
+            _check_repeats(av, in_repeat)
+
+
+def rule_source(text):
+    """ルールを正規表現の文字列にする（使えないルールは理由を付けて ValueError）"""
+    kind, _, body = text.partition(":")
+    if len(body) > rule_max_length:
+        raise ValueError(f"{rule_max_length}文字を超えています")
+    if kind == "regex":
+        # 大文字・小文字は常に区別しない（まとめたときに先頭以外のフラグはエラーになるため外す）
+        source = body[4:] if body.startswith("(?i)") else body
+        if "(?P<" in source:
+            # ルールをまとめたときに名前が重なるため
+            raise ValueError("名前付きグループは使えません")
+        # メッセージは正規化してから照合するため、全角・似た文字のままでは一致しない
+        source = fold_rule_source(source)
+    elif kind == "glob":
+        # Discord の AutoMod と同じく、空白で区切られた語全体と照合する（* は語の中の任意の文字列、? は任意の1文字）
+        body = fold_spaced_text.__wrapped__(body).strip()
+        if not body.strip("*?"):
+            raise ValueError("ワイルドカード以外の文字を含めてください")
+        parts = [r"\S*" if char == "*" else r"\S" if char == "?" else re.escape(char) for char in re.sub(r"\*+", "*", body)]
+        source = r"(?:^|\s)" + "".join(parts) + r"(?:\s|$)"
+    elif kind == "word":
+        body = fold_spaced_text.__wrapped__(body).strip()
+        source = re.escape(body)
+        # 英数字で始まる・終わる場合のみ単語の境界を求める（"c++" のような記号で終わる語にも使えるように）
+        if body[:1].isalnum() or body[:1] == "_":
+            source = r"\b" + source
+        if body[-1:].isalnum() or body[-1:] == "_":
+            source += r"\b"
+    else:
+        raise ValueError("ルールではありません")
+    try:
+        compiled = regex_engine.compile(f"(?i)(?:{source})")
+        if regex_engine is re:
+            _check_repeats(sre_parse.parse(source))
+    except regex_engine.error as e:
+        raise ValueError(f"正規表現の誤り: {e}") from None
+    if compiled.search("") is not None:
+        raise ValueError("空の文字列に一致するため、すべてのメッセージが対象になります")
+    return source
+
+
+def rule_stress_inputs(source, length=RULE_STRESS_LENGTH):
+    """追加時の検査に使う文字列（パターン中の文字の繰り返しと、最後の1文字だけ一致しないもの）"""
+    chars = []
+
+    def collect(subpattern):
+        for op, av in subpattern:
+            if op == sre_parse.LITERAL:
+                chars.append(chr(av))
+            elif op == sre_parse.IN:
+                chars.extend(chr(item[0] if isinstance(item, tuple) else item) for _, item in av if item is not None)
+            else:
+                for child in av if isinstance(av, (tuple, list)) else (av,):
+                    if isinstance(child, list):
+                        for branch in child:
+                            collect(branch)
+                    elif isinstance(child, sre_parse.SubPattern):
+                        collect(child)
+
+    collect(sre_parse.parse(source))
+    sequence = "".join(chars) or "a"
+    inputs = []
+    for unit in dict.fromkeys(chars + ["a", " ", "0", sequence]):
+        text = (unit * (length // len(unit) + 1))[:length]
+        inputs += [text, text[:-1] + "\x00", (unit + " ") * (length // (len(unit) + 1))]
+    return inputs
+
+
+async def measure_rule_worst_case(source):
+    """テスト用の文字列での最悪の処理時間（秒）を別のプロセスで測る（制限時間を超えたら None）"""
+    data = {"pattern": f"(?i)(?:{source})", "inputs": rule_stress_inputs(source), "budget": rule_time_budget_ms / 1000}
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, "-c", RULE_CHECK_SCRIPT, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE
+    )
+    try:
+        stdout, _ = await asyncio.wait_for(process.communicate(json.dumps(data).encode()), RULE_CHECK_TIMEOUT)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        return None
+    try:
+        return float(stdout)
+    except ValueError:
+        return None
+
+
+async def check_rule(text):
+    """/add で追加するルールを検査する（使えない場合は理由、問題なければ None）"""
+    try:
+        source = rule_source(text)
+    except ValueError as e:
+        return str(e)
+    if regex_engine is not re:
+        # RE2 はどのパターンでもメッセージの長さに対して線形時間で終わる
+        return None
+    worst = await measure_rule_worst_case(source)
+    if worst is None or worst * 1000 > rule_time_budget_ms:
+        return (
+            f"メッセージによっては1件の判定に {rule_time_budget_ms}ms 以上かかります"
+            "（.* の連続や、繰り返しの中の選択・繰り返しを減らしてください）"
+        )
+    return None
+
+
+class RuleVerifier:
+    """追加時の検査（check_rule）の結果の記録
+
+    /add 以外（/import・ファイルの編集など）で追加されたルールは、検査を通るまで判定に
+    使わない。検査していないルールはイベントループ上で1件ずつ別のプロセスで検査する。
+    """
+
+    def __init__(self):
+        # ルール → 使えない理由（問題なければ None）
+        self.results = {}
+        # 検査待ちのルール（dict を順序付き集合として使う）
+        self._pending = {}
+        self._task = None
+
+    def record(self, rule, error):
+        self.results[rule] = error
+
+    def verified(self, rules):
+        """検査を通ったルールだけを返す（まだ検査していないものは検査を予約する）"""
+        accepted = []
+        for rule in rules:
+            if rule not in self.results:
+                self._pending[rule] = None
+            elif self.results[rule] is None:
+                accepted.append(rule)
+        if self._pending:
+            self._schedule()
+        return accepted
+
+    def _schedule(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # イベントループ外（--import など）では検査しない
+            return
+        if self._task is None or self._task.done():
+            self._task = loop.create_task(self._run())
+
+    async def _run(self):
+        accepted = False
+        while self._pending:
+            rule = next(iter(self._pending))
+            error = await check_rule(rule)
+            del self._pending[rule]
+            self.results[rule] = error
+            if error:
+                logger.warning("ルール %s を無視します: %s", rule, error)
+            else:
+                accepted = True
+        if accepted:
+            # 検査を通ったルールを判定に加える
+            ban_list.invalidate_matchers()
+
+
+rule_verifier = RuleVerifier()
+
+
+def rule_literal(source):
+    """ルールが一致するメッセージに必ず含まれる最長の文字列（小文字。なければ空文字列）"""
+    best = current = ""
+    try:
+        parsed = sre_parse.parse(source)
+    except re.error:
+        # RE2 にしかない書き方など
+        return ""
+    for op, av in parsed:
+        if op == sre_parse.LITERAL:
+            current += chr(av)
+            best = max(best, current, key=len)
+        else:
+            current = ""
+    return best.lower()
+
+
+class RuleMatcher:
+    """正規表現・ワイルドカード・単語のルールをまとめて判定する
+
+    各ルールが必ず含む文字列（"free.*nitro" なら "nitro"）を Aho-Corasick 法で1回走査して
+    候補を絞り、候補のルールだけ正規表現で確かめる（re の正規表現を1つにまとめると、
+    メッセージの各位置ですべてのルールを試すため、ルールごとに試すより遅くなる）。
+    そのような文字列がないルールは、1つの正規表現にまとめて毎回判定する。
+
+    メッセージは空白・記号を残したまま正規化（全角・大文字・似た文字を統一）してから照合する。
+    """
+
+    def __init__(self, patterns=()):
+        # 元の禁止文字列と、ルールごとの正規表現
+        self.patterns = []
+        self._regexes = []
+        literals = []
+        # 絞り込み用の文字列の添字 → ルールの添字
+        self._candidates = []
+        combined = []
+        for pattern in patterns:
+            try:
+                source = rule_source(pattern)
+            except ValueError as e:
+                # ファイルの編集や /import で追加された、検査を通らないルール
+                logger.warning("ルール %s を無視します: %s", pattern, e)
+                continue
+            index = len(self.patterns)
+            self.patterns.append(pattern)
+            self._regexes.append(regex_engine.compile(f"(?i)(?:{source})"))
+            literal = rule_literal(source)
+            if literal:
+                literals.append(literal)
+                self._candidates.append(index)
+            else:
+                combined.append(f"(?P<r{index}>{source})")
+        self._prefilter = TextMatcher(literals)
+        self._combined = regex_engine.compile("(?i)" + "|".join(combined)) if combined else None
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def search(self, text):
+        """一致したルールの元の禁止文字列を返す（絞り込めるルールを先に確かめる）"""
+        if not self.patterns:
+            return None
+        text = fold_spaced_text(text)
+        for literal_index in self._prefilter.find_all_indices(text):
+            index = self._candidates[literal_index]
+            if self._regexes[index].search(text) is not None:
+                return self.patterns[index]
+        if self._combined is None:
+            return None
+        match = self._combined.search(text)
+        if match is None:
+            return None
+        for name, value in match.groupdict().items():
+            if value is not None:
+                return self.patterns[int(name[1:])]
+        return None
+
+
+class UserIdSet:
+    """ユーザーID（64ビット整数）の集合（1件あたり約8バイト）
+
+    本体は整列済みの array('Q') で、二分探索で判定する。追加・削除は小さな
+    set に溜めておき、一定件数ごとに本体へまとめる。Bloom フィルターを
+    有効にすると、リストにないIDの大半は二分探索の前に除外できる。
+    数字でない値（手動で追加された文字列など）は別の set にそのまま保持する。
+    """
+
+    # 追加・削除の差分がこの件数を超えたら本体の配列にまとめる
+    MERGE_THRESHOLD = 4096
+    _MULTIPLIER = 0x9E3779B97F4A7C15
+    _MASK64 = (1 << 64) - 1
+
+    def __init__(self, ids=(), bloom_bits_per_id=0):
+        self.bloom_bits_per_id = bloom_bits_per_id
+        values = list(ids)
+        numbers = self._bulk_sorted_keys(values)
+        self._others = set()
+        if numbers is None:
+            keys = set()
+            for value in values:
+                key = self._key(value)
+                if key is None:
+                    self._others.add(str(value))
+                else:
+                    keys.add(key)
+            numbers = sorted(keys)
+        self._sorted = array("Q", numbers)
+        self._added = set()
+        self._removed = set()
+        self._count = len(self._sorted) + len(self._others)
+        self._build_bloom()
+
+    def invalid_ids(self):
+        """ユーザーIDとして無効な値（空文字列や数字以外を含むもの）のリスト"""
+        return [value for value in self._others if not (value.isascii() and value.isdigit())]
+
+    @staticmethod
+    def _key(value):
+        """整数として保持できる値ならその整数、できなければ None"""
+        if type(value) is int:
+            return value if 0 <= value < 1 << 64 else None
+        value = str(value)
+        # 先頭の 0 などで文字列に戻したとき別の値になるものは文字列のまま扱う
+        if value.isascii() and value.isdigit() and (value == "0" or value[0] != "0"):
+            number = int(value)
+            if number < 1 << 64:
+                return number
+        return None
+
+    @staticmethod
+    def _bulk_sorted_keys(values):
+        """すべて整数として保持できる値なら、重複を除いて整列した整数のリスト（できなければ None）
+
+        1件ずつ _key を呼ぶより大幅に速い。スナップショットは整列済みで保存するため、
+        読み込み時の sorted はほぼ線形で終わる。
+        """
+        texts = list(map(str, values))
+        joined = "".join(texts)
+        # int() は空白や "+"・"_" も受け付けるため、ASCII の数字だけで先頭が 0 でないことを確かめる
+        # （空文字列は連結すると消えるため、先頭の文字で別に確かめる）
+        heads = [text[:1] for text in texts]
+        if not (joined.isascii() and joined.isdigit()) or "0" in heads or "" in heads:
+            return None
+        numbers = sorted(map(int, texts))
+        if numbers and numbers[-1] >= 1 << 64:
+            return None
+        if any(map(int.__eq__, numbers, islice(numbers, 1, None))):
+            numbers = list(dict.fromkeys(numbers))
+        return numbers
+
+    def _build_bloom(self):
+        """ビット数を 2 のべき乗に切り上げて Bloom フィルターを作り直す（ハッシュ3個）"""
+        if not self.bloom_bits_per_id:
+            self._bloom = None
+            return
+        # 作り直しの頻度を抑えるため、件数が倍になるまでの余裕を持たせる
+        self._bloom_capacity = max(2 * self._count, 65536)
+        bits = 1 << (self._bloom_capacity * self.bloom_bits_per_id - 1).bit_length()
+        self._bloom = bytearray(bits >> 3)
+        self._bloom_mask = bits - 1
+        # 件数が多いと起動時間に響くため、_bloom_add をループ内に展開する
+        bloom = self._bloom
+        mask = self._bloom_mask
+        multiplier = self._MULTIPLIER
+        mask64 = self._MASK64
+        for key in chain(self._sorted, self._added):
+            hashed = (key * multiplier) & mask64
+            step = (hashed >> 32) | 1
+            position = hashed & mask
+            bloom[position >> 3] |= 1 << (position & 7)
+            position = (position + step) & mask
+            bloom[position >> 3] |= 1 << (position & 7)
+            position = (position + step) & mask
+            bloom[position >> 3] |= 1 << (position & 7)
+
+    def _bloom_add(self, key):
+        bloom = self._bloom
+        mask = self._bloom_mask
+        hashed = (key * self._MULTIPLIER) & self._MASK64
+        position = hashed & mask
+        step = (hashed >> 32) | 1
+        for _ in range(3):
+            bloom[position >> 3] |= 1 << (position & 7)
+            position = (position + step) & mask
+
+    def __contains__(self, value):
+        key = value if type(value) is int else self._key(value)
+        if key is None:
+            return str(value) in self._others
+        bloom = self._bloom
+        if bloom is not None:
+            # 3個のビットのどれかが 0 なら確実にリストにない（ループを展開して高速化）
+            mask = self._bloom_mask
+            hashed = (key * self._MULTIPLIER) & self._MASK64
+            position = hashed & mask
+            step = (hashed >> 32) | 1
+            if not bloom[position >> 3] >> (position & 7) & 1:
+                return False
+            position = (position + step) & mask
+            if not bloom[position >> 3] >> (position & 7) & 1:
+                return False
+            position = (position + step) & mask
+            if not bloom[position >> 3] >> (position & 7) & 1:
+                return False
+        if key in self._added:
+            return True
+        if key in self._removed:
+            return False
+        ids = self._sorted
+        index = bisect_left(ids, key)
+        return index < len(ids) and ids[index] == key
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        """整数のIDを昇順に、続けて数字でない値を返す"""
+        self._merge()
+        yield from self._sorted
+        yield from self._others
+
+    def add(self, value):
+        """追加した場合 True"""
+        key = self._key(value)
+        if key is None:
+            value = str(value)
+            if value in self._others:
+                return False
+            self._others.add(value)
+        else:
+            if key in self:
+                return False
+            if key in self._removed:
+                self._removed.discard(key)
+            else:
+                self._added.add(key)
+            if self._bloom is not None:
+                self._bloom_add(key)
+        self._count += 1
+        self._maybe_merge()
+        return True
+
+    def discard(self, value):
+        """削除した場合 True（Bloom フィルターのビットは次に作り直すまで残る）"""
+        key = self._key(value)
+        if key is None:
+            value = str(value)
+            if value not in self._others:
+                return False
+            self._others.discard(value)
+        else:
+            if key not in self:
+                return False
+            if key in self._added:
+                self._added.discard(key)
+            else:
+                self._removed.add(key)
+        self._count -= 1
+        self._maybe_merge()
+        return True
+
+    def _maybe_merge(self):
+        if len(self._added) + len(self._removed) > self.MERGE_THRESHOLD:
+            self._merge()
+        if self._bloom is not None and self._count > self._bloom_capacity:
+            self._merge()
+            self._build_bloom()
+
+    def _merge(self):
+        """差分を本体の配列にまとめる（整列済みの列どうしなので sorted はほぼ線形）"""
+        if not self._added and not self._removed:
+            return
+        ids = self._sorted
+        if self._removed:
+            removed = self._removed
+            ids = [key for key in ids if key not in removed]
+        if self._added:
+            ids = sorted(chain(ids, self._added))
+        self._sorted = array("Q", ids)
+        self._added = set()
+        self._removed = set()
+
+    def difference(self, other):
+        """other に含まれないIDの set"""
+        self._merge()
+        other._merge()
+        keys = set(self._sorted)
+        keys.difference_update(other._sorted)
+        keys.update(self._others - other._others)
+        return keys
+
+    def copy(self):
+        """同じ内容の複製（Bloom フィルターなし）"""
+        self._merge()
+        duplicate = UserIdSet()
+        duplicate._sorted = array("Q", self._sorted)
+        duplicate._others = set(self._others)
+        duplicate._count = self._count
+        return duplicate
+
+    def memory_bytes(self):
+        """本体の配列・差分・Bloom フィルターのおおよそのメモリ使用量"""
+        size = self._sorted.buffer_info()[1] * self._sorted.itemsize
+        size += sys.getsizeof(self._added) + sys.getsizeof(self._removed) + sys.getsizeof(self._others)
+        if self._bloom is not None:
+            size += len(self._bloom)
+        return size
+
+
+class BanList:
+    """メモリ常駐のバンリスト（ファイルが変更されたときのみ再読み込み）
+
+    変更はジャーナルファイルに追記し、一定件数ごとにスナップショット
+    （ban_list.json）へ圧縮する。起動時はスナップショットを読み込んだ後、
+    ジャーナルを再適用する。
+
+    エントリは全サーバー共通か、特定のサーバーのみ（guild_id を指定）の
+    どちらかに登録する。追加者・日時・理由はジャーナルには残るが、
+    スナップショットには保存しない（保存する場合は SqliteBanList を使う）。
+    """
+
+    # ファイルの変更確認（stat）を行う最小間隔（秒）
+    RELOAD_CHECK_INTERVAL = 1.0
+    # 変更をまとめてジャーナルに書き込むまでの遅延（秒）
+    JOURNAL_FLUSH_DELAY = 0.5
+    # ジャーナルがこの件数を超えたらスナップショットに圧縮する
+    JOURNAL_COMPACT_THRESHOLD = 1000
+    # /import でイベントループに制御を返すまでに反映する件数
+    IMPORT_BATCH_SIZE = 10000
+
+    def __init__(self, path, journal_path):
+        self.path = path
+        self.journal_path = journal_path
+        # ユーザーIDは整数の集合、禁止文字列は挿入順を保持するため dict を順序付き集合として使う
+        self.user_ids = UserIdSet(bloom_bits_per_id=user_id_bloom_bits)
+        self.texts = {}
+        # 特定のサーバーのみのエントリ（サーバーID → 集合）
+        self.guild_user_ids = {}
+        self.guild_texts = {}
+        # 内容が変わるたびに増える（キャッシュの再構築判定用）
+        self.version = 0
+        self.texts_version = 0
+        # (TextMatcher, LinkMatcher, RuleMatcher) の組
+        self._matchers = None
+        self._matcher_version = -1
+        # サーバーID → 共通の文字列とそのサーバーのみの文字列を合わせたマッチャー
+        self._guild_matchers = {}
+        # 前回の取り出し以降に追加されたユーザーID（整数）→ 追加元のサーバーID（手動・ファイル編集は None）
+        self._added_users = {}
+        self._stat = None
+        self._last_check = 0.0
+        # まだジャーナルに書き込んでいない変更
+        self._pending = []
+        self._journal_entries = 0
+        self._flush_task = None
+        self._flush_lock = None
+        self.reload()
+
+    def _file_stat(self):
+        # --import など他のプロセスはジャーナル（SQLite では WAL ファイル）に追記するため、両方の変化を見る
+        stats = []
+        for path in (self.path, self.journal_path):
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                stats.append(None)
+                continue
+            stats.append((st.st_mtime_ns, st.st_size))
+        return tuple(stats)
+
+    def _read_journal(self):
+        """ジャーナルの全エントリを読み込む（書き込み途中で壊れた行は無視）"""
+        entries = []
+        try:
+            with open(self.journal_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entries.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        continue
+        except FileNotFoundError:
+            pass
+        return entries
+
+    def _apply(self, entry):
+        """1件の変更をメモリ上のリストに適用する（変更があった場合 True）"""
+        op = entry.get("op")
+        list_type = entry.get("list_type")
+        value = entry.get("value")
+        guild_id = entry.get("guild_id")
+        if list_type == "user":
+            store, scoped = self.user_ids, self.guild_user_ids
+            if guild_id is not None:
+                store = scoped.get(guild_id) or UserIdSet()
+            if op == "add":
+                changed = store.add(value)
+            elif op == "remove":
+                changed = store.discard(value)
+                if changed:
+                    self._added_users.pop(UserIdSet._key(value), None)
+            else:
+                changed = False
+        elif list_type == "text":
+            store, scoped = self.texts, self.guild_texts
+            if guild_id is not None:
+                store = scoped.get(guild_id) or {}
+            changed = (op == "add" and value not in store) or (op == "remove" and value in store)
+            if changed and op == "add":
+                store[value] = None
+            elif changed:
+                del store[value]
+        else:
+            return False
+        if not changed:
+            return False
+        if guild_id is not None:
+            # 空になったサーバーの集合は削除する
+            if store:
+                scoped[guild_id] = store
+            else:
+                scoped.pop(guild_id, None)
+        if list_type == "text":
+            self.texts_version += 1
+        self.version += 1
+        return True
+
+    def _read_snapshot(self):
+        """スナップショット（to_dict と同じ形式）とジャーナルのエントリを読み込む"""
+        return load_ban_list(self.path), self._read_journal()
+
+    def reload(self):
+        """スナップショットを読み込み、ジャーナルを再適用する"""
+        stat = self._file_stat()
+        try:
+            data, journal = self._read_snapshot()
+            self._install(data, journal, stat)
+        except (OSError, sqlite3.Error, ValueError, TypeError) as e:
+            # 手動編集の途中などで壊れている場合は現在の内容を維持（JSONDecodeError は ValueError）
+            logger.warning("バンリストの読み込みに失敗しました（現在の内容を維持）: %s", e)
+            self._stat = stat
+            return False
+        return True
+
+    def _install(self, data, journal, stat):
+        """読み込んだ内容でメモリ上のリストを置き換える（不正な内容なら何も変えずに ValueError）"""
+        previous_user_ids = self.user_ids
+        first_load = not self.version
+        # 途中で不正な値が見つかっても元の内容が残るように、すべて作ってから置き換える
+        user_ids = UserIdSet(data.get("user_ids", []), bloom_bits_per_id=user_id_bloom_bits)
+        texts = dict.fromkeys(data.get("texts", []))
+        guild_user_ids = {}
+        guild_texts = {}
+        for guild_id, scoped in data.get("guilds", {}).items():
+            if scoped.get("user_ids"):
+                guild_user_ids[int(guild_id)] = UserIdSet(scoped["user_ids"])
+            if scoped.get("texts"):
+                guild_texts[int(guild_id)] = dict.fromkeys(scoped["texts"])
+        for id_set in chain([user_ids], guild_user_ids.values()):
+            invalid = id_set.invalid_ids()
+            if invalid:
+                raise ValueError(f"不正なユーザーID {len(invalid)}件（例: {invalid[0]!r}）")
+        self.user_ids = user_ids
+        self.texts = texts
+        self.guild_user_ids = guild_user_ids
+        self.guild_texts = guild_texts
+        self._journal_entries = len(journal)
+        # 未書き込みの変更も失わないように最後に適用する
+        for entry in journal + self._pending:
+            self._apply(entry)
+        if not first_load:
+            # ファイルの手動編集で増えたIDも差分チェックの対象にする
+            for user_id in self.user_ids.difference(previous_user_ids):
+                if type(user_id) is int:
+                    self._added_users.setdefault(user_id, None)
+        self._stat = stat
+        self.version += 1
+        self.texts_version += 1
+
+    def invalidate_matchers(self):
+        """マッチャーと判定結果のキャッシュを作り直させる（リストの内容は変えない）"""
+        self.texts_version += 1
+        self.version += 1
+
+    def reload_if_changed(self):
+        """ファイルの mtime/サイズが変わっていれば読み込み直す"""
+        now = time.monotonic()
+        if now - self._last_check < self.RELOAD_CHECK_INTERVAL:
+            return False
+        self._last_check = now
+        if self._file_stat() == self._stat:
+            return False
+        logger.info("バンリストの変更を検知したため再読み込みします")
+        return self.reload()
+
+    def _record(self, entry):
+        """変更を記録し、少し待ってからまとめてジャーナルに書き込む"""
+        self._pending.append(entry)
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # イベントループ外（起動前など）ではその場で書き込む
+            self.flush_sync()
+            return
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = loop.create_task(self._delayed_flush())
+
+    async def _delayed_flush(self):
+        # 書き込み中に記録された変更は、このタスクが終わるまで新しいタスクを作らないので続けて書き込む
+        while self._pending:
+            await asyncio.sleep(self.JOURNAL_FLUSH_DELAY)
+            await self.flush()
+
+    def _append_journal(self, entries):
+        with open(self.journal_path, "a", encoding="utf-8") as f:
+            for entry in entries:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _write_snapshot(self, snapshot):
+        """スナップショットを書き込み、ジャーナルを空にする"""
+        save_ban_list(snapshot, self.path)
+        # 置き換えが完了してから消す（途中で落ちても再適用で同じ結果になる）
+        with open(self.journal_path, "w", encoding="utf-8"):
+            pass
+
+    async def flush(self, compact=False):
+        """未書き込みの変更をジャーナルに書き込み、必要なら圧縮する"""
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        async with self._flush_lock:
+            if self._file_stat() != self._stat:
+                # 他のプロセスの変更を取り込んでから書き込む（圧縮で消さないように）
+                logger.info("他のプロセスによるバンリストの変更を取り込みます")
+                self.reload()
+            entries, self._pending = self._pending, []
+            if entries:
+                await asyncio.to_thread(self._append_journal, entries)
+                self._journal_entries += len(entries)
+                self._stat = self._file_stat()
+            if self._journal_entries and (compact or self._journal_entries >= self.JOURNAL_COMPACT_THRESHOLD):
+                # 未書き込みの変更が含まれていても、再適用は冪等なので問題ない
+                snapshot = self.to_dict()
+                await asyncio.to_thread(self._write_snapshot, snapshot)
+                self._journal_entries = 0
+                # 自分自身の書き込みで再読み込みが走らないようにする
+                self._stat = self._file_stat()
+
+    def flush_sync(self, compact=False):
+        """イベントループ外から未書き込みの変更を書き込む"""
+        entries, self._pending = self._pending, []
+        if entries:
+            self._append_journal(entries)
+            self._journal_entries += len(entries)
+        if compact and self._journal_entries:
+            # 起動中の BOT が追記した分も読み込み直してから、スナップショットを置き換える
+            self.reload()
+            self._write_snapshot(self.to_dict())
+            self._journal_entries = 0
+        self._stat = self._file_stat()
+
+    def to_dict(self):
+        data = {
+            "user_ids": [str(user_id) for user_id in self.user_ids],
+            "texts": list(self.texts)
+        }
+        guilds = {}
+        for guild_id in self.guild_user_ids.keys() | self.guild_texts.keys():
+            guilds[str(guild_id)] = {
+                "user_ids": [str(user_id) for user_id in self.guild_user_ids.get(guild_id, ())],
+                "texts": list(self.guild_texts.get(guild_id, ())),
+            }
+        if guilds:
+            data["guilds"] = guilds
+        return data
+
+    @staticmethod
+    def _build_matchers(patterns):
+        """禁止文字列をルール（正規表現など）・リンク（ドメイン・招待リンク）・それ以外に分けてマッチャーを作る"""
+        links = LinkMatcher()
+        rules = []
+        texts = []
+        for pattern in patterns:
+            if rule_kind(pattern):
+                rules.append(pattern)
+            elif not links.add(pattern):
+                texts.append(pattern)
+        return TextMatcher(texts, normalize_text), links, RuleMatcher(rule_verifier.verified(rules))
+
+    def _matchers_for(self, guild_id):
+        """(TextMatcher, LinkMatcher, RuleMatcher) を返す（文字列リストが変わったときのみ再構築）"""
+        self.reload_if_changed()
+        if self._matcher_version != self.texts_version:
+            self._matchers = self._build_matchers(self.texts)
+            self._matcher_version = self.texts_version
+            self._guild_matchers.clear()
+        scoped = self.guild_texts.get(guild_id)
+        if not scoped:
+            return self._matchers
+        matchers = self._guild_matchers.get(guild_id)
+        if matchers is None:
+            # 共通の文字列を先に並べる（検出結果は共通リストを優先）
+            patterns = list(self.texts) + [text for text in scoped if text not in self.texts]
+            matchers = self._guild_matchers[guild_id] = self._build_matchers(patterns)
+        return matchers
+
+    def text_matcher(self, guild_id=None):
+        """禁止文字列（リンク以外）のマッチャーを返す"""
+        return self._matchers_for(guild_id)[0]
+
+    def link_matcher(self, guild_id=None):
+        """禁止ドメイン・招待リンクのマッチャーを返す"""
+        return self._matchers_for(guild_id)[1]
+
+    def rule_matcher(self, guild_id=None):
+        """正規表現・ワイルドカード・単語のルールのマッチャーを返す"""
+        return self._matchers_for(guild_id)[2]
+
+    def pop_added_users(self):
+        """前回の呼び出し以降に追加されたユーザーIDを取り出す"""
+        self.reload_if_changed()
+        added, self._added_users = self._added_users, {}
+        return added
+
+    def has_user(self, user_id, guild_id=None):
+        """全サーバー共通のリスト、または guild_id のサーバーのみのリストに含まれるか"""
+        self.reload_if_changed()
+        if user_id in self.user_ids:
+            return True
+        scoped = self.guild_user_ids.get(guild_id)
+        return scoped is not None and user_id in scoped
+
+    @staticmethod
+    def _entry(op, list_type, value, guild_id=None, added_by=None, reason=None):
+        entry = {"op": op, "list_type": list_type, "value": value}
+        if guild_id is not None:
+            entry["guild_id"] = guild_id
+        if op == "add":
+            entry["added_at"] = time.time()
+            if added_by is not None:
+                entry["added_by"] = added_by
+            if reason:
+                entry["reason"] = reason
+        return entry
+
+    def add_user(self, user_id, origin_guild_id=None, guild_id=None, added_by=None, reason=None):
+        """ユーザーIDを追加（追加した場合 True）
+
+        origin_guild_id は検知したサーバー（そこでは処罰済み）、guild_id は
+        登録先のサーバー（None なら全サーバー共通）。
+        """
+        user_id = str(user_id)
+        if not (user_id.isascii() and user_id.isdigit()):
+            raise ValueError(f"ユーザーIDは数字で指定してください: {user_id!r}")
+        entry = self._entry("add", "user", user_id, guild_id, added_by, reason)
+        if not self._apply(entry):
+            return False
+        key = UserIdSet._key(user_id)
+        if key is not None:
+            self._added_users[key] = origin_guild_id
+        self._record(entry)
+        return True
+
+    def remove_user(self, user_id, guild_id=None):
+        """ユーザーIDを削除（削除した場合 True）"""
+        entry = self._entry("remove", "user", str(user_id), guild_id)
+        if not self._apply(entry):
+            return False
+        self._record(entry)
+        return True
+
+    def add_text(self, text, guild_id=None, added_by=None, reason=None):
+        """禁止文字列を追加（追加した場合 True）"""
+        entry = self._entry("add", "text", text, guild_id, added_by, reason)
+        if not self._apply(entry):
+            return False
+        self._record(entry)
+        return True
+
+    def remove_text(self, text, guild_id=None):
+        """禁止文字列を削除（削除した場合 True）"""
+        entry = self._entry("remove", "text", text, guild_id)
+        if not self._apply(entry):
+            return False
+        self._record(entry)
+        return True
+
+    async def lookup_user(self, user_id):
+        """ユーザーIDの登録先（None は全サーバー共通）と追加者・日時・理由を返す"""
+        entries = []
+        if user_id in self.user_ids:
+            entries.append({"guild_id": None, "added_by": None, "added_at": None, "reason": None})
+        for guild_id, scoped in self.guild_user_ids.items():
+            if user_id in scoped:
+                entries.append({"guild_id": guild_id, "added_by": None, "added_at": None, "reason": None})
+        return entries
+
+    def import_entries(self, entries, added_by=None, reason=None, guild_id=None, server_only=False):
+        """(種類, 値, サーバーID) の列を追加し、まとめて1回で書き込む（ImportSummary を返す）
+
+        guild_id を指定すると、サーバーのみのエントリはすべてそのサーバーに登録する
+        （server_only なら全サーバー共通のエントリも）。
+        """
+        summary = ImportSummary()
+        try:
+            self._import_batch(entries, summary, added_by, reason, guild_id, server_only)
+        finally:
+            # 途中で読み取りに失敗しても、メモリに反映済みの分は保存する
+            self._write_imported(summary)
+        return summary
+
+    def _import_batch(self, entries, summary, added_by, reason, guild_id, server_only):
+        for list_type, value, entry_guild_id in entries:
+            if list_type is None:
+                summary.invalid += 1
+                continue
+            if guild_id is not None and (server_only or entry_guild_id is not None):
+                entry_guild_id = guild_id
+            # 登録済みのものとファイル内の重複は _apply が False を返す
+            entry = self._entry("add", list_type, value, entry_guild_id, added_by, reason)
+            if not self._apply(entry):
+                summary.duplicates += 1
+                continue
+            summary.applied.append(entry)
+            if list_type == "user":
+                key = UserIdSet._key(value)
+                if key is not None:
+                    self._added_users[key] = None
+                summary.users += 1
+            else:
+                summary.texts += 1
+
+    def _write_imported(self, summary):
+        # 1件ずつではなく、まとめて1回で書き込む
+        if summary.applied:
+            self._pending.extend(summary.applied)
+            summary.applied = []
+            self._schedule_flush()
+
+    @staticmethod
+    def _open_import(path, fmt, name):
+        f = open(path, "r", encoding="utf-8-sig", newline="")
+        if fmt is None:
+            fmt = detect_format(name or path, f.read(4096))
+            f.seek(0)
+        return f, iter_import_entries(f, fmt)
+
+    @staticmethod
+    def _read_batch(entries, size):
+        """最大 size 件を読み込む（読み取りに失敗したら、それまでの分とエラーを返す）"""
+        batch = []
+        try:
+            batch.extend(islice(entries, size))
+        except ValueError as e:
+            return batch, e
+        return batch, None
+
+    def import_file(self, path, fmt=None, name=None, added_by=None, reason=None, guild_id=None, server_only=False):
+        """ファイルを全体を読み込まずに1件ずつ取り込む（形式の省略時は name・内容から判定）"""
+        f, entries = self._open_import(path, fmt, name)
+        with f:
+            return self.import_entries(entries, added_by, reason, guild_id, server_only)
+
+    async def import_file_async(self, path, fmt=None, name=None, added_by=None, reason=None, guild_id=None, server_only=False):
+        """import_file と同じ（解析は別スレッドで行い、反映は一定件数ごとにイベントループに制御を返す）"""
+        summary = ImportSummary()
+        f, entries = await asyncio.to_thread(self._open_import, path, fmt, name)
+        try:
+            while True:
+                batch, error = await asyncio.to_thread(self._read_batch, entries, self.IMPORT_BATCH_SIZE)
+                self._import_batch(batch, summary, added_by, reason, guild_id, server_only)
+                if error is not None:
+                    raise error
+                if not batch:
+                    break
+        finally:
+            f.close()
+            self._write_imported(summary)
+        return summary
+
+    def import_data(self, data, added_by=None, reason=None):
+        """to_dict（ban_list.json）と同じ形式のデータを追加する（ImportSummary を返す）"""
+        scopes = [(None, data)]
+        scopes += [(int(guild_id), scoped) for guild_id, scoped in data.get("guilds", {}).items()]
+        entries = (
+            (list_type, str(value), guild_id)
+            for guild_id, scoped in scopes
+            for list_type, key in (("user", "user_ids"), ("text", "texts"))
+            for value in scoped.get(key, [])
+        )
+        return self.import_entries(entries, added_by, reason)
+
+    def export_scopes(self, guild_ids=None):
+        """書き出し用に (サーバーID, ユーザーID, 禁止文字列) の複製を返す（全サーバー共通が先頭）
+
+        guild_ids を指定すると、そのサーバーのみのエントリだけを含める。複製なので別スレッドで書き出してよい。
+        """
+        self.reload_if_changed()
+        scopes = [(None, self.user_ids.copy(), list(self.texts))]
+        for scoped_guild_id in sorted(self.guild_user_ids.keys() | self.guild_texts.keys()):
+            if guild_ids is not None and scoped_guild_id not in guild_ids:
+                continue
+            scopes.append((
+                scoped_guild_id,
+                self.guild_user_ids.get(scoped_guild_id, UserIdSet()).copy(),
+                list(self.guild_texts.get(scoped_guild_id, ())),
+            ))
+        return scopes
+
+    def export_file(self, path, fmt="json", scopes=None):
+        """現在の内容を指定の形式で書き出す（一時ファイルに書き込んでから置き換える）"""
+        if scopes is None:
+            scopes = self.export_scopes()
+        temp_path = path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8", newline="") as f:
+            write_export(f, fmt, scopes)
+        os.replace(temp_path, path)
+
+
+class SqliteBanList(BanList):
+    """SQLite（WAL モード）に保存するバンリスト
+
+    判定は BanList と同じくメモリ上で行い、データベースの読み書きは
+    別スレッドで行う。ユーザーIDは整数、登録先のサーバー（0 は全サーバー
+    共通）・追加者・日時・理由も保存する。初回起動時は ban_list.json と
+    ジャーナルの内容を取り込む。
+    """
+
+    SCHEMA_VERSION = 1
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS banned_users (
+            id INTEGER PRIMARY KEY,
+            guild_id INTEGER NOT NULL DEFAULT 0,
+            user_id INTEGER NOT NULL,
+            added_by INTEGER,
+            added_at REAL NOT NULL,
+            reason TEXT,
+            -- user_id が先頭なので、登録先を問わない検索にもこのインデックスを使える
+            UNIQUE (user_id, guild_id)
+        );
+        CREATE TABLE IF NOT EXISTS banned_texts (
+            id INTEGER PRIMARY KEY,
+            guild_id INTEGER NOT NULL DEFAULT 0,
+            pattern TEXT NOT NULL,
+            added_by INTEGER,
+            added_at REAL NOT NULL,
+            reason TEXT,
+            UNIQUE (guild_id, pattern)
+        );
+    """
+
+    def __init__(self, db_path, json_path=BAN_LIST_FILE, json_journal_path=BAN_LIST_JOURNAL_FILE):
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        # 別スレッドからの読み書きが重ならないようにする
+        self._db_lock = threading.Lock()
+        self._reload_task = None
+        with self._db_lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            # 大量の取り込み時にインデックスのページを読み直さないよう、キャッシュを大きめにする（16MiB）
+            self._conn.execute("PRAGMA cache_size=-16384")
+            self._conn.executescript(self.SCHEMA)
+            new_database = self._conn.execute("PRAGMA user_version").fetchone()[0] == 0
+        if new_database:
+            self._migrate_from_json(db_path, json_path, json_journal_path)
+        super().__init__(db_path, db_path + "-wal")
+
+    def _migrate_from_json(self, db_path, json_path, json_journal_path):
+        """ban_list.json（DEFAULT_BAN_LIST 形式）とジャーナルの内容を取り込む"""
+        source = BanList(json_path, json_journal_path)
+        data = source.to_dict()
+        entries = []
+        scopes = [(None, data)] + [(int(guild_id), scoped) for guild_id, scoped in data.get("guilds", {}).items()]
+        for guild_id, scoped in scopes:
+            entries += [self._entry("add", "user", user_id, guild_id) for user_id in scoped.get("user_ids", [])]
+            entries += [self._entry("add", "text", text, guild_id) for text in scoped.get("texts", [])]
+        self._write_entries(entries)
+        with self._db_lock, self._conn:
+            self._conn.execute(f"PRAGMA user_version={self.SCHEMA_VERSION}")
+        if entries:
+            logger.info("%s の %s件を %s に移行しました", json_path, len(entries), db_path)
+
+    @staticmethod
+    def _db_user_id(value):
+        # SQLite の INTEGER は符号付き64ビット（それ以外は文字列のまま保存）
+        value = str(value)
+        return int(value) if value.isdigit() and int(value) < 2**63 else value
+
+    def _read_snapshot(self):
+        data = {"user_ids": [], "texts": []}
+        guilds = {}
+        with self._db_lock:
+            rows = self._conn.execute("SELECT guild_id, user_id FROM banned_users ORDER BY id").fetchall()
+            text_rows = self._conn.execute("SELECT guild_id, pattern FROM banned_texts ORDER BY id").fetchall()
+        for guild_id, user_id in rows:
+            target = data if not guild_id else guilds.setdefault(str(guild_id), {"user_ids": [], "texts": []})
+            target["user_ids"].append(user_id)
+        for guild_id, pattern in text_rows:
+            target = data if not guild_id else guilds.setdefault(str(guild_id), {"user_ids": [], "texts": []})
+            target["texts"].append(pattern)
+        if guilds:
+            data["guilds"] = guilds
+        return data, []
+
+    def reload_if_changed(self):
+        """別プロセスからの書き込みを検知したら、別スレッドで読み込み直す"""
+        now = time.monotonic()
+        if now - self._last_check < self.RELOAD_CHECK_INTERVAL:
+            return False
+        self._last_check = now
+        if self._file_stat() == self._stat:
+            return False
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            logger.info("バンリストの変更を検知したため再読み込みします")
+            return self.reload()
+        if self._reload_task is None or self._reload_task.done():
+            logger.info("バンリストの変更を検知したため再読み込みします")
+            self._reload_task = loop.create_task(self._reload_async())
+        return False
+
+    async def _reload_async(self):
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        # 書き込み中の変更を読み込み結果で上書きしないよう、書き込みと排他にする
+        async with self._flush_lock:
+            stat = self._file_stat()
+            try:
+                data, journal = await asyncio.to_thread(self._read_snapshot)
+            except sqlite3.Error as e:
+                logger.warning("バンリストの読み込みに失敗しました（現在の内容を維持）: %s", e)
+                self._stat = stat
+                return
+            self._install(data, journal, stat)
+
+    def _write_entries(self, entries):
+        """変更を1つのトランザクションで書き込む（同じ種類の連続した変更はまとめて実行）"""
+        with self._db_lock, self._conn:
+            for (op, list_type), group in groupby(entries, key=lambda entry: (entry["op"], entry["list_type"])):
+                table, column = ("banned_users", "user_id") if list_type == "user" else ("banned_texts", "pattern")
+                convert = self._db_user_id if list_type == "user" else str
+                if op == "add":
+                    self._conn.executemany(
+                        f"INSERT OR IGNORE INTO {table} (guild_id, {column}, added_by, added_at, reason) VALUES (?, ?, ?, ?, ?)",
+                        [
+                            (entry.get("guild_id") or 0, convert(entry["value"]), entry.get("added_by"),
+                             entry.get("added_at", time.time()), entry.get("reason"))
+                            for entry in group
+                        ],
+                    )
+                else:
+                    self._conn.executemany(
+                        f"DELETE FROM {table} WHERE guild_id = ? AND {column} = ?",
+                        [(entry.get("guild_id") or 0, convert(entry["value"])) for entry in group],
+                    )
+
+    def _checkpoint(self):
+        with self._db_lock:
+            self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    async def flush(self, compact=False):
+        """未書き込みの変更をデータベースに書き込む（compact なら WAL をまとめる）"""
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        async with self._flush_lock:
+            entries, self._pending = self._pending, []
+            if entries:
+                await asyncio.to_thread(self._write_entries, entries)
+            if compact:
+                await asyncio.to_thread(self._checkpoint)
+            # 自分自身の書き込みで再読み込みが走らないようにする
+            self._stat = self._file_stat()
+
+    def flush_sync(self, compact=False):
+        """イベントループ外から未書き込みの変更を書き込む"""
+        entries, self._pending = self._pending, []
+        if entries:
+            self._write_entries(entries)
+        if compact:
+            self._checkpoint()
+        self._stat = self._file_stat()
+
+    def _query_user(self, user_id):
+        with self._db_lock:
+            return self._conn.execute(
+                "SELECT guild_id, added_by, added_at, reason FROM banned_users WHERE user_id = ? ORDER BY id",
+                (self._db_user_id(user_id),),
+            ).fetchall()
+
+    async def lookup_user(self, user_id):
+        rows = await asyncio.to_thread(self._query_user, user_id)
+        return [
+            {"guild_id": guild_id or None, "added_by": added_by, "added_at": added_at, "reason": reason}
+            for guild_id, added_by, added_at, reason in rows
+        ]
+
+
+# メモリ常駐のバンリスト（起動時に一度だけ読み込む）
+if ban_list_backend == "sqlite":
+    ban_list = SqliteBanList(ban_list_db)
+else:
+    ban_list = BanList(BAN_LIST_FILE, BAN_LIST_JOURNAL_FILE)
+
+
+class GuildConfigStore:
+    """サーバーごとの設定（未設定の項目は config.json の全体設定を使う）"""
+
+    KEYS = (
+        "log_channel_id", "danger_role_id", "admin_role_ids", "default_punishment", "timeout_duration_minutes",
+        "federation",
+    )
+
+    def __init__(self, data, defaults):
+        # {"<サーバーID>": {"log_channel_id": ..., ...}} の形式で config.json の "guilds" に保存する
+        self.guilds = {int(guild_id): dict(settings) for guild_id, settings in (data or {}).items()}
+        self.defaults = defaults
+        # 設定を変更するたびに増やす（ルールの再構築が必要かの判定に使う）
+        self.versions = {}
+
+    def get(self, guild_id, key):
+        settings = self.guilds.get(guild_id)
+        if settings is not None and key in settings:
+            return settings[key]
+        return self.defaults[key]
+
+    def set(self, guild_id, key, value):
+        if key not in self.KEYS:
+            raise KeyError(key)
+        self.guilds.setdefault(guild_id, {})[key] = value
+        self.versions[guild_id] = self.versions.get(guild_id, 0) + 1
+
+    def version(self, guild_id):
+        return self.versions.get(guild_id, 0)
+
+    def to_dict(self):
+        return {str(guild_id): settings for guild_id, settings in self.guilds.items() if settings}
+
+
+guild_configs = GuildConfigStore(config.get("guilds"), {
+    "log_channel_id": log_channel_id,
+    "danger_role_id": danger_role_id,
+    "admin_role_ids": admin_role_ids,
+    "default_punishment": default_punishment,
+    "timeout_duration_minutes": timeout_duration_minutes,
+    "federation": federation_enabled,
+})
+
+
+class GuildRules:
+    """サーバーごとの判定ルール（設定かバンリストが変わるまで使い回す）"""
+
+    __slots__ = (
+        "config_version", "list_version", "matcher", "links", "rules", "user_ids", "guild_user_ids", "admin_roles",
+        "log_channel_id", "danger_role_id", "punishment", "timeout_minutes", "federation",
+    )
+
+    def __init__(self, guild_id):
+        self.config_version = guild_configs.version(guild_id)
+        self.list_version = ban_list.version
+        self.matcher = ban_list.text_matcher(guild_id)
+        self.links = ban_list.link_matcher(guild_id)
+        self.rules = ban_list.rule_matcher(guild_id)
+        self.user_ids = ban_list.user_ids
+        self.guild_user_ids = ban_list.guild_user_ids.get(guild_id, ())
+        self.admin_roles = frozenset(guild_configs.get(guild_id, "admin_role_ids"))
+        self.log_channel_id = guild_configs.get(guild_id, "log_channel_id")
+        self.danger_role_id = guild_configs.get(guild_id, "danger_role_id")
+        punishment = guild_configs.get(guild_id, "default_punishment")
+        self.punishment = punishment if punishment in ("ban", "kick", "timeout") else "ban"
+        self.timeout_minutes = guild_configs.get(guild_id, "timeout_duration_minutes")
+        self.federation = bool(guild_configs.get(guild_id, "federation"))
+
+    def has_user(self, user_id):
+        return user_id in self.user_ids or user_id in self.guild_user_ids
+
+
+# サーバーID → GuildRules（最初のイベントで作成）
+guild_rules = {}
+
+
+def rules_for(guild_id):
+    """サーバーのルールを返す（設定かバンリストが変わったときだけ作り直す）"""
+    ban_list.reload_if_changed()
+    rules = guild_rules.get(guild_id)
+    if (
+        rules is None
+        or rules.config_version != guild_configs.version(guild_id)
+        or rules.list_version != ban_list.version
+    ):
+        rules = guild_rules[guild_id] = GuildRules(guild_id)
+    return rules
+
+
+def save_config():
+    """設定を保存する"""
+    config["log_channel_id"] = log_channel_id
+    config["danger_role_id"] = danger_role_id
+    config["admin_role_ids"] = admin_role_ids
+    config["default_punishment"] = default_punishment
+    config["timeout_duration_minutes"] = timeout_duration_minutes
+    config["guilds"] = guild_configs.to_dict()
+    with open(CONFIG_FILE, "w", encoding="utf-8") as f:
+        json.dump(config, f, ensure_ascii=False, indent=2)
+
+
+class UserInfoCache:
+    """ログ表示用のユーザー名キャッシュ（件数上限と有効期限つき）"""
+
+    MAX_SIZE = 10000
+    TTL = 3600.0
+
+    def __init__(self):
+        # ユーザーID → (表示名, 有効期限)
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def remember(self, user):
+        """メンバーやメッセージ作成者の名前を記録する"""
+        self._entries[user.id] = (user.name, time.monotonic() + self.TTL)
+        self._entries.move_to_end(user.id)
+        while len(self._entries) > self.MAX_SIZE:
+            self._entries.popitem(last=False)
+
+    def name(self, user_id):
+        """表示名を返す（キャッシュになければゲートウェイのキャッシュを参照し、RESTは使わない）"""
+        entry = self._entries.get(user_id)
+        if entry and entry[1] > time.monotonic():
+            self.hits += 1
+            return entry[0]
+        user = bot.get_user(user_id)
+        if user:
+            self.hits += 1
+            self.remember(user)
+            return user.name
+        self.misses += 1
+        self._entries.pop(user_id, None)
+        return "不明なユーザー"
+
+    def __len__(self):
+        return len(self._entries)
+
+
+user_info_cache = UserInfoCache()
+
+
+def describe_user(user_id):
+    """ログ用に「名前 (ID: ...)」の形式で返す"""
+    return f"{user_info_cache.name(user_id)} (ID: {user_id})"
+
+
+class DedupStore:
+    """件数上限（LRU）と有効期限つきの処理済み記録（すべての操作が O(1)）
+
+    キーはサーバーID・ユーザーID・アクション種別を1つの整数にまとめたもの。
+    有効期限は全キー共通なので、最後に使われた順に並べれば期限切れの順にもなる。
+    """
+
+    # アクション種別（文字列）→ 8ビットの番号
+    _action_codes = {}
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # キー → 有効期限（古い順）
+        self._entries = OrderedDict()
+        self.evicted = 0
+        self.expired = 0
+
+    @classmethod
+    def make_key(cls, guild_id, user_id, action_type):
+        code = cls._action_codes.get(action_type)
+        if code is None:
+            code = cls._action_codes[action_type] = len(cls._action_codes) & 0xFF
+        return (guild_id << 72) | (user_id << 8) | code
+
+    def _expire(self, now):
+        entries = self._entries
+        while entries:
+            _, expires_at = next(iter(entries.items()))
+            if expires_at > now:
+                break
+            entries.popitem(last=False)
+            self.expired += 1
+
+    def __contains__(self, key):
+        expires_at = self._entries.get(key)
+        if expires_at is None:
+            return False
+        now = time.monotonic()
+        if expires_at <= now:
+            del self._entries[key]
+            self.expired += 1
+            return False
+        # 使われたキーは期限を延ばして末尾へ
+        self._entries[key] = now + self.ttl
+        self._entries.move_to_end(key)
+        return True
+
+    def add(self, key):
+        now = time.monotonic()
+        self._entries[key] = now + self.ttl
+        self._entries.move_to_end(key)
+        self._expire(now)
+        # 上限を超えたら最も長く使われていないものから削除
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evicted += 1
+
+    def keys(self):
+        """古い順にキーを返す"""
+        return list(self._entries)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# 処理済みのログを記録（ログの重複送信を防ぐ）
+processed_users = DedupStore(dedup_max_entries, dedup_ttl_minutes * 60)
+
+
+async def get_log_channel(guild):
+    """ログチャンネルを取得"""
+    log_channel_id = rules_for(guild.id).log_channel_id
+    if log_channel_id:
+        try:
+            channel = guild.get_channel(log_channel_id)
+            if channel:
+                return channel
+        except:
+            pass
+    return None
+
+
+async def assign_danger_role(member):
+    """危険な人にロールを付与（ロール付与できない問題を解決）"""
+    danger_role_id = rules_for(member.guild.id).danger_role_id
+    if not danger_role_id:
+        return False
+    
+    try:
+        # メンバーがサーバーに存在するか確認
+        if not isinstance(member, discord.Member):
+            logger.warning("メンバーオブジェクトが無効です")
+            return False
+        
+        # ロールを取得
+        role = member.guild.get_role(danger_role_id)
+        if not role:
+            logger.warning("ロールID %s が見つかりません", danger_role_id)
+            return False
+        
+        # 既にロールを持っているか確認
+        if role in member.roles:
+            return True  # 既に付与されている
+        
+        # BOTのロール位置を確認
+        bot_member = member.guild.get_member(bot.user.id)
+        if bot_member:
+            bot_top_role = bot_member.top_role
+            if bot_top_role.position <= role.position:
+                logger.warning(
+                    "BOTのロール位置が対象ロールより下です（BOT: %s / 対象: %s）。BOTのロールを対象ロールより上に配置してください",
+                    bot_top_role.position, role.position,
+                    extra={"guild_id": member.guild.id, "role_id": role.id},
+                )
+                # それでも試行（権限があれば成功する可能性がある）
+        
+        # ロールを付与
+        count_rest("add_roles")
+        await member.add_roles(role, reason="荒らし対策：危険ユーザーとして検知")
+        logger.info("ユーザー %s (ID: %s) にロール %s を付与しました", member.name, member.id, role.name)
+        return True
+        
+    except discord.errors.Forbidden as e:
+        # 同じ原因で繰り返し失敗するため、内容は1件にまとめる（繰り返しは RepeatFilter が集約）
+        logger.warning(
+            "ロール付与の権限がありません: %s（「ロールの管理」権限、BOTのロール位置、サーバーの権限設定を確認してください）",
+            e, extra={"guild_id": member.guild.id, "user_id": member.id},
+        )
+        return False
+    except discord.errors.HTTPException as e:
+        logger.error("ロール付与でHTTPエラーが発生: %s", e)
+        return False
+    except Exception as e:
+        logger.error("ロール付与エラー: %s: %s", type(e).__name__, e)
+        return False
+
+
+class LogSink:
+    """ログチャンネルへの送信をサーバーごとにまとめる（検知順を維持）"""
+
+    # 1メッセージあたりの埋め込み数・文字数の上限（Discord の制限）
+    MAX_EMBEDS = 10
+    MAX_MESSAGE_CHARS = 6000
+    MAX_DESCRIPTION_CHARS = 4000
+
+    def __init__(self):
+        # サーバーID → 送信待ちのログ
+        self.buffers = {}
+        self.full_events = {}
+        self.tasks = {}
+        self.sent_messages = 0
+        self.dropped = 0
+
+    def add(self, guild, entry):
+        buffer = self.buffers.setdefault(guild.id, deque())
+        buffer.append(entry)
+        event = self.full_events.setdefault(guild.id, asyncio.Event())
+        if len(buffer) >= self.MAX_EMBEDS:
+            event.set()
+        if guild.id not in self.tasks:
+            self.tasks[guild.id] = asyncio.create_task(self._run(guild))
+
+    async def _run(self, guild):
+        buffer = self.buffers[guild.id]
+        event = self.full_events[guild.id]
+        try:
+            while buffer:
+                # 埋め込みの上限に達するか、一定時間が経ったら送信
+                if len(buffer) < self.MAX_EMBEDS:
+                    try:
+                        await asyncio.wait_for(event.wait(), log_flush_interval_ms / 1000)
+                    except asyncio.TimeoutError:
+                        pass
+                event.clear()
+                entries = list(buffer)
+                buffer.clear()
+                await self._send(guild, entries)
+        finally:
+            del self.tasks[guild.id]
+
+    async def _send(self, guild, entries):
+        log_channel = await get_log_channel(guild)
+        if not log_channel:
+            self.dropped += len(entries)
+            return
+        started = time.perf_counter()
+        try:
+            count_rest("send_message")
+            embeds = [build_log_embed(entry) for entry in entries]
+            if len(embeds) <= self.MAX_EMBEDS and sum(len(embed) for embed in embeds) <= self.MAX_MESSAGE_CHARS:
+                await log_channel.send(embeds=embeds)
+            else:
+                # 1メッセージに収まらない分は一覧表とテキストファイルにまとめる
+                await log_channel.send(embed=build_digest_embed(entries), file=build_digest_file(entries))
+            self.sent_messages += 1
+            metrics.inc("log_entries_sent_total", len(entries), guild=guild.id)
+        except Exception as e:
+            retry_after = get_retry_after(e)
+            if retry_after is not None:
+                metrics.inc("rate_limits_total", source="log_sink")
+                # 順序を保つため先頭に戻してから待機
+                self.buffers[guild.id].extendleft(reversed(entries))
+                await asyncio.sleep(retry_after)
+                return
+            self.dropped += len(entries)
+            metrics.inc("log_entries_dropped_total", len(entries), guild=guild.id)
+            logger.error("ログ送信エラー（%s件）: %s", len(entries), e)
+        finally:
+            metrics.observe("log_send_latency_seconds", time.perf_counter() - started)
+
+
+log_sink = LogSink()
+
+
+def build_log_embed(entry):
+    """1件の検知ログの埋め込みを作成"""
+    embed = discord.Embed(
+        title=f"⚠️ {entry['action_type']}",
+        color=discord.Color.red(),
+        timestamp=entry["timestamp"]
+    )
+    embed.add_field(name="ユーザー", value=f"<@{entry['user_id']}> ({entry['user_name']})", inline=False)
+    embed.add_field(name="ユーザーID", value=str(entry["user_id"]), inline=False)
+    embed.add_field(name="理由", value=entry["reason"][:1024], inline=False)
+    if entry["message_content"]:
+        embed.add_field(name="メッセージ内容", value=entry["message_content"][:1000], inline=False)
+    
+    embed.set_footer(text=f"アクション: {entry['action_type']}")
+    return embed
+
+
+def format_log_line(entry):
+    return f"{entry['timestamp']:%H:%M:%S} | {entry['action_type']} | {entry['user_name']} ({entry['user_id']}) | {entry['reason']}"
+
+
+def build_digest_embed(entries):
+    """複数の検知ログを一覧表にまとめた埋め込みを作成"""
+    lines = []
+    length = 0
+    for entry in entries:
+        line = format_log_line(entry)[:200]
+        if length + len(line) + 1 > LogSink.MAX_DESCRIPTION_CHARS - 100:
+            lines.append(f"… 他 {len(entries) - len(lines)}件は添付ファイルを参照")
+            break
+        lines.append(line)
+        length += len(line) + 1
+    embed = discord.Embed(
+        title=f"⚠️ 検知まとめ（{len(entries)}件）",
+        description="```\n" + "\n".join(lines) + "\n```",
+        color=discord.Color.red(),
+        timestamp=entries[-1]["timestamp"]
+    )
+    embed.set_footer(text="全件の詳細は添付ファイルを参照してください")
+    return embed
+
+
+def build_digest_file(entries):
+    """全件の詳細をテキストファイルにまとめる"""
+    blocks = []
+    for entry in entries:
+        block = format_log_line(entry)
+        if entry["message_content"]:
+            block += "\n    メッセージ内容: " + entry["message_content"].replace("\n", "\n    ")
+        blocks.append(block)
+    data = io.BytesIO("\n".join(blocks).encode("utf-8"))
+    return discord.File(data, filename=f"detections_{entries[0]['timestamp']:%Y%m%d_%H%M%S}.txt")
+
+
+async def send_log_once(guild, user, reason, action_type="検知", message_content=None):
+    """ログチャンネルにログを送信（一回のみ、まとめて送信）"""
+    metrics.inc("detections_total", guild=guild.id, type=action_type)
+    # 重複チェック用のキー
+    log_key = DedupStore.make_key(guild.id, user.id, action_type)
+    
+    # 既に処理済みの場合はスキップ
+    if log_key in processed_users:
+        return None
+    
+    log_channel = await get_log_channel(guild)
+    if not log_channel:
+        return None
+
+    log_sink.add(guild, {
+        "action_type": action_type,
+        "user_id": user.id,
+        "user_name": user.name,
+        "reason": reason,
+        "message_content": message_content,
+        "timestamp": datetime.now().astimezone()
+    })
+    
+    # 処理済みとして記録（上限を超えた分は古いものから削除される）
+    processed_users.add(log_key)
+    
+    return True
+
+
+class ExemptCache:
+    """管理者（検知・処罰の対象外）かどうかの判定結果をサーバーごとに記録する"""
+
+    def __init__(self):
+        self.verdicts = {}  # guild_id -> {member_id: 判定結果}
+
+    def reset(self):
+        """全サーバーの判定をやり直す"""
+        self.verdicts.clear()
+
+    def invalidate_guild(self, guild_id):
+        """管理者ロールの設定やロールの権限が変わったサーバーの判定を破棄"""
+        self.verdicts.pop(guild_id, None)
+
+    def invalidate_member(self, guild_id, member_id):
+        """ロールが変わったメンバーの判定を破棄"""
+        guild_verdicts = self.verdicts.get(guild_id)
+        if guild_verdicts:
+            guild_verdicts.pop(member_id, None)
+
+    def is_exempt(self, member):
+        guild_verdicts = self.verdicts.get(member.guild.id)
+        if guild_verdicts is None:
+            guild_verdicts = self.verdicts[member.guild.id] = {}
+        verdict = guild_verdicts.get(member.id)
+        if verdict is None:
+            # 管理者権限、または管理者ロールを1つでも持っているか（ロール一覧は作らずIDで確認）
+            verdict = member.guild_permissions.administrator or any(
+                member.get_role(role_id) is not None for role_id in rules_for(member.guild.id).admin_roles
+            )
+            guild_verdicts[member.id] = verdict
+        return verdict
+
+
+exempt_cache = ExemptCache()
+
+
+async def is_admin(member):
+    """ユーザーが管理者かどうかをチェック"""
+    if not member:
+        return False
+    return exempt_cache.is_exempt(member)
+
+
+async def delete_message(message):
+    """メッセージを削除（失敗しても無視）"""
+    count_rest("delete_message")
+    try:
+        await message.delete()
+    except:
+        pass
+
+
+def get_retry_after(error):
+    """レート制限によるエラーなら待機秒数を返す（それ以外は None）"""
+    if isinstance(error, discord.errors.RateLimited):
+        return error.retry_after
+    if isinstance(error, discord.errors.HTTPException) and error.status == 429:
+        try:
+            return float(error.response.headers.get("Retry-After", 1.0))
+        except (AttributeError, TypeError, ValueError):
+            return 1.0
+    return None
+
+
+async def ban_user(guild, user_id, reason="荒らし対策"):
+    """ユーザーをバンする"""
+    global rest_calls_avoided
+    try:
+        # ユーザーを取得せず、IDだけでバンする
+        rest_calls_avoided += 1
+        count_rest("ban")
+        await guild.ban(discord.Object(id=user_id), reason=reason, delete_message_seconds=0)
+        logger.info("ユーザー %s をバンしました", describe_user(user_id), extra={"guild_id": guild.id, "user_id": user_id})
+        return True
+    except discord.errors.NotFound:
+        logger.warning("ユーザーID %s が見つかりません", user_id, extra={"guild_id": guild.id, "user_id": user_id})
+        return False
+    except discord.errors.Forbidden:
+        logger.warning("ユーザーID %s をバンする権限がありません", user_id, extra={"guild_id": guild.id, "user_id": user_id})
+        return False
+    except Exception as e:
+        # レート制限は処罰キューで待機してから再試行する
+        if get_retry_after(e) is not None:
+            raise
+        logger.error("バンエラー: %s", e, extra={"guild_id": guild.id, "user_id": user_id})
+        return False
+
+
+def can_bulk_ban(guild):
+    """一括バンに必要なサーバー管理の権限があるか（BOT のメンバー情報がない場合は試す）"""
+    me = guild.me
+    return me is None or me.guild_permissions.manage_guild
+
+
+async def bulk_ban_users(guild, user_ids, reason="荒らし対策"):
+    """複数のユーザーを1回のリクエストでバンする（バンできたID, 失敗したID を返す）
+
+    一括バンの権限がない場合は None を返す（呼び出し元で1人ずつバンする）。
+    """
+    try:
+        count_rest("bulk_ban")
+        result = await guild.bulk_ban(
+            [discord.Object(id=user_id) for user_id in user_ids],
+            reason=reason,
+            delete_message_seconds=0
+        )
+    except discord.errors.Forbidden:
+        # 一括バンにはメンバーをBANの権限に加えてサーバー管理の権限が必要
+        logger.warning("一括バンの権限がないため1人ずつバンします（%s人）", len(user_ids), extra={"guild_id": guild.id})
+        return None
+    except Exception as e:
+        # レート制限は処罰キューで待機してから再試行する
+        if get_retry_after(e) is not None:
+            raise
+        logger.error("一括バンエラー: %s", e, extra={"guild_id": guild.id})
+        return [], list(user_ids)
+    return [user.id for user in result.banned], [user.id for user in result.failed]
+
+
+async def kick_user(guild, user_id, reason="荒らし対策"):
+    """ユーザーをキックする"""
+    global rest_calls_avoided
+    try:
+        member = guild.get_member(user_id)
+        if member:
+            count_rest("kick")
+            await member.kick(reason=reason)
+            logger.info("ユーザー %s (ID: %s) をキックしました", member.name, user_id, extra={"guild_id": guild.id, "user_id": user_id})
+            return True
+        else:
+            # メンバーがサーバーに存在しない場合（名前はキャッシュから表示）
+            rest_calls_avoided += 1
+            logger.warning("ユーザー %s はサーバーに存在しません", describe_user(user_id), extra={"guild_id": guild.id, "user_id": user_id})
+            return False
+    except discord.errors.Forbidden:
+        logger.warning("ユーザーID %s をキックする権限がありません", user_id, extra={"guild_id": guild.id, "user_id": user_id})
+        return False
+    except Exception as e:
+        # レート制限は処罰キューで待機してから再試行する
+        if get_retry_after(e) is not None:
+            raise
+        logger.error("キックエラー: %s", e, extra={"guild_id": guild.id, "user_id": user_id})
+        return False
+
+
+async def timeout_user(guild, user_id, duration_minutes, reason="荒らし対策"):
+    """ユーザーをタイムアウトする"""
+    try:
+        member = guild.get_member(user_id)
+        if member:
+            timeout_until = datetime.utcnow() + timedelta(minutes=duration_minutes)
+            count_rest("timeout")
+            await member.timeout(timeout_until, reason=reason)
+            logger.info("ユーザー %s (ID: %s) を %s分間タイムアウトしました", member.name, user_id, duration_minutes, extra={"guild_id": guild.id, "user_id": user_id})
+            return True
+        else:
+            logger.warning("ユーザーID %s はサーバーに存在しません", user_id, extra={"guild_id": guild.id, "user_id": user_id})
+            return False
+    except discord.errors.Forbidden:
+        logger.warning("ユーザーID %s をタイムアウトする権限がありません", user_id, extra={"guild_id": guild.id, "user_id": user_id})
+        return False
+    except Exception as e:
+        # レート制限は処罰キューで待機してから再試行する
+        if get_retry_after(e) is not None:
+            raise
+        logger.error("タイムアウトエラー: %s", e, extra={"guild_id": guild.id, "user_id": user_id})
+        return False
+
+
+async def unban_user(guild, user_id, reason="バン解除"):
+    """ユーザーのバンを解除する"""
+    global rest_calls_avoided
+    try:
+        # ユーザーを取得せず、IDだけでバン解除する
+        rest_calls_avoided += 1
+        count_rest("unban")
+        await guild.unban(discord.Object(id=user_id), reason=reason)
+        logger.info("ユーザー %s のバンを解除しました", describe_user(user_id), extra={"guild_id": guild.id, "user_id": user_id})
+        return True
+    except discord.errors.NotFound:
+        # バンされていない場合もエラーになるが、これは無視
+        logger.warning("ユーザーID %s はバンされていないか、見つかりません", user_id, extra={"guild_id": guild.id, "user_id": user_id})
+        return False
+    except discord.errors.Forbidden:
+        logger.warning("ユーザーID %s のバンを解除する権限がありません", user_id, extra={"guild_id": guild.id, "user_id": user_id})
+        return False
+    except Exception as e:
+        logger.error("バン解除エラー: %s", e, extra={"guild_id": guild.id, "user_id": user_id})
+        return False
+
+
+async def check_user_in_list(user_id, guild=None):
+    """ユーザーIDがリストに含まれているかチェック"""
+    if guild is not None:
+        return rules_for(guild.id).has_user(user_id)
+    return ban_list.has_user(user_id)
+
+
+async def check_text_in_message(message_content, guild=None, embeds=()):
+    """メッセージに禁止文字列・ルール・禁止リンクが含まれているかチェック（リンクは埋め込みも対象）"""
+    if guild is not None:
+        rules = rules_for(guild.id)
+        matcher, rule_matcher, links = rules.matcher, rules.rules, rules.links
+    else:
+        matcher, rule_matcher, links = ban_list.text_matcher(), ban_list.rule_matcher(), ban_list.link_matcher()
+    detected_text = matcher.search(message_content)
+    if detected_text is None and rule_matcher:
+        detected_text = rule_matcher.search(message_content)
+    if detected_text is None and links:
+        detected_text = links.search(f"{message_content}\n{embed_text(embeds)}" if embeds else message_content)
+    if detected_text is not None:
+        return True, detected_text
+    return False, None
+
+
+async def apply_punishment(guild, user_id, reason="荒らし対策"):
+    """設定された処罰方法を適用する"""
+    rules = rules_for(guild.id)
+    punishment = rules.punishment
+    started = time.perf_counter()
+    result = False
+    try:
+        if punishment == "kick":
+            result = await kick_user(guild, user_id, reason)
+        elif punishment == "timeout":
+            result = await timeout_user(guild, user_id, rules.timeout_minutes, reason)
+        else:
+            # デフォルトはバン
+            result = await ban_user(guild, user_id, reason)
+        return result
+    finally:
+        metrics.observe("punishment_latency_seconds", time.perf_counter() - started, type=punishment)
+        metrics.inc("punishments_total", guild=guild.id, type=punishment, result="ok" if result else "failed")
+
+
+class PunishmentQueue:
+    """サーバーごとの処罰キュー（複数ワーカーで実行し、レート制限に応じて待機）"""
+
+    # 連続でレート制限を受けたときの最大待機（秒）
+    MAX_BACKOFF = 30.0
+    # 直近何件の処理時間を統計に使うか
+    LATENCY_SAMPLES = 200
+
+    def __init__(self, guild_id, workers):
+        self.guild_id = guild_id
+        self.queue = asyncio.Queue()
+        # 実行待ち・実行中のユーザーID → (理由, 追加時刻)（重複を防ぐ）
+        self.pending = {}
+        self.backoff = 0.0
+        self.blocked_until = 0.0
+        self.processed = 0
+        self.rate_limited = 0
+        self.latencies = deque(maxlen=self.LATENCY_SAMPLES)
+        # ユーザーID → 結果（成功なら True）を待つ Future のリスト（連携処罰の集計に使う）
+        self.waiters = {}
+        # 一括バンの対象を集めるワーカーは同時に1つだけにする
+        self._collect_lock = asyncio.Lock()
+        self.workers = [asyncio.create_task(self._worker()) for _ in range(max(1, workers))]
+
+    def put(self, user_id, reason, waiter=None):
+        """処罰を追加する（既に待機中なら追加しない）。waiter には完了時に結果を設定する"""
+        if waiter is not None:
+            self.waiters.setdefault(user_id, []).append(waiter)
+        if user_id in self.pending:
+            return False
+        self.pending[user_id] = (reason, time.monotonic())
+        self.queue.put_nowait(user_id)
+        return True
+
+    def _finish(self, user_id, result):
+        """待機中から外し、結果を待っている Future に通知する"""
+        entry = self.pending.pop(user_id, None)
+        for waiter in self.waiters.pop(user_id, ()):
+            if not waiter.done():
+                waiter.set_result(result)
+        return entry
+
+    @property
+    def depth(self):
+        return len(self.pending)
+
+    def latency_percentile(self, percentile):
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percentile))]
+
+    async def _wait_for_rate_limit(self):
+        delay = max(self.blocked_until - time.monotonic(), self.backoff)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def _collect_batch(self):
+        """最初の1件を待ち、その後は短時間だけ追加分を待って一括バンの対象をまとめる"""
+        batch = [await self.queue.get()]
+        if rules_for(self.guild_id).punishment != "ban" or bulk_ban_max_size <= 1:
+            return batch
+        deadline = time.monotonic() + bulk_ban_window_ms / 1000
+        while len(batch) < bulk_ban_max_size:
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _worker(self):
+        while True:
+            async with self._collect_lock:
+                batch = await self._collect_batch()
+            try:
+                if len(batch) > 1 and rules_for(self.guild_id).punishment == "ban":
+                    await self._run_bulk_ban(batch)
+                else:
+                    for user_id in batch:
+                        await self._run(user_id)
+            except Exception as e:
+                logger.error("処罰キューエラー (Guild ID: %s): %s", self.guild_id, e)
+                for user_id in batch:
+                    self._finish(user_id, False)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def _on_rate_limited(self, guild, retry_after, user_ids):
+        """レート制限：全ワーカーを止め、待機時間を伸ばしてから再投入"""
+        self.rate_limited += 1
+        metrics.inc("rate_limits_total", source="punishment_queue")
+        self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+        self.backoff = min(self.MAX_BACKOFF, max(self.backoff * 2, 0.25))
+        logger.warning("レート制限を検知しました (Guild: %s): %.2f秒待機します", guild.name, retry_after)
+        for user_id in user_ids:
+            self.queue.put_nowait(user_id)
+
+    def _on_done(self, user_id, result=True):
+        self.processed += 1
+        self.latencies.append(time.monotonic() - self._finish(user_id, result)[1])
+
+    async def _run(self, user_id):
+        reason = self.pending[user_id][0]
+        await self._wait_for_rate_limit()
+        guild = bot.get_guild(self.guild_id)
+        if guild is None:
+            self._finish(user_id, False)
+            return
+        try:
+            async with punishment_semaphore:
+                result = await apply_punishment(guild, user_id, reason)
+        except Exception as e:
+            retry_after = get_retry_after(e)
+            if retry_after is None:
+                raise
+            self._on_rate_limited(guild, retry_after, [user_id])
+            return
+        # 成功したら待機時間を徐々に戻す
+        self.backoff = self.backoff / 2 if self.backoff > 0.05 else 0.0
+        self._on_done(user_id, result)
+
+    async def _run_bulk_ban(self, user_ids):
+        await self._wait_for_rate_limit()
+        guild = bot.get_guild(self.guild_id)
+        if guild is None:
+            for user_id in user_ids:
+                self._finish(user_id, False)
+            return
+        if not can_bulk_ban(guild):
+            # サーバー管理の権限がない BOT でもバンできるよう1人ずつ処罰する
+            for user_id in user_ids:
+                await self._run(user_id)
+            return
+        # 理由が異なる場合は最初の理由を代表として使い、個別の理由はログに残す
+        reason = self.pending[user_ids[0]][0]
+        started = time.perf_counter()
+        try:
+            async with punishment_semaphore:
+                result = await bulk_ban_users(guild, user_ids, reason)
+        except Exception as e:
+            retry_after = get_retry_after(e)
+            if retry_after is None:
+                raise
+            self._on_rate_limited(guild, retry_after, user_ids)
+            return
+        finally:
+            metrics.observe("punishment_latency_seconds", time.perf_counter() - started, type="bulk_ban")
+        if result is None:
+            for user_id in user_ids:
+                await self._run(user_id)
+            return
+        banned, failed = result
+        self.backoff = self.backoff / 2 if self.backoff > 0.05 else 0.0
+        metrics.inc("punishments_total", len(banned), guild=guild.id, type="bulk_ban", result="ok")
+        metrics.inc("punishments_total", len(failed), guild=guild.id, type="bulk_ban", result="failed")
+        logger.info("一括バン (Guild: %s): 成功 %s人 / 失敗 %s人", guild.name, len(banned), len(failed))
+        for user_id in banned:
+            logger.info("ユーザー %s をバンしました（%s）", describe_user(user_id), self.pending[user_id][0])
+        for user_id in failed:
+            logger.warning("ユーザー %s のバンに失敗しました（%s）", describe_user(user_id), self.pending[user_id][0])
+        failed = set(failed)
+        for user_id in user_ids:
+            if user_id in self.pending:
+                self._on_done(user_id, user_id not in failed)
+
+
+# サーバーID → 処罰キュー
+punishment_queues = {}
+# 全サーバーの処罰キューで共有する同時実行数の制限
+punishment_semaphore = asyncio.Semaphore(max(1, punishment_max_concurrency))
+
+
+def enqueue_punishment(guild, user_id, reason="荒らし対策", waiter=None):
+    """処罰をキューに追加してすぐに戻る（既に待機中なら False）"""
+    queue = punishment_queues.get(guild.id)
+    if queue is None:
+        queue = PunishmentQueue(guild.id, punishment_workers)
+        punishment_queues[guild.id] = queue
+    return queue.put(user_id, reason, waiter)
+
+
+class MemberIndex:
+    """ユーザーID → 参加しているサーバーID の逆引き（メンバーキャッシュから作る）
+
+    大半のユーザーは1つのサーバーにしか参加していないため、その場合は
+    set を作らずサーバーIDの整数だけを保持する。
+    """
+
+    # 作成中にイベントループに制御を返す間隔（メンバー数）
+    YIELD_EVERY = 5000
+
+    def __init__(self):
+        self.guilds = {}
+
+    def add(self, guild_id, user_id):
+        guild_ids = self.guilds.get(user_id)
+        if guild_ids is None:
+            self.guilds[user_id] = guild_id
+        elif type(guild_ids) is int:
+            if guild_ids != guild_id:
+                self.guilds[user_id] = {guild_ids, guild_id}
+        else:
+            guild_ids.add(guild_id)
+
+    def discard(self, guild_id, user_id):
+        guild_ids = self.guilds.get(user_id)
+        if guild_ids is None:
+            return
+        if type(guild_ids) is int:
+            if guild_ids == guild_id:
+                del self.guilds[user_id]
+            return
+        guild_ids.discard(guild_id)
+        if len(guild_ids) == 1:
+            self.guilds[user_id] = next(iter(guild_ids))
+
+    def guilds_of(self, user_id):
+        guild_ids = self.guilds.get(user_id)
+        if guild_ids is None:
+            return ()
+        if type(guild_ids) is int:
+            return (guild_ids,)
+        return tuple(guild_ids)
+
+    async def add_guild(self, guild):
+        for count, member in enumerate(guild.members, 1):
+            self.add(guild.id, member.id)
+            if count % self.YIELD_EVERY == 0:
+                await asyncio.sleep(0)
+
+    def remove_guild(self, guild):
+        for member in guild.members:
+            self.discard(guild.id, member.id)
+
+    async def rebuild(self, guilds):
+        """メンバーキャッシュ全体から作り直す（再接続時も呼ばれる）"""
+        self.guilds = {}
+        for guild in guilds:
+            await self.add_guild(guild)
+
+    def __len__(self):
+        return len(self.guilds)
+
+
+member_index = MemberIndex()
+
+
+class Federation:
+    """連携モード：検知したユーザーを、共通で参加している他のサーバーでも処罰する
+
+    連携を有効にしたサーバー間でのみ行う。実行は各サーバーの処罰キューに任せる
+    （サーバーごとのレート制限と、全サーバー共通の同時実行数の制限を受ける）。
+    結果は検知したサーバーのログチャンネルに1件のレポートとしてまとめて送る。
+    """
+
+    # 連携処罰の記録を保持する最大ユーザー数
+    MAX_RECENT = 10000
+
+    def __init__(self):
+        # ユーザーID → 最後に連携処罰を始めた時刻
+        self.recent = OrderedDict()
+        self.tasks = set()
+        self.reports = 0
+
+    def handled(self, user_id, guild_id):
+        """連携処罰の対象になったばかりのサーバー・ユーザーなら True"""
+        started = self.recent.get(user_id)
+        if started is None or time.monotonic() - started >= federation_cooldown_seconds:
+            return False
+        return rules_for(guild_id).federation
+
+    def propagate(self, origin_guild, user_id, reason):
+        """連携処罰をバックグラウンドで開始する（連携が無効・処理したばかりなら False）"""
+        if not rules_for(origin_guild.id).federation:
+            return False
+        now = time.monotonic()
+        started = self.recent.get(user_id)
+        if started is not None and now - started < federation_cooldown_seconds:
+            return False
+        self.recent[user_id] = now
+        self.recent.move_to_end(user_id)
+        while len(self.recent) > self.MAX_RECENT:
+            self.recent.popitem(last=False)
+        task = asyncio.create_task(self._run(origin_guild, user_id, reason))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return True
+
+    def _targets(self, origin_guild, user_id):
+        targets = []
+        for guild_id in member_index.guilds_of(user_id):
+            if guild_id == origin_guild.id or not rules_for(guild_id).federation:
+                continue
+            guild = bot.get_guild(guild_id)
+            member = guild.get_member(user_id) if guild is not None else None
+            if member is not None:
+                targets.append((guild, member))
+        return targets
+
+    async def _punish(self, guild, member, reason):
+        if await is_admin(member):
+            return "exempt"
+        waiter = asyncio.get_running_loop().create_future()
+        enqueue_punishment(guild, member.id, reason, waiter)
+        try:
+            result = await asyncio.wait_for(waiter, federation_timeout_seconds)
+        except asyncio.TimeoutError:
+            return "timeout"
+        return "ok" if result else "failed"
+
+    async def _run(self, origin_guild, user_id, reason):
+        targets = self._targets(origin_guild, user_id)
+        if not targets:
+            return
+        started = time.perf_counter()
+        federated_reason = f"{reason}（{origin_guild.name} で検知・連携）"[:512]
+        results = await asyncio.gather(
+            *(self._punish(guild, member, federated_reason) for guild, member in targets),
+            return_exceptions=True
+        )
+        outcomes = {"ok": [], "failed": [], "exempt": [], "timeout": []}
+        for (guild, _), result in zip(targets, results):
+            if isinstance(result, Exception):
+                logger.error("連携処罰エラー (Guild: %s): %s", guild.name, result)
+                result = "failed"
+            outcomes[result].append(guild)
+            metrics.inc("federation_actions_total", result=result)
+        self.reports += 1
+        self._report(origin_guild, user_id, reason, outcomes, time.perf_counter() - started)
+
+    def _report(self, origin_guild, user_id, reason, outcomes, elapsed):
+        """結果を検知したサーバーのログチャンネルに1件にまとめて送る"""
+        labels = {"ok": "成功", "failed": "失敗", "exempt": "対象外（管理者）", "timeout": "応答なし"}
+        total = sum(len(guilds) for guilds in outcomes.values())
+        summary = " / ".join(f"{labels[key]} {len(guilds)}" for key, guilds in outcomes.items() if guilds)
+        logger.info(
+            "連携処罰: %sサーバー（%s）%.1f秒", total, summary, elapsed,
+            extra={"guild_id": origin_guild.id, "user_id": user_id}
+        )
+        # 失敗したサーバーを優先して一覧にする
+        lines = [
+            f"{labels[key]}: {guild.name}"
+            for key in ("failed", "timeout", "exempt", "ok")
+            for guild in outcomes[key]
+        ]
+        log_sink.add(origin_guild, {
+            "action_type": "連携処罰",
+            "user_id": user_id,
+            "user_name": user_info_cache.name(user_id),
+            "reason": f"{reason}\n{total}サーバーに連携: {summary}",
+            "message_content": "\n".join(lines),
+            "timestamp": datetime.now().astimezone()
+        })
+
+
+federation = Federation()
+
+
+async def start_metrics_server():
+    """ローカルに Prometheus 形式のメトリクスを公開する"""
+    async def handle_metrics(request):
+        return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, metrics_host, metrics_port).start()
+    logger.info("メトリクスを公開しました: http://%s:%s/metrics", metrics_host, metrics_port)
+
+
+def queue_depth_gauges():
+    for guild_id, queue in punishment_queues.items():
+        yield "punishment_queue_depth", {"guild": guild_id}, queue.depth
+    for guild_id, buffer in log_sink.buffers.items():
+        yield "log_buffer_depth", {"guild": guild_id}, len(buffer)
+
+
+def cumulative_counters():
+    yield "rest_calls_avoided_total", {}, rest_calls_avoided
+    yield "content_cache_total", {"result": "unchanged"}, content_cache.unchanged_hits
+    yield "content_cache_total", {"result": "verdict"}, content_cache.verdict_hits
+    yield "content_cache_total", {"result": "miss"}, content_cache.misses
+
+
+metrics.gauges.append(queue_depth_gauges)
+metrics.counter_functions.append(cumulative_counters)
+
+
+@bot.event
+async def on_ready():
+    logger.info("%s としてログインしました", bot.user)
+    logger.info("接続中のサーバー数: %s", len(bot.guilds))
+    
+    # インテントの状態を確認
+    logger.info(
+        "インテント状態: message_content=%s, members=%s, guilds=%s",
+        bot.intents.message_content, bot.intents.members, bot.intents.guilds,
+    )
+    
+    # スラッシュコマンドを同期
+    try:
+        synced = await bot.tree.sync()
+        logger.info("%s 個のスラッシュコマンドを同期しました", len(synced))
+    except Exception as e:
+        logger.error("コマンド同期エラー: %s", e)
+    
+    # 連携モード用のユーザー → サーバーの逆引きを作成
+    started = time.perf_counter()
+    await member_index.rebuild(bot.guilds)
+    logger.info("メンバーの逆引きを作成しました: %s人 / %.2f秒", len(member_index), time.perf_counter() - started)
+
+    # 定期チェックタスクを開始
+    if not periodic_check.is_running():
+        periodic_check.start()
+        logger.info("定期チェックタスクを開始しました（5秒間隔）")
+
+
+class ReconcileState:
+    """キャッシュを使った全件照合の進捗（中断しても続きから再開できる）"""
+
+    # 1回の定期チェックで照合する最大メンバー数
+    MEMBERS_PER_TICK = 5000
+    # イベントループに制御を返す間隔（メンバー数）
+    YIELD_EVERY = 500
+
+    def __init__(self):
+        self.next_run = 0.0
+        self.guild_ids = deque()
+        self.current_guild_id = None
+        self.member_ids = []
+        self.position = 0
+        self.started_at = 0.0
+        self.detected = 0
+
+    @property
+    def running(self):
+        return self.current_guild_id is not None or bool(self.guild_ids)
+
+    def start(self, guilds):
+        self.guild_ids = deque(guild.id for guild in guilds)
+        self.current_guild_id = None
+        self.next_run = time.monotonic() + reconcile_interval_minutes * 60
+
+
+reconcile_state = ReconcileState()
+
+
+async def enforce_listed_member(guild, member, action_type):
+    """リストに記載されているメンバーに処罰を適用する"""
+    user_info_cache.remember(member)
+    # ロールを付与
+    await assign_danger_role(member)
+    # ログを送信（一回のみ）
+    await send_log_once(guild, member, "リストに記載されているユーザーID", action_type)
+    # 設定された処罰をキューに追加
+    enqueue_punishment(guild, member.id, "リストに記載されているユーザーID")
+
+
+async def enforce_added_users(added_users):
+    """新しくリストに追加されたユーザーIDだけを、参加しているサーバーのメンバーキャッシュと照合する"""
+    for user_id, origin_guild_id in added_users.items():
+        for guild_id in member_index.guilds_of(user_id):
+            # 追加元のサーバーでは既に処罰済み（特定のサーバーのみの登録は他のサーバーでは対象外）
+            if origin_guild_id == guild_id or not ban_list.has_user(user_id, guild_id):
+                continue
+            # 連携処罰で対応中
+            if federation.handled(user_id, guild_id):
+                continue
+            guild = bot.get_guild(guild_id)
+            member = guild.get_member(user_id) if guild is not None else None
+            if member is None or await is_admin(member):
+                continue
+            try:
+                await enforce_listed_member(guild, member, "リスト追加時検知")
+            except Exception as e:
+                logger.error("リスト追加時チェックエラー (Guild: %s): %s", guild.name, e)
+
+
+async def reconcile_members():
+    """メンバーキャッシュ全体をリストと照合する（1回あたりの件数を制限し、続きから再開）"""
+    state = reconcile_state
+    budget = ReconcileState.MEMBERS_PER_TICK
+    while budget > 0 and state.running:
+        if state.current_guild_id is None:
+            guild = bot.get_guild(state.guild_ids.popleft())
+            if guild is None:
+                continue
+            state.current_guild_id = guild.id
+            state.member_ids = [member.id for member in guild.members]
+            state.position = 0
+            state.started_at = time.monotonic()
+            state.detected = 0
+        guild = bot.get_guild(state.current_guild_id)
+        if guild is None:
+            state.current_guild_id = None
+            continue
+
+        while budget > 0 and state.position < len(state.member_ids):
+            user_id = state.member_ids[state.position]
+            state.position += 1
+            budget -= 1
+            if state.position % ReconcileState.YIELD_EVERY == 0:
+                await asyncio.sleep(0)
+            if not ban_list.has_user(user_id, guild.id):
+                continue
+            member = guild.get_member(user_id)
+            if member is None or await is_admin(member):
+                continue
+            state.detected += 1
+            await enforce_listed_member(guild, member, "定期チェック検知")
+
+        if state.position >= len(state.member_ids):
+            elapsed = time.monotonic() - state.started_at
+            logger.info("照合完了 (Guild: %s): %s人 / 検知 %s人 / 所要 %.2f秒", guild.name, len(state.member_ids), state.detected, elapsed)
+            state.current_guild_id = None
+            state.member_ids = []
+
+
+async def full_sweep():
+    """従来方式：全メンバーをRESTで取得してチェック"""
+    for guild in bot.guilds:
+        started_at = time.monotonic()
+        count = 0
+        try:
+            # サーバーの全メンバーをチェック
+            count_rest("fetch_members")
+            async for member in guild.fetch_members(limit=None):
+                count += 1
+                # 管理者は除外
+                if await is_admin(member):
+                    continue
+                
+                if ban_list.has_user(member.id, guild.id):
+                    await enforce_listed_member(guild, member, "定期チェック検知")
+        except discord.errors.Forbidden:
+            continue
+        except Exception as e:
+            logger.error("定期チェックエラー (Guild: %s): %s", guild.name, e)
+        logger.info("全件チェック完了 (Guild: %s): %s人 / 所要 %.2f秒", guild.name, count, time.monotonic() - started_at)
+
+
+@tasks.loop(seconds=5)
+@timed("periodic_check")
+async def periodic_check():
+    """5秒ごとにリストをチェック"""
+    if sweep_mode == "full":
+        await full_sweep()
+        return
+
+    # リストに追加されたIDだけをチェック（参加時は on_member_join が担当）
+    added_users = ban_list.pop_added_users()
+    if added_users:
+        await enforce_added_users(added_users)
+
+    # 長い間隔でキャッシュ全体を照合
+    if not reconcile_state.running and time.monotonic() >= reconcile_state.next_run:
+        reconcile_state.start(bot.guilds)
+    if reconcile_state.running:
+        try:
+            await reconcile_members()
+        except Exception as e:
+            logger.error("定期照合エラー: %s", e)
+
+
+class JoinRing:
+    """直近 N 件の参加時刻とユーザーIDを保持する固定長のリングバッファ"""
+
+    __slots__ = ("times", "user_ids", "index", "count")
+
+    def __init__(self, size):
+        self.times = [0.0] * size
+        self.user_ids = [0] * size
+        self.index = 0
+        self.count = 0
+
+    def push(self, now, user_id):
+        """追加し、N 件目の参加から今回までの経過秒数を返す（N 件に満たなければ None）"""
+        size = len(self.times)
+        self.times[self.index] = now
+        self.user_ids[self.index] = user_id
+        self.index = (self.index + 1) % size
+        self.count = min(self.count + 1, size)
+        if self.count < size:
+            return None
+        # index は最も古い要素を指している
+        return now - self.times[self.index]
+
+    def recent(self, now, window):
+        """window 秒以内に参加したユーザーID"""
+        return [
+            user_id
+            for joined_at, user_id in zip(self.times, self.user_ids)
+            if user_id and now - joined_at <= window
+        ]
+
+
+class GuildJoinState:
+    """サーバーごとの参加レート検知の状態（メモリ使用量は固定）"""
+
+    # 名前の類似度判定に使う直近の参加者数
+    NAME_HISTORY = 32
+
+    def __init__(self):
+        self.joins = JoinRing(max(2, raid_join_threshold))
+        self.suspicious = JoinRing(max(2, raid_suspicious_threshold))
+        self.name_keys = [None] * self.NAME_HISTORY
+        self.name_counts = {}
+        self.name_index = 0
+        self.lockdown_until = 0.0
+
+    @property
+    def locked_down(self):
+        return time.monotonic() < self.lockdown_until
+
+    def push_name(self, key):
+        """名前のパターンを記録し、直近の参加者に同じパターンが何人いたかを返す"""
+        count = self.name_counts.get(key, 0)
+        old_key = self.name_keys[self.name_index]
+        if old_key is not None:
+            remaining = self.name_counts[old_key] - 1
+            if remaining:
+                self.name_counts[old_key] = remaining
+            else:
+                del self.name_counts[old_key]
+        self.name_keys[self.name_index] = key
+        self.name_index = (self.name_index + 1) % self.NAME_HISTORY
+        self.name_counts[key] = self.name_counts.get(key, 0) + 1
+        return count
+
+
+# サーバーID → 参加レート検知の状態
+join_states = {}
+
+NAME_PATTERN_RE = re.compile(r"[\d\W_]+")
+
+
+def is_suspicious_join(member, state):
+    """新規アカウント・デフォルトアイコン・似た名前のうち2つ以上に該当するか"""
+    signals = 0
+    if discord.utils.utcnow() - member.created_at < timedelta(days=raid_account_age_days):
+        signals += 1
+    if member.avatar is None:
+        signals += 1
+    # 数字や記号を除いた名前が直近の参加者と一致するか（raider123 と raider456 など）
+    name_key = NAME_PATTERN_RE.sub("", member.name.lower())[:16]
+    if name_key and state.push_name(name_key) > 0:
+        signals += 1
+    return signals >= 2
+
+
+async def handle_raid_member(member, reason, suspicious):
+    """ロックダウン中の参加者を隔離し、不審な参加者は処罰する
+
+    大きなサーバーでは通常の参加でも参加レートを超えるため、古いアカウントなど
+    不審な点のない参加者は処罰しない。
+    """
+    await assign_danger_role(member)
+    await send_log_once(member.guild, member, reason, "レイド検知")
+    if suspicious and raid_action != "quarantine":
+        enqueue_punishment(member.guild, member.id, reason)
+
+
+async def check_join_rate(member):
+    """参加レートを記録し、レイドと判定したらロックダウンする（1回あたり O(1)）"""
+    guild = member.guild
+    state = join_states.get(guild.id)
+    if state is None:
+        state = join_states[guild.id] = GuildJoinState()
+
+    now = time.monotonic()
+    window = raid_join_window_seconds
+    elapsed = state.joins.push(now, member.id)
+    triggered = elapsed is not None and elapsed <= window
+    suspicious = is_suspicious_join(member, state)
+    if suspicious:
+        elapsed = state.suspicious.push(now, member.id)
+        triggered = triggered or (elapsed is not None and elapsed <= window)
+
+    if state.locked_down:
+        await handle_raid_member(member, "ロックダウン中の参加", suspicious)
+        if triggered:
+            state.lockdown_until = now + raid_lockdown_minutes * 60
+        return True
+
+    if not triggered:
+        return False
+
+    state.lockdown_until = now + raid_lockdown_minutes * 60
+    logger.info("レイドを検知しました (Guild: %s): %s分間ロックダウンします", guild.name, raid_lockdown_minutes)
+    # 検知のきっかけになった直近の参加者にも対応する
+    suspicious_ids = set(state.suspicious.recent(now, window))
+    burst_ids = set(state.joins.recent(now, window)) | suspicious_ids
+    for user_id in burst_ids:
+        burst_member = guild.get_member(user_id)
+        if burst_member is None or await is_admin(burst_member):
+            continue
+        await handle_raid_member(burst_member, "短時間の大量参加（レイド）", user_id in suspicious_ids)
+    return True
+
+
+@bot.event
+@timed("on_member_join")
+async def on_member_join(member):
+    """ユーザーがサーバーに参加したとき"""
+    metrics.inc("events_total", guild=member.guild.id, type="join")
+    user_info_cache.remember(member)
+    member_index.add(member.guild.id, member.id)
+
+    # 管理者は除外
+    if await is_admin(member):
+        return
+    
+    if await check_user_in_list(member.id, member.guild):
+        # ロールを付与
+        await assign_danger_role(member)
+        # ログを送信（一回のみ）
+        await send_log_once(member.guild, member, "リストに記載されているユーザーID", "参加時検知")
+        # 設定された処罰をキューに追加
+        enqueue_punishment(member.guild, member.id, "リストに記載されているユーザーID（参加時検知）")
+        # 連携モードなら共通の他のサーバーでも処罰
+        federation.propagate(member.guild, member.id, "リストに記載されているユーザーID（参加時検知）")
+        return
+
+    # 参加レートによるレイド検知
+    await check_join_rate(member)
+
+
+@bot.event
+async def on_member_update(before, after):
+    """ロールや権限が変わったメンバーの管理者判定をやり直す"""
+    exempt_cache.invalidate_member(after.guild.id, after.id)
+
+
+@bot.event
+async def on_member_remove(member):
+    """退出したメンバーの管理者判定と逆引きを破棄"""
+    exempt_cache.invalidate_member(member.guild.id, member.id)
+    member_index.discard(member.guild.id, member.id)
+
+
+@bot.event
+async def on_guild_join(guild):
+    """参加したサーバーのメンバーを逆引きに追加"""
+    await member_index.add_guild(guild)
+
+
+@bot.event
+async def on_guild_remove(guild):
+    """退出したサーバーのメンバーを逆引きから外す"""
+    member_index.remove_guild(guild)
+    exempt_cache.invalidate_guild(guild.id)
+
+
+@bot.event
+async def on_guild_role_update(before, after):
+    """ロールの権限が変わると、そのロールを持つ全員の判定が変わりうる"""
+    exempt_cache.invalidate_guild(after.guild.id)
+
+
+@bot.event
+async def on_guild_role_delete(role):
+    """削除されたロールは管理者ロールの一覧と判定から外す"""
+    exempt_cache.invalidate_guild(role.guild.id)
+
+
+class FloodState:
+    """ユーザーごとの直近 N 件の発言時刻と内容ハッシュ（固定長のリングバッファ）"""
+
+    __slots__ = ("times", "hashes", "index", "count", "last_seen")
+
+    def __init__(self, size):
+        self.times = [0.0] * size
+        self.hashes = [0] * size
+        self.index = 0
+        self.count = 0
+        self.last_seen = 0.0
+
+
+CUSTOM_EMOJI_RE = re.compile(r"<a?:\w+:\d+>")
+
+
+def count_emoji(content):
+    """カスタム絵文字と主な Unicode 絵文字の数を数える"""
+    count = len(CUSTOM_EMOJI_RE.findall(content))
+    for ch in content:
+        code = ord(ch)
+        if 0x1F300 <= code <= 0x1FAFF or 0x2600 <= code <= 0x27BF:
+            count += 1
+    return count
+
+
+class FloodDetector:
+    """短時間の連投・同一内容の繰り返し・大量メンション・絵文字の連打を検知する"""
+
+    def __init__(self):
+        # (サーバーID << 64 | ユーザーID) → FloodState（最後に発言した順）
+        self.states = OrderedDict()
+
+    def _evict(self, now):
+        """一定時間発言のないユーザーと上限を超えた分を古い順に削除"""
+        states = self.states
+        while states:
+            state = next(iter(states.values()))
+            if now - state.last_seen < flood_idle_seconds and len(states) <= flood_max_tracked_users:
+                break
+            states.popitem(last=False)
+
+    def check(self, message, edited=False):
+        """検知した場合は理由を返す（編集では発言として数えず、メンション・絵文字の数だけ見る）"""
+        if not edited:
+            reason = self._check_rate(message)
+            if reason:
+                return reason
+
+        mentions = len(message.mentions) + len(message.role_mentions)
+        if message.mention_everyone:
+            mentions += 1
+        if mentions >= flood_mention_threshold:
+            return f"大量メンション（{mentions}件）"
+
+        content = message.content
+        if content and len(content) >= flood_emoji_threshold and count_emoji(content) >= flood_emoji_threshold:
+            return f"絵文字の連打（{flood_emoji_threshold}個以上）"
+        return None
+
+    def _check_rate(self, message):
+        """発言を記録し、短時間の連投か同じ内容の繰り返しなら理由を返す"""
+        now = time.monotonic()
+        key = (message.guild.id << 64) | message.author.id
+        state = self.states.get(key)
+        if state is None:
+            state = self.states[key] = FloodState(max(2, flood_message_count))
+        else:
+            self.states.move_to_end(key)
+        state.last_seen = now
+        self._evict(now)
+
+        content = message.content
+        # 正規化した内容で比べる（ゼロ幅文字や全角・半角の違いだけの連投もまとめて数える）
+        folded = normalize_text(content) if content else ""
+        content_hash = hash(folded) if len(folded) >= flood_duplicate_min_length else 0
+        size = len(state.times)
+        state.times[state.index] = now
+        state.hashes[state.index] = content_hash
+        state.index = (state.index + 1) % size
+        state.count = min(state.count + 1, size)
+
+        # N 件目の発言から今回までが T 秒以内なら連投
+        if state.count == size and now - state.times[state.index] <= flood_window_seconds:
+            return f"短時間の連投（{flood_window_seconds}秒間に{size}件以上）"
+
+        # 同じ内容の繰り返し
+        if content_hash:
+            duplicates = 0
+            for sent_at, sent_hash in zip(state.times, state.hashes):
+                if sent_hash == content_hash and now - sent_at <= flood_duplicate_window_seconds:
+                    duplicates += 1
+            if duplicates >= flood_duplicate_count:
+                return f"同じ内容の繰り返し（{duplicates}回）"
+        return None
+
+
+flood_detector = FloodDetector()
+
+
+class DuplicateCluster:
+    """似た文章のまとまり（代表の署名・投稿者・投稿メッセージ）"""
+
+    __slots__ = ("signature", "authors", "messages", "last_seen", "flagged", "text")
+
+    def __init__(self, signature, text, now):
+        self.signature = signature
+        self.text = text
+        # 投稿者ID → 最後に投稿した時刻
+        self.authors = {}
+        # メッセージID → 検知前の投稿 (チャンネルID, メッセージID, 投稿者ID)（検知時にまとめて削除）
+        # 編集で同じメッセージをもう一度確認しても重複しないように、メッセージIDで持つ
+        self.messages = {}
+        self.last_seen = now
+        self.flagged = False
+
+
+class DuplicateDetector:
+    """MinHash（1回のハッシュで K 個に振り分ける方式）と LSH で似た文章を検出する
+
+    文章を4文字ずつの断片に分け、各断片のハッシュ値を下位ビットで K 個の枠に
+    振り分けて枠ごとの最小値を署名とする。署名を2枠ずつの帯に分けて索引し、
+    同じ帯を持つ候補だけを一致率で比較する。1件あたりの処理は文章の長さに比例する。
+    """
+
+    SLOTS = 16
+    ROWS_PER_BAND = 2
+    SHINGLE = 4
+    EMPTY = 1 << 60
+    HASH_MASK = (1 << 64) - 1
+
+    def __init__(self):
+        # (帯の番号, 帯の値) → その帯を持つ DuplicateCluster の集合
+        self.buckets = {}
+        # 作成順（期限切れの確認用）
+        self.clusters = deque()
+
+    @classmethod
+    def signature(cls, content):
+        text = " ".join(normalize_text(content).split())
+        mins = [cls.EMPTY] * cls.SLOTS
+        mask = cls.HASH_MASK
+        slot_mask = cls.SLOTS - 1
+        shingle = cls.SHINGLE
+        for i in range(max(1, len(text) - shingle + 1)):
+            h = hash(text[i:i + shingle]) & mask
+            slot = h & slot_mask
+            value = h >> 4
+            if value < mins[slot]:
+                mins[slot] = value
+        return tuple(mins)
+
+    @classmethod
+    def similarity(cls, a, b):
+        """署名の一致率（推定 Jaccard 係数）"""
+        equal = compared = 0
+        for x, y in zip(a, b):
+            if x == cls.EMPTY and y == cls.EMPTY:
+                continue
+            compared += 1
+            equal += x == y
+        return equal / compared if compared else 0.0
+
+    def _band_keys(self, signature):
+        rows = self.ROWS_PER_BAND
+        for band in range(self.SLOTS // rows):
+            values = signature[band * rows:(band + 1) * rows]
+            if all(value == self.EMPTY for value in values):
+                continue
+            yield (band,) + values
+
+    def _remove(self, cluster):
+        for key in self._band_keys(cluster.signature):
+            bucket = self.buckets.get(key)
+            if bucket is not None:
+                bucket.discard(cluster)
+                if not bucket:
+                    del self.buckets[key]
+
+    def _expire(self, now):
+        """期限切れのまとまりを作成順に削除する（1回あたり O(1) の償却コスト）"""
+        clusters = self.clusters
+        while clusters:
+            cluster = clusters[0]
+            ttl = duplicate_flag_ttl_minutes * 60 if cluster.flagged else duplicate_window_seconds
+            if len(clusters) <= duplicate_max_clusters and now - cluster.last_seen < ttl:
+                # 先頭がまだ使われている場合は末尾に回し、後ろのものは次回以降に確認する
+                clusters.rotate(-1)
+                break
+            clusters.popleft()
+            self._remove(cluster)
+
+    def _find(self, signature):
+        seen = set()
+        for key in self._band_keys(signature):
+            for cluster in self.buckets.get(key, ()):
+                if cluster in seen:
+                    continue
+                seen.add(cluster)
+                if self.similarity(signature, cluster.signature) >= duplicate_similarity:
+                    return cluster
+        return None
+
+    def check(self, message):
+        """(該当するまとまり, 今回初めて検知したか) を返す。検知対象でなければ (None, False)"""
+        content = message.content
+        if len(content) < duplicate_min_length:
+            return None, False
+        now = time.monotonic()
+        self._expire(now)
+        signature = self.signature(content)
+        cluster = self._find(signature)
+        if cluster is None:
+            cluster = DuplicateCluster(signature, content, now)
+            for key in self._band_keys(signature):
+                self.buckets.setdefault(key, set()).add(cluster)
+            self.clusters.append(cluster)
+        cluster.last_seen = now
+        if cluster.flagged:
+            return cluster, False
+
+        # 時間枠を過ぎた投稿者は数えない
+        for author_id, posted_at in list(cluster.authors.items()):
+            if now - posted_at > duplicate_window_seconds:
+                del cluster.authors[author_id]
+        cluster.authors[message.author.id] = now
+        cluster.messages[message.id] = (message.channel.id, message.id, message.author.id)
+        while len(cluster.messages) > duplicate_author_threshold * 4:
+            del cluster.messages[next(iter(cluster.messages))]
+        if len(cluster.authors) >= duplicate_author_threshold:
+            cluster.flagged = True
+            return cluster, True
+        return None, False
+
+
+duplicate_detector = DuplicateDetector()
+
+
+async def handle_duplicate_spam(message, cluster, newly_flagged):
+    """同じ文章の大量投稿を検知したときの処理"""
+    reason = f"複数アカウントによる同じ文章の投稿: {cluster.text[:100]}"
+    guild = message.guild
+    if not newly_flagged:
+        targets = [(message.channel.id, message.id, message.author.id)]
+    else:
+        # これまでに投稿した全員を対象にする
+        targets = list(cluster.messages.values())
+        cluster.messages.clear()
+        logger.info("同じ文章の大量投稿を検知しました (Guild: %s): 投稿者 %s人", guild.name, len(cluster.authors))
+        # 1つのサーバーでの検知が全サーバーの禁止文字列にならないよう、検知したサーバーに限定する
+        # 投稿された文章はそのまま一致させる（「regex:」などで始まってもルールにしない）
+        text = escape_rule_prefix(cluster.text.strip()[:100])
+        if duplicate_auto_add and ban_list.add_text(text, guild_id=guild.id, reason="同じ文章の大量投稿（自動追加）"):
+            logger.info("禁止文字列 `%s` をサーバー %s のリストに追加しました", text, guild.name)
+
+    punished = set()
+    for channel_id, message_id, author_id in targets:
+        channel = guild.get_channel_or_thread(channel_id)
+        if channel is not None:
+            await delete_message(channel.get_partial_message(message_id))
+        if author_id in punished:
+            continue
+        punished.add(author_id)
+        member = guild.get_member(author_id)
+        if member is None or await is_admin(member):
+            continue
+        await assign_danger_role(member)
+        await send_log_once(guild, member, reason, "重複投稿検知", cluster.text)
+        enqueue_punishment(guild, author_id, reason)
 
-async def ban_user(guild, user_id, reason="荒らし対策"):
-    """ユーザーをバンする"""
-    try:
-        user = await bot.fetch_user(user_id)
-        await guild.ban(user, reason=reason, delete_message_days=0)
-        print(f"[{datetime.now()}] ユーザー {user.name} (ID: {user_id}) をバンしました")
-        return True
-    except discord.errors.NotFound:
-        print(f"[{datetime.now()}] ユーザーID {user_id} が見つかりません")
-        return False
-    except discord.errors.Forbidden:
-        print(f"[{datetime.now()}] ユーザーID {user_id} をバンする権限がありません")
-        return False
-    except Exception as e:
-        print(f"[{datetime.now()}] バンエラー: {e}")
-        return False
 
+class ContentVerdictCache:
+    """メッセージの内容のハッシュと判定結果の記録（件数上限つき、古いものから削除）
 
-async def kick_user(guild, user_id, reason="荒らし対策"):
-    """ユーザーをキックする"""
-    try:
-        member = guild.get_member(user_id)
-        if member:
-            await member.kick(reason=reason)
-            print(f"[{datetime.now()}] ユーザー {member.name} (ID: {user_id}) をキックしました")
-            return True
-        else:
-            # メンバーがサーバーに存在しない場合
-            user = await bot.fetch_user(user_id)
-            print(f"[{datetime.now()}] ユーザー {user.name} (ID: {user_id}) はサーバーに存在しません")
-            return False
-    except discord.errors.Forbidden:
-        print(f"[{datetime.now()}] ユーザーID {user_id} をキックする権限がありません")
-        return False
-    except Exception as e:
-        print(f"[{datetime.now()}] キックエラー: {e}")
-        return False
+    メッセージID → 内容のハッシュで内容の変わっていない編集（ピン留めなど）を無視し、
+    (サーバーID, 内容のハッシュ) → 判定結果で同じ内容の連投や編集の照合を省く。
+    埋め込みのリンクも判定の対象のため、ハッシュには埋め込みのリンク・本文も含める
+    （埋め込みの展開だけの編集も照合し直す）。判定結果は禁止文字列が変わると使わない。
+    """
 
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._messages = OrderedDict()
+        self._verdicts = OrderedDict()
+        # 内容の変わっていない編集・判定結果の再利用・照合した回数
+        self.unchanged_hits = 0
+        self.verdict_hits = 0
+        self.misses = 0
 
-async def timeout_user(guild, user_id, duration_minutes, reason="荒らし対策"):
-    """ユーザーをタイムアウトする"""
-    try:
-        member = guild.get_member(user_id)
-        if member:
-            timeout_until = datetime.utcnow() + timedelta(minutes=duration_minutes)
-            await member.timeout(timeout_until, reason=reason)
-            print(f"[{datetime.now()}] ユーザー {member.name} (ID: {user_id}) を {duration_minutes}分間タイムアウトしました")
-            return True
-        else:
-            print(f"[{datetime.now()}] ユーザーID {user_id} はサーバーに存在しません")
-            return False
-    except discord.errors.Forbidden:
-        print(f"[{datetime.now()}] ユーザーID {user_id} をタイムアウトする権限がありません")
-        return False
-    except Exception as e:
-        print(f"[{datetime.now()}] タイムアウトエラー: {e}")
-        return False
+    def _remember(self, entries, key, value):
+        entries[key] = value
+        entries.move_to_end(key)
+        while len(entries) > self.max_entries:
+            entries.popitem(last=False)
 
+    @property
+    def hit_rate(self):
+        total = self.unchanged_hits + self.verdict_hits + self.misses
+        return (self.unchanged_hits + self.verdict_hits) / total if total else 0.0
 
-async def unban_user(guild, user_id, reason="バン解除"):
-    """ユーザーのバンを解除する"""
-    try:
-        user = await bot.fetch_user(user_id)
-        await guild.unban(user, reason=reason)
-        print(f"[{datetime.now()}] ユーザー {user.name} (ID: {user_id}) のバンを解除しました")
+    @staticmethod
+    def content_hash(message):
+        """本文と埋め込み（check_text_in_message が見る部分）のハッシュ"""
+        if not message.embeds:
+            return hash(message.content)
+        return hash((message.content, embed_text(message.embeds)))
+
+    def is_unchanged(self, message):
+        """前回チェックしたときと本文・埋め込みが同じなら True"""
+        if self._messages.get(message.id) != self.content_hash(message):
+            return False
+        self._messages.move_to_end(message.id)
+        self.unchanged_hits += 1
         return True
-    except discord.errors.NotFound:
-        # バンされていない場合もエラーになるが、これは無視
-        print(f"[{datetime.now()}] ユーザーID {user_id} はバンされていないか、見つかりません")
-        return False
-    except discord.errors.Forbidden:
-        print(f"[{datetime.now()}] ユーザーID {user_id} のバンを解除する権限がありません")
-        return False
-    except Exception as e:
-        print(f"[{datetime.now()}] バン解除エラー: {e}")
-        return False
 
+    async def check(self, message):
+        """check_text_in_message と同じ結果を返す（同じ内容の判定結果があれば照合しない）"""
+        content_hash = self.content_hash(message)
+        self._remember(self._messages, message.id, content_hash)
+        ban_list.reload_if_changed()
+        key = (message.guild.id, content_hash)
+        cached = self._verdicts.get(key)
+        if cached is not None and cached[0] == ban_list.texts_version:
+            self._verdicts.move_to_end(key)
+            self.verdict_hits += 1
+            detected_text = cached[1]
+        else:
+            self.misses += 1
+            _, detected_text = await check_text_in_message(message.content, message.guild, message.embeds)
+            self._remember(self._verdicts, key, (ban_list.texts_version, detected_text))
+        return detected_text is not None, detected_text
 
-async def check_user_in_list(user_id):
-    """ユーザーIDがリストに含まれているかチェック"""
-    ban_list = load_ban_list()
-    return str(user_id) in [str(uid) for uid in ban_list["user_ids"]]
 
+content_cache = ContentVerdictCache(content_cache_max_entries)
 
-async def check_text_in_message(message_content):
-    """メッセージに禁止文字列が含まれているかチェック"""
-    ban_list = load_ban_list()
-    message_lower = message_content.lower()
-    for text in ban_list["texts"]:
-        if text.lower() in message_lower:
-            return True, text
-    return False, None
 
+async def handle_detected_text(message, member, detected_text, action_type="禁止文字列検知"):
+    """禁止文字列を含むメッセージを削除し、投稿者を処罰してリストに追加する"""
+    # メッセージを削除
+    await delete_message(message)
 
-async def apply_punishment(guild, user_id, reason="荒らし対策"):
-    """設定された処罰方法を適用する"""
-    global default_punishment, timeout_duration_minutes
-    
-    if default_punishment == "ban":
-        return await ban_user(guild, user_id, reason)
-    elif default_punishment == "kick":
-        return await kick_user(guild, user_id, reason)
-    elif default_punishment == "timeout":
-        return await timeout_user(guild, user_id, timeout_duration_minutes, reason)
-    else:
-        # デフォルトはバン
-        return await ban_user(guild, user_id, reason)
+    # メンバーオブジェクトを取得
+    if member:
+        # ロールを付与
+        await assign_danger_role(member)
 
+    # ログを送信（一回のみ）
+    await send_log_once(message.guild, message.author, f"禁止文字列を検知: {detected_text}", action_type, message.content)
 
-@bot.event
-async def on_ready():
-    print(f"[{datetime.now()}] {bot.user} としてログインしました")
-    print(f"[{datetime.now()}] 接続中のサーバー数: {len(bot.guilds)}")
-    
-    # インテントの状態を確認
-    print(f"[{datetime.now()}] インテント状態:")
-    print(f"  - message_content: {bot.intents.message_content}")
-    print(f"  - members: {bot.intents.members}")
-    print(f"  - guilds: {bot.intents.guilds}")
-    
-    # スラッシュコマンドを同期
-    try:
-        synced = await bot.tree.sync()
-        print(f"[{datetime.now()}] {len(synced)} 個のスラッシュコマンドを同期しました")
-    except Exception as e:
-        print(f"[{datetime.now()}] コマンド同期エラー: {e}")
-    
-    # 定期チェックタスクを開始
-    if not periodic_check.is_running():
-        periodic_check.start()
-        print(f"[{datetime.now()}] 定期チェックタスクを開始しました（5秒間隔）")
+    # 設定された処罰をキューに追加
+    enqueue_punishment(message.guild, message.author.id, f"禁止文字列を検知: {detected_text}")
+    federation.propagate(message.guild, message.author.id, f"禁止文字列を検知: {detected_text}")
 
+    # ユーザーIDをリストに追加
+    if ban_list.add_user(
+        message.author.id, origin_guild_id=message.guild.id, reason=f"禁止文字列を検知: {detected_text}"[:200]
+    ):
+        logger.info("ユーザーID %s をリストに追加しました", message.author.id)
 
-@tasks.loop(seconds=5)
-async def periodic_check():
-    """5秒ごとにリストをチェック"""
-    ban_list = load_ban_list()
-    for guild in bot.guilds:
-        try:
-            # サーバーの全メンバーをチェック
-            async for member in guild.fetch_members(limit=None):
-                # 管理者は除外
-                if await is_admin(member):
-                    continue
-                
-                user_id = str(member.id)
-                if user_id in [str(uid) for uid in ban_list["user_ids"]]:
-                    # ロールを付与
-                    await assign_danger_role(member)
-                    # ログを送信（一回のみ）
-                    await send_log_once(guild, member, "リストに記載されているユーザーID", "定期チェック検知")
-                    # 設定された処罰を適用
-                    await apply_punishment(guild, member.id, "リストに記載されているユーザーID")
-                    await asyncio.sleep(0.5)  # レート制限対策
-        except discord.errors.Forbidden:
-            continue
-        except Exception as e:
-            print(f"[{datetime.now()}] 定期チェックエラー (Guild: {guild.name}): {e}")
 
+async def scan_message(message, member, edited=False):
+    """メッセージを検知処理に順に通す（新規の投稿と編集で共通）"""
+    # メンションされた場合もチェック
+    if bot.user in message.mentions:
+        if await check_user_in_list(message.author.id, message.guild):
+            # メンバーオブジェクトを取得
+            if member:
+                # ロールを付与
+                await assign_danger_role(member)
+            # ログを送信（一回のみ）
+            await send_log_once(message.guild, message.author, "リストに記載されているユーザーID", "メンション時検知", message.content)
+            # 設定された処罰をキューに追加
+            enqueue_punishment(message.guild, message.author.id, "リストに記載されているユーザーID（メンション時検知）")
+            federation.propagate(message.guild, message.author.id, "リストに記載されているユーザーID（メンション時検知）")
+            await delete_message(message)
+            return
 
-@bot.event
-async def on_member_join(member):
-    """ユーザーがサーバーに参加したとき"""
-    # 管理者は除外
-    if await is_admin(member):
+    # メッセージ内容をチェック（同じ内容の判定結果があれば再利用）
+    detected, detected_text = await content_cache.check(message)
+    if detected:
+        await handle_detected_text(message, member, detected_text, "編集時検知" if edited else "禁止文字列検知")
         return
-    
-    if await check_user_in_list(member.id):
-        # ロールを付与
-        await assign_danger_role(member)
-        # ログを送信（一回のみ）
-        await send_log_once(member.guild, member, "リストに記載されているユーザーID", "参加時検知")
-        # 設定された処罰を適用
-        await apply_punishment(member.guild, member.id, "リストに記載されているユーザーID（参加時検知）")
+
+    # 連投・大量メンションをチェック
+    flood_reason = flood_detector.check(message, edited)
+    if flood_reason:
+        await delete_message(message)
+        if member:
+            await assign_danger_role(member)
+        await send_log_once(message.guild, message.author, flood_reason, "連投検知", message.content)
+        enqueue_punishment(message.guild, message.author.id, flood_reason)
+        return
+
+    # 複数アカウントによる同じ文章の投稿をチェック
+    cluster, newly_flagged = duplicate_detector.check(message)
+    if cluster is not None:
+        await handle_duplicate_spam(message, cluster, newly_flagged)
 
 
 @bot.event
+@timed("on_message")
 async def on_message(message):
     """メッセージが送信されたとき"""
     # BOT自身のメッセージは無視
@@ -387,120 +4239,147 @@ async def on_message(message):
         await bot.process_commands(message)
         return
 
+    if message.guild:
+        metrics.inc("events_total", guild=message.guild.id, type="message")
+
+    user_info_cache.remember(message.author)
+
     # 管理者は除外（誤検知を防ぐ）
     member = message.guild.get_member(message.author.id)
     if member and await is_admin(member):
         await bot.process_commands(message)
         return
 
-    # メンションされた場合もチェック
-    if bot.user in message.mentions:
-        if await check_user_in_list(message.author.id):
-            # メンバーオブジェクトを取得
-            if member:
-                # ロールを付与
-                await assign_danger_role(member)
-            # ログを送信（一回のみ）
-            await send_log_once(message.guild, message.author, "リストに記載されているユーザーID", "メンション時検知", message.content)
-            # 設定された処罰を適用
-            await apply_punishment(message.guild, message.author.id, "リストに記載されているユーザーID（メンション時検知）")
-            try:
-                await message.delete()
-            except:
-                pass
-            await bot.process_commands(message)
-            return
+    await scan_message(message, member)
+    await bot.process_commands(message)
 
-    # メッセージ内容をチェック
-    detected, detected_text = await check_text_in_message(message.content)
-    if detected:
-        # メッセージを削除
-        try:
-            await message.delete()
-        except:
-            pass
 
-        # メンバーオブジェクトを取得
-        if member:
-            # ロールを付与
-            await assign_danger_role(member)
-        
-        # ログを送信（一回のみ）
-        await send_log_once(message.guild, message.author, f"禁止文字列を検知: {detected_text}", "禁止文字列検知", message.content)
-        
-        # 設定された処罰を適用
-        await apply_punishment(message.guild, message.author.id, f"禁止文字列を検知: {detected_text}")
+@bot.event
+@timed("on_raw_message_edit")
+async def on_raw_message_edit(payload):
+    """メッセージが編集されたとき（BOT のメッセージキャッシュにないメッセージも対象）
 
-        # ユーザーIDをリストに追加
-        ban_list = load_ban_list()
-        user_id_str = str(message.author.id)
-        if user_id_str not in [str(uid) for uid in ban_list["user_ids"]]:
-            ban_list["user_ids"].append(user_id_str)
-            save_ban_list(ban_list)
-            print(f"[{datetime.now()}] ユーザーID {user_id_str} をリストに追加しました")
+    on_message_edit はキャッシュにあるメッセージでしか呼ばれず、呼ばれる場合もこのイベントの
+    後なので、こちらだけで処理する。
+    """
+    message = payload.message
+    if message.guild is None or message.author.bot:
+        return
+    # 本文・埋め込みの変わっていない編集（ピン留めなど）は照合しない
+    if content_cache.is_unchanged(message):
+        return
+    metrics.inc("events_total", guild=message.guild.id, type="edit")
 
-    await bot.process_commands(message)
+    # 管理者は除外（誤検知を防ぐ）
+    member = message.guild.get_member(message.author.id)
+    if member and await is_admin(member):
+        return
 
+    # 投稿後に禁止文字列・リンク・大量メンションを書き足す手口への対策
+    # （連投の判定では編集を発言として数えない）
+    await scan_message(message, member, edited=True)
 
-@bot.tree.command(name="add", description="リストにテキストまたはユーザーIDを追加")
-async def add_command(interaction: discord.Interaction, list_type: str, value: str):
+
+@bot.tree.command(name="add", description="リストにテキスト・ルール・ユーザーIDを追加")
+@app_commands.describe(
+    list_type="text（部分一致）/ regex（正規表現）/ glob（* ? を使った語の一致）/ word（単語の一致）/ user",
+    server_only="このサーバーのみに適用する（省略時は全サーバー共通）",
+    reason="追加する理由（記録用）"
+)
+async def add_command(
+    interaction: discord.Interaction,
+    list_type: str,
+    value: str,
+    server_only: bool = False,
+    reason: str = None
+):
     """リストに追加するコマンド"""
     if not interaction.user.guild_permissions.administrator:
         await interaction.response.send_message("このコマンドは管理者のみ使用できます。", ephemeral=True)
         return
 
-    ban_list = load_ban_list()
+    guild_id = interaction.guild.id if server_only else None
+    if list_type.lower() == "text" and rule_kind(value):
+        # 検査を通さずにルールとして登録されないようにする
+        await interaction.response.send_message(
+            f"`{rule_kind(value)}:` で始まるテキストはルールとして扱われます。list_type に `{rule_kind(value)}` を指定してください。",
+            ephemeral=True
+        )
 
-    if list_type.lower() == "text":
-        if value not in ban_list["texts"]:
-            ban_list["texts"].append(value)
-            save_ban_list(ban_list)
-            await interaction.response.send_message(f"テキスト `{value}` をリストに追加しました。", ephemeral=True)
+    elif list_type.lower() == "text":
+        if ban_list.add_text(value, guild_id=guild_id, added_by=interaction.user.id, reason=reason):
+            rule = parse_link_rule(value)
+            note = ""
+            if rule is not None:
+                note = f"\nリンクとして判定します（{'ドメイン' if rule[0] == 'domain' else '招待コード'}: `{rule[1]}`）。"
+            await interaction.response.send_message(f"テキスト `{value}` をリストに追加しました。{note}", ephemeral=True)
         else:
             await interaction.response.send_message(f"テキスト `{value}` は既にリストに存在します。", ephemeral=True)
 
+    elif list_type.lower() in RULE_TYPES:
+        # 遅くなるパターンの検査に数秒かかることがある
+        await interaction.response.defer(ephemeral=True, thinking=True)
+        rule = f"{list_type.lower()}:{value}"
+        error = await check_rule(rule)
+        rule_verifier.record(rule, error)
+        if error:
+            await interaction.followup.send(f"ルール `{rule}` は追加できません: {error}", ephemeral=True)
+        elif ban_list.add_text(rule, guild_id=guild_id, added_by=interaction.user.id, reason=reason):
+            await interaction.followup.send(f"ルール `{rule}` をリストに追加しました。", ephemeral=True)
+        else:
+            await interaction.followup.send(f"ルール `{rule}` は既にリストに存在します。", ephemeral=True)
+
     elif list_type.lower() == "user":
-        user_id_str = str(value)
-        if user_id_str not in [str(uid) for uid in ban_list["user_ids"]]:
-            ban_list["user_ids"].append(user_id_str)
-            save_ban_list(ban_list)
+        user_id_str = str(value).strip()
+        try:
+            added = ban_list.add_user(user_id_str, guild_id=guild_id, added_by=interaction.user.id, reason=reason)
+        except ValueError:
+            await interaction.response.send_message(f"ユーザーID `{user_id_str}` は数字で指定してください。", ephemeral=True)
+            return
+        if added:
             await interaction.response.send_message(f"ユーザーID `{user_id_str}` をリストに追加しました。", ephemeral=True)
         else:
             await interaction.response.send_message(f"ユーザーID `{user_id_str}` は既にリストに存在します。", ephemeral=True)
 
     else:
-        await interaction.response.send_message("list_typeは 'text' または 'user' を指定してください。", ephemeral=True)
+        await interaction.response.send_message(
+            "list_typeは 'text'・'regex'・'glob'・'word'・'user' のいずれかを指定してください。", ephemeral=True
+        )
 
 
-@bot.tree.command(name="remove", description="リストからテキストまたはユーザーIDを削除")
-async def remove_command(interaction: discord.Interaction, list_type: str, value: str):
+@bot.tree.command(name="remove", description="リストからテキスト・ルール・ユーザーIDを削除")
+@app_commands.describe(server_only="このサーバーのみのリストから削除する（省略時は全サーバー共通のリスト）")
+async def remove_command(interaction: discord.Interaction, list_type: str, value: str, server_only: bool = False):
     """リストから削除するコマンド"""
     if not interaction.user.guild_permissions.administrator:
         await interaction.response.send_message("このコマンドは管理者のみ使用できます。", ephemeral=True)
         return
 
-    ban_list = load_ban_list()
-
+    guild_id = interaction.guild.id if server_only else None
     if list_type.lower() == "text":
-        if value in ban_list["texts"]:
-            ban_list["texts"].remove(value)
-            save_ban_list(ban_list)
+        if ban_list.remove_text(value, guild_id=guild_id):
             await interaction.response.send_message(f"テキスト `{value}` をリストから削除しました。", ephemeral=True)
         else:
             await interaction.response.send_message(f"テキスト `{value}` はリストに存在しません。", ephemeral=True)
 
+    elif list_type.lower() in RULE_TYPES:
+        rule = f"{list_type.lower()}:{value}"
+        if ban_list.remove_text(rule, guild_id=guild_id):
+            await interaction.response.send_message(f"ルール `{rule}` をリストから削除しました。", ephemeral=True)
+        else:
+            await interaction.response.send_message(f"ルール `{rule}` はリストに存在しません。", ephemeral=True)
+
     elif list_type.lower() == "user":
         user_id_str = str(value)
-        user_ids_str = [str(uid) for uid in ban_list["user_ids"]]
-        if user_id_str in user_ids_str:
-            ban_list["user_ids"] = [uid for uid in ban_list["user_ids"] if str(uid) != user_id_str]
-            save_ban_list(ban_list)
+        if ban_list.remove_user(user_id_str, guild_id=guild_id):
             await interaction.response.send_message(f"ユーザーID `{user_id_str}` をリストから削除しました。", ephemeral=True)
         else:
             await interaction.response.send_message(f"ユーザーID `{user_id_str}` はリストに存在しません。", ephemeral=True)
 
     else:
-        await interaction.response.send_message("list_typeは 'text' または 'user' を指定してください。", ephemeral=True)
+        await interaction.response.send_message(
+            "list_typeは 'text'・'regex'・'glob'・'word'・'user' のいずれかを指定してください。", ephemeral=True
+        )
 
 
 @bot.tree.command(name="list", description="現在のリストを表示")
@@ -510,18 +4389,147 @@ async def list_command(interaction: discord.Interaction):
         await interaction.response.send_message("このコマンドは管理者のみ使用できます。", ephemeral=True)
         return
 
-    ban_list = load_ban_list()
+    ban_list.reload_if_changed()
     
-    user_ids_text = "\n".join(ban_list["user_ids"]) if ban_list["user_ids"] else "なし"
-    texts_text = "\n".join(ban_list["texts"]) if ban_list["texts"] else "なし"
+    user_ids_text = "\n".join(map(str, ban_list.user_ids)) if ban_list.user_ids else "なし"
+    texts_text = "\n".join(ban_list.texts) if ban_list.texts else "なし"
 
     embed = discord.Embed(title="バンリスト", color=discord.Color.red())
     embed.add_field(name="ユーザーID", value=f"```\n{user_ids_text}\n```", inline=False)
     embed.add_field(name="禁止テキスト", value=f"```\n{texts_text}\n```", inline=False)
 
+    # このサーバーのみのエントリ
+    guild_user_ids = ban_list.guild_user_ids.get(interaction.guild.id)
+    guild_texts = ban_list.guild_texts.get(interaction.guild.id)
+    if guild_user_ids:
+        embed.add_field(name="ユーザーID（このサーバーのみ）", value="```\n" + "\n".join(map(str, guild_user_ids)) + "\n```", inline=False)
+    if guild_texts:
+        embed.add_field(name="禁止テキスト（このサーバーのみ）", value="```\n" + "\n".join(guild_texts) + "\n```", inline=False)
+
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+
+@bot.tree.command(name="lookup", description="ユーザーIDのリストへの登録内容を確認")
+async def lookup_command(interaction: discord.Interaction, user_id: str):
+    """ユーザーIDの登録先・追加者・日時・理由を表示するコマンド"""
+    if not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message("このコマンドは管理者のみ使用できます。", ephemeral=True)
+        return
+
+    entries = await ban_list.lookup_user(user_id.strip())
+    if not entries:
+        await interaction.response.send_message(f"ユーザーID `{user_id}` はリストに存在しません。", ephemeral=True)
+        return
+
+    embed = discord.Embed(title="リストへの登録内容", color=discord.Color.blue())
+    embed.add_field(name="ユーザーID", value=user_id, inline=False)
+    for entry in entries:
+        guild_id = entry["guild_id"]
+        if guild_id is None:
+            scope = "全サーバー共通"
+        else:
+            guild = bot.get_guild(guild_id)
+            scope = f"{guild.name if guild else '不明なサーバー'} のみ (ID: {guild_id})"
+        lines = [
+            f"追加者: <@{entry['added_by']}>" if entry["added_by"] else "追加者: 記録なし（自動追加または移行前のデータ）",
+            f"追加日時: <t:{int(entry['added_at'])}:f>" if entry["added_at"] else "追加日時: 記録なし",
+            f"理由: {entry['reason'] or 'なし'}",
+        ]
+        embed.add_field(name=scope, value="\n".join(lines), inline=False)
+
     await interaction.response.send_message(embed=embed, ephemeral=True)
 
 
+@bot.tree.command(name="import", description="添付ファイル（ndjson / csv / json）のユーザーID・禁止文字列をまとめて追加")
+@app_commands.describe(
+    file="1行に1件の ndjson、ID だけを並べたテキストや csv、ban_list.json 形式の json",
+    file_format="ファイルの形式（省略時は拡張子・内容から判定）",
+    server_only="すべてこのサーバーのみに適用する（省略時は全サーバー共通）",
+    reason="追加する理由（記録用）"
+)
+@app_commands.choices(file_format=[app_commands.Choice(name=fmt, value=fmt) for fmt in IMPORT_FORMATS])
+async def import_command(
+    interaction: discord.Interaction,
+    file: discord.Attachment,
+    file_format: str = None,
+    server_only: bool = False,
+    reason: str = None
+):
+    """添付ファイルを少しずつ読み込んでリストに追加するコマンド"""
+    if not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message("このコマンドは管理者のみ使用できます。", ephemeral=True)
+        return
+    if file.size > import_max_bytes:
+        await interaction.response.send_message(
+            f"ファイルが大きすぎます（上限 {import_max_bytes // 1024 // 1024}MiB）。", ephemeral=True
+        )
+        return
+
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    with tempfile.TemporaryDirectory(prefix="antiraid-import-") as work_dir:
+        path = os.path.join(work_dir, "import")
+        # 添付ファイルはメモリに全体を読み込まず、一時ファイルに少しずつ保存する
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.get(file.url) as response:
+                    response.raise_for_status()
+                    with open(path, "wb") as f:
+                        async for chunk in response.content.iter_chunked(1 << 16):
+                            f.write(chunk)
+        except aiohttp.ClientError as e:
+            await interaction.followup.send(f"ファイルのダウンロードに失敗しました: {e}", ephemeral=True)
+            return
+
+        try:
+            summary = await ban_list.import_file_async(
+                path,
+                file_format,
+                name=file.filename,
+                added_by=interaction.user.id,
+                reason=reason or f"{file.filename} から取り込み",
+                guild_id=interaction.guild.id,
+                server_only=server_only,
+            )
+        except ValueError as e:
+            await interaction.followup.send(
+                f"ファイルを読み取れませんでした（{e}）。読み取れた部分までは追加されています。", ephemeral=True
+            )
+            return
+
+    logger.info(
+        "%s から取り込みました（ユーザーID %s件、禁止文字列 %s件、重複 %s件、無効 %s件）",
+        file.filename, summary.users, summary.texts, summary.duplicates, summary.invalid,
+        extra={"guild_id": interaction.guild.id, "user_id": interaction.user.id}
+    )
+    await interaction.followup.send(summary.describe(), ephemeral=True)
+
+
+@bot.tree.command(name="export", description="リスト（全サーバー共通とこのサーバーのみ）をファイルで書き出す")
+@app_commands.describe(file_format="ファイルの形式（省略時は ban_list.json と同じ json）")
+@app_commands.choices(file_format=[app_commands.Choice(name=fmt, value=fmt) for fmt in IMPORT_FORMATS])
+async def export_command(interaction: discord.Interaction, file_format: str = "json"):
+    """リストをファイルに書き出して送信するコマンド"""
+    if not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message("このコマンドは管理者のみ使用できます。", ephemeral=True)
+        return
+
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    # 他のサーバーのみのエントリは含めない
+    scopes = ban_list.export_scopes(guild_ids={interaction.guild.id})
+    with tempfile.TemporaryDirectory(prefix="antiraid-export-") as work_dir:
+        path = os.path.join(work_dir, f"ban_list.{file_format}")
+        await asyncio.to_thread(ban_list.export_file, path, file_format, scopes)
+        size = os.path.getsize(path)
+        if size > interaction.guild.filesize_limit:
+            await interaction.followup.send(
+                f"ファイルが大きすぎるため送信できません（{size / 1024 / 1024:.1f}MiB）。"
+                "BOTを動かしているPCで `py main.py --export ファイル名` を実行してください。",
+                ephemeral=True
+            )
+            return
+        await interaction.followup.send("バンリストを書き出しました。", file=discord.File(path), ephemeral=True)
+
+
 @bot.tree.command(name="setlog", description="ログチャンネルを設定")
 async def setlog_command(interaction: discord.Interaction, channel: discord.TextChannel):
     """ログチャンネルを設定するコマンド"""
@@ -529,8 +4537,7 @@ async def setlog_command(interaction: discord.Interaction, channel: discord.Text
         await interaction.response.send_message("このコマンドは管理者のみ使用できます。", ephemeral=True)
         return
 
-    global log_channel_id
-    log_channel_id = channel.id
+    guild_configs.set(interaction.guild.id, "log_channel_id", channel.id)
     save_config()
     await interaction.response.send_message(f"ログチャンネルを {channel.mention} に設定しました。", ephemeral=True)
 
@@ -542,8 +4549,7 @@ async def setrole_command(interaction: discord.Interaction, role: discord.Role):
         await interaction.response.send_message("このコマンドは管理者のみ使用できます。", ephemeral=True)
         return
 
-    global danger_role_id
-    danger_role_id = role.id
+    guild_configs.set(interaction.guild.id, "danger_role_id", role.id)
     save_config()
     
     # BOTのロール位置を確認
@@ -592,16 +4598,11 @@ async def unban_command(interaction: discord.Interaction, user_id: str):
     # バンを解除
     unban_result = await unban_user(interaction.guild, user_id_int, f"管理者 {interaction.user.name} による解除")
 
-    # リストから削除
-    ban_list = load_ban_list()
+    # リストから削除（共通のリストとこのサーバーのリストの両方。残っていると再参加時にまたバンされる）
     user_id_str = str(user_id_int)
-    user_ids_str = [str(uid) for uid in ban_list["user_ids"]]
-    
-    removed_from_list = False
-    if user_id_str in user_ids_str:
-        ban_list["user_ids"] = [uid for uid in ban_list["user_ids"] if str(uid) != user_id_str]
-        save_ban_list(ban_list)
-        removed_from_list = True
+    removed_global = ban_list.remove_user(user_id_str)
+    removed_scoped = ban_list.remove_user(user_id_str, guild_id=interaction.guild.id)
+    removed_from_list = removed_global or removed_scoped
 
     # 結果を返す
     result_messages = []
@@ -633,9 +4634,11 @@ async def setadminrole_command(interaction: discord.Interaction, role: discord.R
         await interaction.response.send_message("このコマンドは管理者のみ使用できます。", ephemeral=True)
         return
 
-    global admin_role_ids
+    guild_id = interaction.guild.id
+    admin_role_ids = guild_configs.get(guild_id, "admin_role_ids")
     if role.id not in admin_role_ids:
-        admin_role_ids.append(role.id)
+        guild_configs.set(guild_id, "admin_role_ids", admin_role_ids + [role.id])
+        exempt_cache.invalidate_guild(guild_id)
         save_config()
         await interaction.response.send_message(f"管理者ロールに {role.mention} を追加しました。", ephemeral=True)
     else:
@@ -649,9 +4652,11 @@ async def removeadminrole_command(interaction: discord.Interaction, role: discor
         await interaction.response.send_message("このコマンドは管理者のみ使用できます。", ephemeral=True)
         return
 
-    global admin_role_ids
+    guild_id = interaction.guild.id
+    admin_role_ids = guild_configs.get(guild_id, "admin_role_ids")
     if role.id in admin_role_ids:
-        admin_role_ids.remove(role.id)
+        guild_configs.set(guild_id, "admin_role_ids", [role_id for role_id in admin_role_ids if role_id != role.id])
+        exempt_cache.invalidate_guild(guild_id)
         save_config()
         await interaction.response.send_message(f"管理者ロールから {role.mention} を削除しました。", ephemeral=True)
     else:
@@ -665,7 +4670,7 @@ async def listadminroles_command(interaction: discord.Interaction):
         await interaction.response.send_message("このコマンドは管理者のみ使用できます。", ephemeral=True)
         return
 
-    global admin_role_ids
+    admin_role_ids = guild_configs.get(interaction.guild.id, "admin_role_ids")
     if not admin_role_ids:
         await interaction.response.send_message("管理者ロールが設定されていません。\n注: 管理者権限を持つユーザーは自動的に除外されます。", ephemeral=True)
         return
@@ -685,9 +4690,9 @@ async def listadminroles_command(interaction: discord.Interaction):
     await interaction.response.send_message(embed=embed, ephemeral=True)
 
 
-@bot.tree.command(name="punish", description="検知時に自動適用される全体の処罰方法を設定")
+@bot.tree.command(name="punish", description="検知時に自動適用されるこのサーバーの処罰方法を設定")
 @app_commands.describe(
-    punishment_type="検知時に全ユーザーに自動適用する処罰の種類（全体設定）",
+    punishment_type="検知時に全ユーザーに自動適用する処罰の種類（サーバーごとの設定）",
     timeout_minutes="タイムアウトの時間（分）。timeoutを選択した場合のみ必要"
 )
 @app_commands.choices(punishment_type=[
@@ -700,12 +4705,13 @@ async def punish_command(
     punishment_type: app_commands.Choice[str],
     timeout_minutes: int = None
 ):
-    """検知時に自動適用される全体の処罰方法を設定するコマンド"""
+    """検知時に自動適用されるこのサーバーの処罰方法を設定するコマンド"""
     if not interaction.user.guild_permissions.administrator:
         await interaction.response.send_message("このコマンドは管理者のみ使用できます。", ephemeral=True)
         return
 
-    global default_punishment, timeout_duration_minutes
+    guild_id = interaction.guild.id
+    timeout_duration_minutes = guild_configs.get(guild_id, "timeout_duration_minutes")
     punishment_type_value = punishment_type.value.lower()
 
     # タイムアウトの場合は時間が必要
@@ -722,9 +4728,10 @@ async def punish_command(
         else:
             # 新しいタイムアウト時間を設定
             timeout_duration_minutes = timeout_minutes
+            guild_configs.set(guild_id, "timeout_duration_minutes", timeout_minutes)
 
-    # 全体の処罰方法を設定
-    default_punishment = punishment_type_value
+    # このサーバーの処罰方法を設定
+    guild_configs.set(guild_id, "default_punishment", punishment_type_value)
     save_config()
 
     # 結果を返す
@@ -737,7 +4744,7 @@ async def punish_command(
     punishment_name = punishment_names.get(punishment_type_value, punishment_type_value)
     
     embed = discord.Embed(
-        title="✅ 全体の処罰設定を更新しました",
+        title="✅ このサーバーの処罰設定を更新しました",
         description=f"今後検知されるすべてのユーザーに自動適用される処罰: **{punishment_name}**\n\nこの設定は、リストに記載されているユーザーIDや禁止文字列を検知した際に、すべてのユーザーに適用されます。",
         color=discord.Color.green()
     )
@@ -748,15 +4755,17 @@ async def punish_command(
     await interaction.response.send_message(embed=embed, ephemeral=True)
 
 
-@bot.tree.command(name="punishstatus", description="現在の全体処罰設定を確認")
+@bot.tree.command(name="punishstatus", description="このサーバーの現在の処罰設定を確認")
 async def punishstatus_command(interaction: discord.Interaction):
-    """現在の全体処罰設定を確認するコマンド"""
+    """このサーバーの現在の処罰設定を確認するコマンド"""
     if not interaction.user.guild_permissions.administrator:
         await interaction.response.send_message("このコマンドは管理者のみ使用できます。", ephemeral=True)
         return
 
-    global default_punishment, timeout_duration_minutes
-    
+    rules = rules_for(interaction.guild.id)
+    default_punishment = rules.punishment
+    timeout_duration_minutes = rules.timeout_minutes
+
     punishment_names = {
         "ban": "バン",
         "kick": "キック",
@@ -766,7 +4775,7 @@ async def punishstatus_command(interaction: discord.Interaction):
     punishment_name = punishment_names.get(default_punishment, default_punishment)
     
     embed = discord.Embed(
-        title="現在の全体処罰設定",
+        title="このサーバーの現在の処罰設定",
         description=f"検知時に自動適用される処罰: **{punishment_name}**",
         color=discord.Color.blue()
     )
@@ -777,19 +4786,197 @@ async def punishstatus_command(interaction: discord.Interaction):
     )
     if default_punishment == "timeout":
         embed.add_field(name="タイムアウト時間", value=f"{timeout_duration_minutes}分", inline=False)
-    embed.set_footer(text="設定を変更するには /punish コマンドを使用してください")
+    embed.add_field(
+        name="連携モード",
+        value="有効（他のサーバーで検知したユーザーもこのサーバーで処罰）" if rules.federation else "無効",
+        inline=False
+    )
+    embed.set_footer(text="設定を変更するには /punish・/federation コマンドを使用してください")
     
     await interaction.response.send_message(embed=embed, ephemeral=True)
 
 
+@bot.tree.command(name="federation", description="連携モード（他のサーバーと検知したユーザーの処罰を共有）を設定")
+@app_commands.describe(enabled="有効にすると、連携を有効にしたサーバーどうしで検知したユーザーを共通で処罰します")
+async def federation_command(interaction: discord.Interaction, enabled: bool):
+    """このサーバーの連携モードを設定するコマンド"""
+    if not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message("このコマンドは管理者のみ使用できます。", ephemeral=True)
+        return
+
+    guild_configs.set(interaction.guild.id, "federation", enabled)
+    save_config()
+    if enabled:
+        await interaction.response.send_message(
+            "連携モードを有効にしました。このサーバーで検知したユーザーは、連携を有効にした他のサーバーでも処罰され、"
+            "他のサーバーで検知したユーザーもこのサーバーで処罰されます。結果はログチャンネルにまとめて送信します。",
+            ephemeral=True
+        )
+    else:
+        await interaction.response.send_message("連携モードを無効にしました。", ephemeral=True)
+
+
+@bot.tree.command(name="queuestatus", description="処罰キューの状態を表示")
+async def queuestatus_command(interaction: discord.Interaction):
+    """処罰キューの待機数と処理時間を表示するコマンド"""
+    if not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message("このコマンドは管理者のみ使用できます。", ephemeral=True)
+        return
+
+    queue = punishment_queues.get(interaction.guild.id)
+    embed = discord.Embed(title="処罰キューの状態", color=discord.Color.blue())
+    if queue is None:
+        embed.description = "このサーバーではまだ処罰が実行されていません。"
+    else:
+        embed.add_field(name="待機中", value=f"{queue.depth}件", inline=True)
+        embed.add_field(name="処理済み", value=f"{queue.processed}件", inline=True)
+        embed.add_field(name="ワーカー数", value=str(len(queue.workers)), inline=True)
+        embed.add_field(
+            name="処理時間（追加から完了まで）",
+            value=f"中央値 {queue.latency_percentile(0.5):.2f}秒 / p95 {queue.latency_percentile(0.95):.2f}秒",
+            inline=False
+        )
+        embed.add_field(name="レート制限", value=f"{queue.rate_limited}回（現在の待機 {queue.backoff:.2f}秒）", inline=False)
+    embed.add_field(
+        name="省略したユーザー取得リクエスト",
+        value=f"{rest_calls_avoided}回（名前キャッシュ: {len(user_info_cache)}件, ヒット {user_info_cache.hits} / ミス {user_info_cache.misses}）",
+        inline=False
+    )
+
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+
+@bot.tree.command(name="endlockdown", description="レイド検知によるロックダウンを解除")
+async def endlockdown_command(interaction: discord.Interaction):
+    """ロックダウンを解除するコマンド"""
+    if not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message("このコマンドは管理者のみ使用できます。", ephemeral=True)
+        return
+
+    state = join_states.get(interaction.guild.id)
+    if state is None or not state.locked_down:
+        await interaction.response.send_message("ロックダウン中ではありません。", ephemeral=True)
+        return
+
+    # 検知の記録ごと初期化し、直後の参加で再びロックダウンしないようにする
+    del join_states[interaction.guild.id]
+    await interaction.response.send_message("ロックダウンを解除しました。", ephemeral=True)
+
+
+@bot.tree.command(name="stats", description="BOTの動作状況（処理時間・検知数・API呼び出し数）を表示")
+async def stats_command(interaction: discord.Interaction):
+    """メトリクスの概要を表示するコマンド"""
+    if not interaction.user.guild_permissions.administrator:
+        await interaction.response.send_message("このコマンドは管理者のみ使用できます。", ephemeral=True)
+        return
+
+    guild_id = interaction.guild.id
+    embed = discord.Embed(title="動作状況", color=discord.Color.blue())
+
+    embed.add_field(
+        name="イベント（このサーバー）",
+        value=(
+            f"メッセージ: {metrics.counter_value('events_total', guild=guild_id, type='message')}件\n"
+            f"編集: {metrics.counter_value('events_total', guild=guild_id, type='edit')}件\n"
+            f"参加: {metrics.counter_value('events_total', guild=guild_id, type='join')}件"
+        ),
+        inline=False
+    )
+    embed.add_field(
+        name="内容のキャッシュ（全サーバー）",
+        value=(
+            f"ヒット率: {content_cache.hit_rate * 100:.1f}%\n"
+            f"変更なしの編集: {content_cache.unchanged_hits}件 / 判定結果の再利用: {content_cache.verdict_hits}件 / "
+            f"照合: {content_cache.misses}件"
+        ),
+        inline=False
+    )
+
+    detections = {}
+    for (name, labels), value in metrics.counters.items():
+        labels = dict(labels)
+        if name == "detections_total" and labels.get("guild") == guild_id:
+            detections[labels["type"]] = detections.get(labels["type"], 0) + value
+    embed.add_field(
+        name="検知数（このサーバー）",
+        value="\n".join(f"{action_type}: {count}件" for action_type, count in detections.items()) or "なし",
+        inline=False
+    )
+
+    latency_lines = []
+    for (name, labels), histogram in metrics.histograms.items():
+        if histogram.count and name in ("handler_latency_seconds", "punishment_latency_seconds", "log_send_latency_seconds"):
+            label = dict(labels).get("handler") or dict(labels).get("type") or "log_send"
+            latency_lines.append(
+                f"{label}: p50 {histogram.quantile(0.5) * 1000:.2f}ms / p99 {histogram.quantile(0.99) * 1000:.2f}ms（{histogram.count}回）"
+            )
+    embed.add_field(name="処理時間", value="\n".join(latency_lines) or "なし", inline=False)
+
+    queue = punishment_queues.get(guild_id)
+    embed.add_field(
+        name="処罰（このサーバー）",
+        value=(
+            f"成功: {metrics.counter_value('punishments_total', guild=guild_id, result='ok')}件 / "
+            f"失敗: {metrics.counter_value('punishments_total', guild=guild_id, result='failed')}件\n"
+            f"キュー待機: {queue.depth if queue else 0}件 / ログ送信待ち: {len(log_sink.buffers.get(guild_id, ()))}件"
+        ),
+        inline=False
+    )
+    embed.add_field(
+        name="API",
+        value=(
+            f"REST呼び出し: {metrics.counter_value('rest_calls_total')}回（省略 {rest_calls_avoided}回）\n"
+            f"レート制限: {metrics.counter_value('rate_limits_total')}回"
+        ),
+        inline=False
+    )
+    if metrics_port:
+        embed.set_footer(text=f"詳細: http://{metrics_host}:{metrics_port}/metrics")
+
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+
 if __name__ == "__main__":
+    # バンリストの取り込み・書き出し（BOTは起動しない）
+    #   py main.py --import raid_list.csv / py main.py --export backup.ndjson
+    #   形式は拡張子（.ndjson .jsonl .csv .txt .json）から判定する。--format で指定も可
+    cli = argparse.ArgumentParser(description="荒らし対策BOT（--import / --export を指定した場合は起動しない）")
+    cli_action = cli.add_mutually_exclusive_group()
+    cli_action.add_argument("--import", dest="import_file", metavar="FILE", help="ファイルからリストにまとめて追加する")
+    cli_action.add_argument("--export", dest="export_file", metavar="FILE", help="リストをファイルに書き出す")
+    cli.add_argument("--format", choices=IMPORT_FORMATS, help="ファイルの形式（省略時は拡張子から判定）")
+    cli.add_argument("--reason", help="追加する理由（記録用）")
+    cli_args = cli.parse_args()
+    if cli_args.export_file:
+        fmt = cli_args.format or FORMAT_EXTENSIONS.get(os.path.splitext(cli_args.export_file.lower())[1], "json")
+        ban_list.export_file(cli_args.export_file, fmt)
+        print(f"バンリストを {cli_args.export_file} に書き出しました。")
+        exit(0)
+    if cli_args.import_file:
+        if not os.path.exists(cli_args.import_file):
+            print(f"{cli_args.import_file} が見つかりません。")
+            exit(1)
+        try:
+            summary = ban_list.import_file(
+                cli_args.import_file, cli_args.format,
+                reason=cli_args.reason or f"{cli_args.import_file} から取り込み"
+            )
+        except ValueError as e:
+            ban_list.flush_sync()
+            print(f"{cli_args.import_file} を読み取れませんでした（{e}）。読み取れた部分までは追加されています。")
+            exit(1)
+        # 起動中の BOT が次の圧縮で取り込んだ分を消さないよう、スナップショットにまとめる
+        ban_list.flush_sync(compact=True)
+        print(summary.describe())
+        exit(0)
+
     token = config.get("token")
     if not token:
         print("config.jsonにトークンが設定されていません。")
         exit(1)
     
     try:
-        bot.run(token)
+        bot.run(token, log_handler=None)
     except discord.errors.PrivilegedIntentsRequired as e:
         print("\n" + "="*60)
         print("【エラー】特権インテントが有効化されていません")